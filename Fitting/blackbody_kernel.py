@@ -0,0 +1,97 @@
+import numpy as np
+
+try:
+    from profiling import timed #stage timers, when an entry point has put Photometry/ on the path
+except ImportError:
+    def timed(name = None):
+        return lambda function: function
+
+#Unitless NumPy version of the modified blackbody that fitter.py fits, with its analytic Jacobian.
+#Frequencies are in Hz, temperatures in K and fluxes in Jy; the model is
+#    S = scale * nu^beta * B_nu(T)
+#which is dust_emissivity's modified_blackbody(nu, T, beta, scale) in erg / s / cm^2 / Hz / sr times 10^23.
+#All functions broadcast, so a whole grid of parameters or an ensemble of walkers can be evaluated in one call.
+#test_blackbody_kernel.py compares the kernel with dust_emissivity (python -m pytest Fitting).
+
+#exact SI values in cgs, the same as astropy.constants, which takes too long to import for a quick run
+_h = 6.62607015e-27 #erg s
+_c = 2.99792458e10 #cm / s
+_k_B = 1.380649e-16 #erg / K
+_jansky = 10**23 #erg / s / cm^2 / Hz to Jy
+
+#frequencies in Hz of wavelengths in microns
+def micronsToHz(wavelengths):
+    return _c / (np.asarray(wavelengths, dtype = float) * 1e-4)
+
+#the Planck function in Jy / sr, along with x = h nu / k T
+def _planck(nu, temperature):
+    x = _h * nu / (_k_B * temperature)
+    with np.errstate(over = 'ignore'):
+        planck = 2 * _h * nu**3 / _c**2 / np.expm1(x) * _jansky
+    return planck, x
+
+#modified blackbody flux in Jy
+def modifiedBlackbody(nu, temperature, beta, scale):
+    planck, x = _planck(nu, temperature)
+    return scale * nu**beta * planck
+
+#partial derivatives of modifiedBlackbody with respect to temperature, beta and scale.
+#Returns an array with the three derivatives along the last axis.
+def modifiedBlackbodyJacobian(nu, temperature, beta, scale):
+    planck, x = _planck(nu, temperature)
+    unscaled = nu**beta * planck
+    flux = scale * unscaled
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        dlogb_dt = x / temperature / -np.expm1(-x) #d ln B / dT = (x / T) e^x / (e^x - 1)
+    d_temperature = np.where(flux == 0, 0, flux * dlogb_dt)
+    d_beta = flux * np.log(nu)
+    d_scale = unscaled * np.ones_like(flux)
+    return np.stack(np.broadcast_arrays(d_temperature, d_beta, d_scale), axis = -1)
+
+#scale that makes the model pass through a flux at a frequency, for given temperature and beta
+def scaleGuess(nu, flux, temperature, beta):
+    return flux / modifiedBlackbody(nu, temperature, beta, 1)
+
+#least-squares fit of the modified blackbody, using the analytic Jacobian.
+#guesses is (temperature, beta, scale). Returns (parameters, errors, chi square), where the errors come from the
+#covariance matrix scaled by the reduced chi square (as lmfit does) and are None if the covariance could not be found.
+#Raises ValueError if the fit fails.
+@timed('fit')
+def fitModifiedBlackbody(nu, flux, error, guesses):
+    from scipy.optimize import least_squares
+
+    nu = np.asarray(nu, dtype = float)
+    flux = np.asarray(flux, dtype = float)
+    error = np.asarray(error, dtype = float)
+
+    def residuals(p):
+        return (modifiedBlackbody(nu, p[0], p[1], p[2]) - flux) / error
+
+    def jacobian(p):
+        return modifiedBlackbodyJacobian(nu, p[0], p[1], p[2]) / error[:, None]
+
+    with np.errstate(all = 'ignore'):
+        result = least_squares(residuals, np.array(guesses, dtype = float), jac = jacobian, method = 'lm', x_scale = 'jac')
+    if not result.success or not np.all(np.isfinite(result.x)):
+        raise ValueError('Fit did not converge: ' + result.message)
+
+    pars = [float(par) for par in result.x]
+    chi = float(np.sum(result.fun**2))
+    return (pars, parameterErrors(nu, error, pars, chi), chi)
+
+#parameter errors at a solution, from the covariance matrix scaled by the reduced chi square.
+#Returns [None, None, None] if the covariance could not be found.
+def parameterErrors(nu, error, pars, chi):
+    nu = np.asarray(nu, dtype = float)
+    jacobian = modifiedBlackbodyJacobian(nu, pars[0], pars[1], pars[2]) / np.asarray(error, dtype = float)[:, None]
+    dof = len(nu) - len(pars)
+    try:
+        covariance = np.linalg.inv(jacobian.T.dot(jacobian))
+        if dof > 0:
+            covariance = covariance * chi / dof
+        errs = [float(err) for err in np.sqrt(np.diag(covariance))]
+        if not np.all(np.isfinite(errs)):
+            errs = [None, None, None]
+    except np.linalg.LinAlgError:
+        errs = [None, None, None]
+    return errs
@@ -1,142 +1,268 @@
-from astropy import units as u
-from astropy import constants
-from dust_emissivity import blackbody, fit_sed
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
 import csv
+import multiprocessing
+import os
+import sys
 
-_m_p = constants.m_p.cgs.value
-_c = 300000000
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Photometry')) #results table format and stage timers
+from results_table import tableBands, bandColumns, detectionMask
+from results_store import DEFAULT_STORE, LATEST, loadResults, isStore, storeConfigs
+from blackbody_kernel import scaleGuess, fitModifiedBlackbody, parameterErrors, micronsToHz
+from seed_grid import BANDS as GRID_BANDS, gridSeeds
+from posterior import sampleRow
+from result_cache import rowKey, ResultCache
+from sed_plots import renderPlots
 
-print('\nEnter the file path of the results spreadsheet.')
-results_path = str(input('Spreadsheet File Path: '))
+#numbered copies of the results file tried when it is open elsewhere
+OUTPUT_COPIES = 10
 
-while True:
-    try:
-        with open(results_path, newline = '') as results:
-            reader = csv.reader(results)
-            next(reader) # skip header
-            data = [row for row in reader]
-        break
-    except ValueError:
-        results_path = str(input('Invalid input. Try again: '))
-    except FileNotFoundError:
-        results_path = str(input('File not found. Try again: '))
-    except OSError:
-        results_path = str(input('Invalid file. Try again: '))
-
-print('\n')
-
-print('Generate plots?')
-plots = ' '
-while (plots != 'y' and plots != 'n'):
-    plots = str(input('y/n: '))
-
-print('\n')
-
-writetofile = [] # array that contains the lines of the output csv
-for row in data:
-    i = 3
-    detections = 0
-    wavelengths = []
-    fluxes = []
-    fluxes_err = []
-    outputrow = [row[0], row[1], row[2]] # array that contains the elements of a line of the output csv
-    bestflux = 0
-    bestfreq = 0
-    tracker = 0
-    while i < 24:
-        if row[i] == '': # skip a wavelength with no data
-            i += 3
-        elif float(row[i]) <= 3 * float(row[i + 1]): # skip a nondetection
-            i += 3
-        else:
-            detections += 1
-
-            if i == 3: # append the wavelength of the detection
-                wavelength = 24
-                wavelengths.append(wavelength)
-            elif i == 6:
-                wavelength = 70
-                wavelengths.append(wavelength)
-            elif i == 9:
-                wavelength = 100
-                wavelengths.append(wavelength)
-            elif i == 12:
-                wavelength = 160
-                wavelengths.append(wavelength)
-            elif i == 15:
-                wavelength = 250
-                wavelengths.append(wavelength)
-            elif i == 18:
-                wavelength = 350
-                wavelengths.append(wavelength)
-            elif i == 21:
-                wavelength = 500
-                wavelengths.append(wavelength)
-
-            flux = float(row[i])
-            photerr = float(row[i + 1])
-            err = float(row[i + 2])
-            if flux / photerr > tracker: # find best detected flux
-                tracker = flux / photerr
-                bestflux = flux
-                bestfreq = _c / (wavelength * 10**-6)
-            fluxes.append(flux)
-            fluxes_err.append(err)
-
-            i += 3
+#columns of fitting_results.csv
+HEADER = ['Galaxy', 'Aperture', 'ApName', 'Temp', 'Temp Error', 'Beta', 'Beta Error', 'Scale', 'Scale Error', 'Chi Square','Detection']
+
+#fit a modified blackbody to one aperture. This does no plotting or printing, so apertures can be fit in any process.
+#label is (galaxy, aperture, ap_name); frequencies (Hz), fluxes and fluxes_err (Jy) hold only the detected bands.
+#guesses is the (temperature, beta, scale) guess from the table and seed is (temperature, beta, scale, chi square)
+#from the seed grid, or None. With grid_only the seed is used as the fit.
+#Returns (output row, message, plot data). The message is None unless the fit failed, and the plot data is None unless a fit was made.
+#The plot data is (title, frequencies in Hz, fluxes in Jy, flux errors in Jy, fit parameters, minimum frequency, maximum frequency).
+def fitRow(label, frequencies, fluxes, fluxes_err, guesses, seed = None, grid_only = False):
+    outputrow = list(label) # array that contains the elements of a line of the output csv
+    message = None
+    plot = None
+    detections = len(frequencies)
 
     if detections >= 3:
-        maxfreq = _c / (wavelengths[0] * 10**-6)
-        minfreq = _c / (wavelengths[len(wavelengths) - 1] * 10**-6)
-        wavelengths = np.array(wavelengths) * u.um
-        frequencies = wavelengths.to(u.Hz, u.spectral())
-        fluxes = np.array(fluxes) * u.Jy
-        fluxes_err = np.array(fluxes_err) * u.Jy
-        tguess, bguess, sguess = float(row[24]) * u.K, float(row[25]), float(row[26])
+        #start from the grid seed if there is one, falling back on the table guesses
+        guesses = [tuple(guesses)]
+        if seed != None:
+            guesses.insert(0, tuple(seed[:3]))
 
-        sguess = bestflux / ((blackbody.modified_blackbody(bestfreq * u.Hz, tguess, bguess, 1) / (u.erg/u.s/u.cm**2/u.Hz/u.sr)) * 10**23)
-        print(sguess)
+        try:
+            if grid_only and seed != None:
+                pars, chi = [float(par) for par in seed[:3]], float(seed[3])
+                errs = parameterErrors(frequencies, fluxes_err, pars, chi)
+            else:
+                for guess in guesses:
+                    try:
+                        pars, errs, chi = fitModifiedBlackbody(frequencies, fluxes, fluxes_err, guess)
+                        break
+                    except ValueError:
+                        if guess == guesses[-1]:
+                            raise
 
-        t = np.arange(minfreq, maxfreq, minfreq * 0.01)
+            outputrow.append(pars[0])
+            outputrow.append(errs[0])
+            outputrow.append(pars[1])
+            outputrow.append(errs[1])
+            outputrow.append(pars[2])
+            outputrow.append(errs[2])
+            outputrow.append(chi)
+            outputrow.append(detections)
 
-        try:
-            pars, errs, chi = fit_sed.fit_modified_bb(frequencies, fluxes, fluxes_err, (tguess, bguess, sguess), detections, return_error = True)
-
-            if plots == 'y':
-                plt.title(row[0] + ': ' + row[2])
-                plt.xlabel('Frequency (Hz)')
-                plt.ylabel('Flux (Jy)')
-                #plt.plot(frequencies / u.Hz, (fluxes / u.Jy), 'bo', t, (blackbody.modified_blackbody(t * u.Hz, pars[0] * u.K, pars[1], pars[2] * u.cm**-2, pars[3]) / u.erg/u.s/u.cm**2/u.Hz/u.sr) * 10**23, 'r-')
-                plt.errorbar(frequencies / u.Hz, (fluxes / u.Jy), yerr = fluxes_err / u.Jy, fmt='ko')
-                plt.plot(t, (blackbody.modified_blackbody(t * u.Hz, pars[0] * u.K, pars[1], pars[2]) / (u.erg/u.s/u.cm**2/u.Hz/u.sr)) * 10**23, 'r-')
-                plt.show()
-
-                outputrow.append(pars[0])
-                outputrow.append(errs[0])
-                outputrow.append(pars[1])
-                outputrow.append(errs[1])
-                outputrow.append(pars[2])
-                outputrow.append(errs[2])
-                outputrow.append(chi)
-                outputrow.append(detections)
+            plot = (label[0] + ': ' + label[2], frequencies, fluxes, fluxes_err, pars, frequencies.min(), frequencies.max())
         except ValueError:
             outputrow.append('Error')
-            print('Could not generate fit for ' + row[0] + ': ' + row[2] + '. Try changing the guesses.')
+            message = 'Could not generate fit for ' + label[0] + ': ' + label[2] + '. Try changing the guesses.'
+
+    return (outputrow, message, plot)
+
+#set up the fit of every row of a results table (see Photometry/results_table.py) in one vectorized pass:
+#the 3 sigma detection mask, the scale guess from the detection with the best signal to noise, and the seed grid point.
+#Returns one argument tuple for fitRow per row.
+def fitJobs(table, grid_only = False):
+    bands = tableBands(table)
+    frequencies = micronsToHz(bands)
+    fluxes = bandColumns(table, 'flux')
+    photerrs = bandColumns(table, 'sky_error')
+    errors = bandColumns(table, 'total_error')
+    detected = detectionMask(table)
+
+    #scale guess through the best detection, for the table's temperature and beta guesses
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        best = np.argmax(np.where(detected, fluxes / photerrs, -np.inf), axis = 1)
+    rows = np.arange(len(table))
+    scales = scaleGuess(frequencies[best], fluxes[rows, best], table['temp_guess'], table['beta_guess'])
+
+    #seed grid, whose columns are seed_grid.BANDS
+    grid_fluxes = np.zeros((len(table), len(GRID_BANDS)))
+    grid_errors = np.ones((len(table), len(GRID_BANDS)))
+    grid_use = np.zeros((len(table), len(GRID_BANDS)), dtype = bool)
+    for j, band in enumerate(bands):
+        if band in GRID_BANDS:
+            k = GRID_BANDS.index(band)
+            grid_fluxes[:, k], grid_errors[:, k], grid_use[:, k] = fluxes[:, j], errors[:, j], detected[:, j]
+    seeds = np.stack(gridSeeds(grid_fluxes, grid_errors, grid_use), axis = 1)
 
-    writetofile.append(outputrow)
+    jobs = []
+    for i in range(len(table)):
+        use = detected[i]
+        label = (str(table['galaxy'][i]), int(table['aperture'][i]), str(table['ap_name'][i]))
+        guesses = (float(table['temp_guess'][i]), float(table['beta_guess'][i]), float(scales[i]))
+        seed = tuple(seeds[i]) if np.all(np.isfinite(seeds[i])) else None
+        jobs.append((label, frequencies[use], fluxes[i, use], errors[i, use], guesses, seed, grid_only))
+    return jobs
 
-while True:
+#fit every row of a results table on a pool of worker processes. Results come back in the same order as the rows.
+#Every row is seeded from the grid first. mode is 'f' for the full fit, 'g' to report the grid point instead of running
+#the optimizer, or 'm' to sample the posterior (see posterior.py), saving the chains in chain_directory.
+#With one worker the rows are fit in this process.
+#If cache_path is given, rows whose inputs match a cached fit are not refit, and every new fit is added to the cache
+#as soon as it is done (see result_cache.py), so an interrupted run can be resumed.
+def fitRows(table, workers, mode = 'f', chain_directory = 'chains', cache_path = None):
+    jobs = fitJobs(table, mode == 'g')
+    function = fitRow
+    if mode == 'm':
+        jobs = [job[:6] for job in jobs]
+        function = functools.partial(sampleRow, chain_directory = chain_directory)
+
+    results = [None] * len(jobs)
+    cache = None
+    if cache_path != None:
+        cache = ResultCache(cache_path)
+        keys = [rowKey(job, mode) for job in jobs]
+        for i, key in enumerate(keys):
+            cached = cache.get(key)
+            if cached != None:
+                results[i] = (cached[0], cached[1], plotData(jobs[i], cached[0]))
+    todo = [i for i in range(len(jobs)) if results[i] == None]
+    if cache != None:
+        print('Reusing ' + str(len(jobs) - len(todo)) + ' cached fits, fitting ' + str(len(todo)) + ' rows.')
+
+    pool = None
     try:
-        with open('fitting_results.csv', 'w', newline = '') as fitting_results:
-            fitwriter = csv.writer(fitting_results)
-            fitwriter.writerow(['Galaxy', 'Aperture', 'ApName', 'Temp', 'Temp Error', 'Beta', 'Beta Error', 'Scale', 'Scale Error', 'Chi Square','Detection'])
-            for row in writetofile:
-                fitwriter.writerow(row)
-        break
-    except PermissionError:
-        proceed = str(input('Could not write to file. Make sure it is closed and press \'Enter\' to try again. '))
+        if workers == 1 or len(todo) < 2:
+            fits = (function(*jobs[i]) for i in todo)
+        else:
+            pool = multiprocessing.Pool(workers)
+            fits = pool.imap(functools.partial(_applyJob, function), [jobs[i] for i in todo],
+                             chunksize = max(len(todo) // (workers * 16), 1))
+        for i, result in zip(todo, fits):
+            results[i] = result
+            if cache != None:
+                cache.add(keys[i], result[0], result[1])
+    finally:
+        if pool != None:
+            pool.terminate()
+        if cache != None:
+            cache.close()
+    return results
+
+#call a fit function with the arguments of a job. Lets pool.imap, which passes one argument, run fitRow and sampleRow.
+def _applyJob(function, job):
+    return function(*job)
+
+#plot data of a finished fit, from its job and its output row, or None if there was no fit
+def plotData(job, outputrow):
+    label, frequencies, fluxes, fluxes_err = job[:4]
+    if len(outputrow) < 11:
+        return None
+    pars = [outputrow[3], outputrow[5], outputrow[7]]
+    return (label[0] + ': ' + label[2], frequencies, fluxes, fluxes_err, pars, frequencies.min(), frequencies.max())
+
+#fit every row of a results table (see Photometry/results_table.py, or loadResults for a file) and write the fits to
+#output_path, printing the failed fits. If output_path is open elsewhere, a numbered copy next to it is written instead.
+#With plots, the fits are also rendered to plot_directory. Returns (fit results from fitRows, path written).
+def runFit(data, workers, mode = 'f', plots = False, output_path = 'fitting_results.csv', cache_path = 'fitting_cache.jsonl', plot_directory = 'plots'):
+    fit_results = fitRows(data, workers, mode, cache_path = cache_path)
+    for outputrow, message, plot in fit_results:
+        if message != None:
+            print(message)
+
+    writetofile = [outputrow for outputrow, message, plot in fit_results] # array that contains the lines of the output csv
+
+    #if the results file is open elsewhere, write a copy next to it instead of waiting; the fits are in the cache anyway.
+    #Only a file that exists can be locked, so a file that cannot be made (a read-only directory) raises, as does
+    #running out of copies.
+    base = output_path[:-len('.csv')] if output_path.endswith('.csv') else output_path
+    copy = 0
+    while True:
+        try:
+            with open(output_path, 'w', newline = '') as fitting_results:
+                fitwriter = csv.writer(fitting_results)
+                fitwriter.writerow(HEADER)
+                for row in writetofile:
+                    fitwriter.writerow(row)
+            break
+        except PermissionError:
+            if not os.path.exists(output_path) or copy >= OUTPUT_COPIES:
+                raise
+            copy += 1
+            output_path = base + '_' + str(copy) + '.csv'
+            print('Could not write to the results file, trying ' + output_path)
+    print('Wrote ' + output_path)
+
+    if plots:
+        written = renderPlots([(outputrow[:3], plot) for outputrow, message, plot in fit_results], plot_directory, 'png', True, workers)
+        print('Wrote ' + str(len(written)) + ' plot files to ' + plot_directory + '/')
+    return (fit_results, output_path)
+
+if __name__ == '__main__':
+    print('\nEnter the file path of the results table (.npy or .csv) or results store. Leave it empty to use the photometry results store.')
+    results_path = str(input('Results File Path: '))
+
+    while True:
+        try:
+            if results_path == '':
+                results_path = DEFAULT_STORE
+            store = not results_path.endswith('.npy') and isStore(results_path)
+            configs = storeConfigs(results_path) if store else []
+            data = loadResults(results_path) if not store else None
+            break
+        except ValueError:
+            results_path = str(input('Invalid input. Try again: '))
+        except FileNotFoundError:
+            results_path = str(input('File not found. Try again: '))
+        except OSError:
+            results_path = str(input('Invalid file. Try again: '))
+
+    print('\n')
+
+    if store:
+        #measurements made with different settings are not fit together
+        print('The store holds measurements made with these settings (config: number of measurements):')
+        for config, count in configs:
+            print('\t' + config + ': ' + str(count))
+        print('Enter the config to fit. Leave it empty to use the latest config of each galaxy, or enter \'all\' to use every measurement.')
+        config = str(input('Config: '))
+        while config not in ['', 'all'] + [listed for listed, count in configs]:
+            config = str(input('Invalid input. Try again: '))
+        data = loadResults(results_path, {'': LATEST, 'all': None}.get(config, config))
+
+        print('\n')
+
+    print('Generate plots? They are saved to \'plots/\' as PNG files, with a PDF of all plots for each galaxy.')
+    plots = ' '
+    while (plots != 'y' and plots != 'n'):
+        plots = str(input('y/n: '))
+
+    print('\n')
+
+    print('Fit mode? \'f\' runs the full fit, \'g\' only looks up the nearest point of the precomputed grid (fast, approximate),')
+    print('\'m\' samples the posterior with MCMC and saves the chains to \'chains/\' (slower, for degenerate fits).')
+    mode = ' '
+    while (mode != 'f' and mode != 'g' and mode != 'm'):
+        mode = str(input('f/g/m: '))
+
+    print('\n')
+
+    print('Enter the number of worker processes. Leave blank to use one per core.')
+    while True:
+        try:
+            workers = str(input('Workers: '))
+            if workers == '':
+                workers = os.cpu_count() or 1
+            else:
+                workers = int(workers)
+            if workers >= 1:
+                break
+            print('Invalid input. Try again.')
+        except ValueError:
+            print('Invalid input. Try again.')
+
+    print('\n')
+
+    runFit(data, workers, mode, plots == 'y')
 
 #wavelengths = np.array([24, 100, 160, 250, 350, 500]) * u.um
 #frequencies = wavelengths.to(u.Hz, u.spectral())
@@ -0,0 +1,240 @@
+from astropy.io import fits
+from astropy.wcs.utils import proj_plane_pixel_area
+import numpy as np
+import argparse
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Photometry')) #share the FITS access code in Photometry/
+from fits_cache import getHeader, getData, getWcs, closeAll, isSpire
+from reprojection import cachedMapping, applyMapping, coarsestImage
+from profiling import timed
+from blackbody_kernel import modifiedBlackbody, modifiedBlackbodyJacobian, micronsToHz
+from seed_grid import BANDS as GRID_BANDS, gridSeeds
+
+#Pixel-by-pixel modified blackbody fits. The _convolved images of a galaxy (all at the resolution of the coarsest
+#band) are resampled onto the pixel grid of the coarsest band, stacked into a cube in Jy per pixel, and every pixel
+#with at least three bands above the signal to noise threshold is fit. The fits run on whole chunks of pixels at
+#once: a Levenberg-Marquardt solver where each step is a batch of 3 x 3 solves, started from the seed grid.
+#The temperature, beta, scale and chi square maps are written as the extensions of one FITS file.
+
+MAP_BANDS = [100, 160, 250] #um
+MAP_NAMES = ['TEMP', 'TEMP_ERR', 'BETA', 'BETA_ERR', 'SCALE', 'SCALE_ERR', 'CHI2', 'NBANDS']
+TEMPERATURE_BOUNDS = (2., 150.) #K
+BETA_BOUNDS = (0., 5.)
+
+#find the convolved image and error map of each band of a galaxy. Returns a list of (band, image path, error path),
+#leaving out bands that do not have both.
+def findBands(directory, galaxy, bands = MAP_BANDS):
+    found = []
+    for band in bands:
+        image = os.path.join(directory, galaxy + '_' + str(band) + '_convolved.fits')
+        error = os.path.join(directory, galaxy + '_' + str(band) + '_error_convolved.fits')
+        if os.path.exists(image) and os.path.exists(error):
+            found.append((band, image, error))
+    return found
+
+#convert an image of a band to Jy / sr. SPIRE maps are in MJy / sr and PACS maps in Jy / pixel (see isSpire in
+#Photometry/fits_cache.py).
+def surfaceBrightness(data, header, coord_info, band):
+    if isSpire(header, band):
+        return data * 1e6
+    return data / (proj_plane_pixel_area(coord_info) * (np.pi / 180)**2)
+
+#stack the bands of a galaxy onto the grid of the band with the largest pixels, by bilinear interpolation with the
+#cached mappings of reprojection.py. Because the images are already convolved to the coarsest beam, sampling them at
+#the coarse pixel centers loses nothing.
+#Returns (bands, fluxes, errors, target header), with fluxes and errors as (bands, y, x) cubes in Jy per target pixel.
+@timed('build_cube')
+def buildCube(found, level = 1):
+    target = coarsestImage([band[1] for band in found], level)
+    target_wcs = getWcs(target, level)
+    target_header = getHeader(target, level)
+    shape = getData(target, level).shape
+    pixel_area = proj_plane_pixel_area(target_wcs) * (np.pi / 180)**2
+
+    fluxes = np.empty((len(found),) + shape)
+    errors = np.empty((len(found),) + shape)
+    for i, (band, image, error) in enumerate(found):
+        coord_info = getWcs(image, level)
+        header = getHeader(image, level)
+        image_data = surfaceBrightness(getData(image, level), header, coord_info, band)
+        error_data = surfaceBrightness(getData(error, level), getHeader(error, level), getWcs(error, level), band)
+        if image == target:
+            fluxes[i], errors[i] = image_data, error_data
+        else:
+            mapping = cachedMapping(header, target_header) #the error map is on the same grid as the image
+            fluxes[i], errors[i] = applyMapping(mapping, image_data), applyMapping(mapping, error_data)
+    return ([band[0] for band in found], fluxes * pixel_area, errors * pixel_area, target_header)
+
+#Jacobian of the weighted residuals in (temperature, beta, ln scale), shaped (pixels, bands, 3)
+def _weightedJacobian(frequencies, pars, weights):
+    jacobian = modifiedBlackbodyJacobian(frequencies[None, :], pars[:, 0:1], pars[:, 1:2], np.exp(pars[:, 2:3]))
+    jacobian[:, :, 2] = jacobian[:, :, 2] * np.exp(pars[:, 2:3]) #d / d ln(scale) = scale * d / d scale
+    return jacobian * weights[:, :, None]
+
+#chi square of each pixel, with residuals of the bands that are not used weighted by 0
+def _chiSquare(frequencies, fluxes, weights, pars):
+    with np.errstate(all = 'ignore'):
+        models = modifiedBlackbody(frequencies[None, :], pars[:, 0:1], pars[:, 1:2], np.exp(pars[:, 2:3]))
+        chi = np.sum(((models - fluxes) * weights)**2, axis = 1)
+    return np.where(np.isfinite(chi), chi, np.inf)
+
+#fit many pixels at once with Levenberg-Marquardt. fluxes and errors are (pixels, bands) in Jy, use marks the bands
+#to fit in each pixel and seeds are (temperature, beta, scale) starting points.
+#Returns (parameters, errors, chi squares) with parameters and errors as (pixels, 3) arrays of temperature, beta, scale.
+@timed('fit_pixels')
+def fitPixels(frequencies, fluxes, errors, use, seeds, iterations = 100, tolerance = 1e-8):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        weights = np.where(use, 1 / errors, 0)
+    fluxes = np.where(use, fluxes, 0)
+    pars = np.column_stack([seeds[:, 0], seeds[:, 1], np.log(seeds[:, 2])])
+    chi = _chiSquare(frequencies, fluxes, weights, pars)
+    damping = np.full(len(pars), 1e-3)
+    active = np.isfinite(chi)
+    low = np.array([TEMPERATURE_BOUNDS[0], BETA_BOUNDS[0], -np.inf])
+    high = np.array([TEMPERATURE_BOUNDS[1], BETA_BOUNDS[1], np.inf])
+
+    for iteration in range(iterations):
+        if not np.any(active):
+            break
+        index = np.nonzero(active)[0]
+        p = pars[index]
+        with np.errstate(all = 'ignore'):
+            jacobian = _weightedJacobian(frequencies, p, weights[index])
+            models = modifiedBlackbody(frequencies[None, :], p[:, 0:1], p[:, 1:2], np.exp(p[:, 2:3]))
+            residuals = (models - fluxes[index]) * weights[index]
+            normal = np.einsum('nbi,nbj->nij', jacobian, jacobian)
+            gradient = np.einsum('nbi,nb->ni', jacobian, residuals)
+            diagonal = np.einsum('nii->ni', normal)
+            damped = normal + (damping[index, None] * diagonal + 1e-30)[:, :, None] * np.eye(3)
+        try:
+            step = -np.linalg.solve(damped, gradient[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = -np.einsum('nij,nj->ni', np.linalg.pinv(damped), gradient)
+        trial = np.clip(p + np.nan_to_num(step), low, high)
+        trial_chi = _chiSquare(frequencies, fluxes[index], weights[index], trial)
+
+        better = trial_chi < chi[index]
+        change = np.where(better, chi[index] - trial_chi, 0)
+        pars[index[better]] = trial[better]
+        chi[index[better]] = trial_chi[better]
+        damping[index] = np.where(better, np.maximum(damping[index] / 10, 1e-12), damping[index] * 10)
+        #stop pixels that have converged or can no longer improve
+        done = (better & (change <= tolerance * np.maximum(chi[index], 1e-12))) | (damping[index] > 1e12)
+        active[index[done]] = False
+
+    #errors from the covariance at the solution, not scaled: with three bands there are no degrees of freedom left
+    with np.errstate(all = 'ignore'):
+        jacobian = _weightedJacobian(frequencies, pars, weights)
+        normal = np.einsum('nbi,nbj->nij', jacobian, jacobian)
+        try:
+            covariance = np.linalg.inv(normal)
+        except np.linalg.LinAlgError:
+            covariance = np.linalg.pinv(normal)
+        errs = np.sqrt(np.einsum('nii->ni', covariance))
+    scale = np.exp(pars[:, 2])
+    parameters = np.column_stack([pars[:, 0], pars[:, 1], scale])
+    parameter_errors = np.column_stack([errs[:, 0], errs[:, 1], scale * errs[:, 2]])
+    return (parameters, parameter_errors, chi)
+
+#seed and fit one chunk of pixels. Runs in the worker processes.
+def fitChunk(chunk):
+    bands, fluxes, errors, use = chunk
+    frequencies = micronsToHz(bands)
+
+    grid_fluxes = np.zeros((len(fluxes), len(GRID_BANDS)))
+    grid_errors = np.ones((len(fluxes), len(GRID_BANDS)))
+    grid_use = np.zeros((len(fluxes), len(GRID_BANDS)), dtype = bool)
+    for j, band in enumerate(bands):
+        k = GRID_BANDS.index(band)
+        grid_fluxes[:, k], grid_errors[:, k], grid_use[:, k] = fluxes[:, j], errors[:, j], use[:, j]
+    seeds = np.stack(gridSeeds(grid_fluxes, grid_errors, grid_use, stride = 4)[:3], axis = 1) #a coarse seed is enough for the solver
+
+    good = np.all(np.isfinite(seeds), axis = 1) & (seeds[:, 2] > 0)
+    parameters = np.full((len(fluxes), 3), np.nan)
+    parameter_errors = np.full((len(fluxes), 3), np.nan)
+    chi = np.full(len(fluxes), np.nan)
+    if np.any(good):
+        parameters[good], parameter_errors[good], chi[good] = fitPixels(frequencies, fluxes[good], errors[good], use[good], seeds[good])
+    return (parameters, parameter_errors, chi)
+
+#fit every pixel of a galaxy with at least three bands at or above the signal to noise threshold.
+#Returns (maps, header, bands), where maps is a dictionary of 2D arrays named as in MAP_NAMES (nan where no fit was
+#made), header holds the WCS of the maps and bands are the bands that were found.
+def fitMap(directory, galaxy, bands = MAP_BANDS, snr = 3., workers = 1, level = 1, chunk_size = 4096):
+    found = findBands(directory, galaxy, bands)
+    if len(found) < 3:
+        raise ValueError(galaxy + ' has convolved images and error maps in only ' + str(len(found)) + ' of the bands')
+    bands, fluxes, errors, header = buildCube(found, level)
+    shape = fluxes.shape[1:]
+    fluxes = fluxes.reshape(len(bands), -1).T
+    errors = errors.reshape(len(bands), -1).T
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        use = np.isfinite(fluxes) & (errors > 0) & (fluxes >= snr * errors)
+    pixels = np.nonzero(np.count_nonzero(use, axis = 1) >= 3)[0]
+
+    chunks = [(bands, fluxes[pixels[start:start + chunk_size]], errors[pixels[start:start + chunk_size]],
+               use[pixels[start:start + chunk_size]]) for start in range(0, len(pixels), chunk_size)]
+    if workers == 1 or len(chunks) < 2:
+        results = [fitChunk(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(fitChunk, chunks)
+
+    maps = {name: np.full(shape[0] * shape[1], np.nan) for name in MAP_NAMES}
+    if len(results) > 0:
+        parameters = np.concatenate([result[0] for result in results])
+        parameter_errors = np.concatenate([result[1] for result in results])
+        chi = np.concatenate([result[2] for result in results])
+        for k, name in enumerate(['TEMP', 'BETA', 'SCALE']):
+            maps[name][pixels] = parameters[:, k]
+            maps[name + '_ERR'][pixels] = parameter_errors[:, k]
+        maps['CHI2'][pixels] = chi
+        maps['NBANDS'][pixels] = np.count_nonzero(use[pixels], axis = 1)
+    return ({name: values.reshape(shape) for name, values in maps.items()}, header, bands)
+
+#write the maps to a FITS file, one image extension per map, with the WCS of the grid they were fit on
+def writeMaps(path, maps, header, bands):
+    from astropy import wcs
+    map_header = wcs.WCS(header).to_header()
+    map_header['BANDS'] = (','.join(str(band) for band in bands), 'bands fit, um')
+    hdus = [fits.PrimaryHDU()]
+    for name in MAP_NAMES:
+        hdus.append(fits.ImageHDU(maps[name].astype(np.float32), header = map_header, name = name))
+    hdus[1].header['BUNIT'] = 'K'
+    hdus[2].header['BUNIT'] = 'K'
+    fits.HDUList(hdus).writeto(path, overwrite = True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Fit temperature and beta maps to the convolved images of each galaxy.')
+    parser.add_argument('root', nargs = '?', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FITS Files'),
+                        help = 'directory holding one directory per galaxy (default: FITS Files)')
+    parser.add_argument('--galaxies', nargs = '*', help = 'galaxies to fit (default: every galaxy with enough bands)')
+    parser.add_argument('--bands', type = int, nargs = '+', default = MAP_BANDS, help = 'bands to use, in um')
+    parser.add_argument('--snr', type = float, default = 3., help = 'signal to noise a band needs in a pixel to be fit')
+    parser.add_argument('--level', type = int, default = 1, help = 'level of the FITS files to analyze')
+    parser.add_argument('--workers', type = int, default = 0, help = 'number of worker processes (default: one per core)')
+    parser.add_argument('--output', default = '.', help = 'directory to write <galaxy>_dust_maps.fits to')
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers < 1:
+        workers = os.cpu_count() or 1
+
+    galaxies = args.galaxies
+    if galaxies == None:
+        galaxies = [galaxy for galaxy in sorted(os.listdir(args.root))
+                    if len(findBands(os.path.join(args.root, galaxy), galaxy, args.bands)) >= 3]
+
+    for galaxy in galaxies:
+        try:
+            maps, header, bands = fitMap(os.path.join(args.root, galaxy), galaxy, args.bands, args.snr, workers, args.level)
+        except (ValueError, OSError) as error:
+            print('Skipping ' + galaxy + ': ' + str(error))
+            continue
+        path = os.path.join(args.output, galaxy + '_dust_maps.fits')
+        writeMaps(path, maps, header, bands)
+        print('Wrote ' + path + ' (' + str(np.count_nonzero(np.isfinite(maps['TEMP']))) + ' pixels fit)')
+    closeAll()
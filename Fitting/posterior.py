@@ -0,0 +1,120 @@
+from blackbody_kernel import modifiedBlackbody, fitModifiedBlackbody
+import numpy as np
+import os
+import re
+import zlib
+
+try:
+    from profiling import timed #stage timers, when an entry point has put Photometry/ on the path
+except ImportError:
+    def timed(name = None):
+        return lambda function: function
+
+#Posterior sampling of the modified blackbody, for apertures where temperature and beta are degenerate and the
+#covariance errors of the least-squares fit mean little. Uses the affine-invariant ensemble sampler of
+#Goodman & Weare (2010), the same "stretch move" that emcee uses. The walkers are split into two halves and each half
+#is moved against the other, so the likelihood of half of the ensemble is computed in one vectorized call.
+#The parameters sampled are temperature, beta and log10(scale), with flat priors inside the bounds below.
+#Each aperture's chain (after burn-in, keeping every thin-th step) is saved with its summary to a compressed .npz file.
+
+PARAMETERS = ['temperature', 'beta', 'log10_scale']
+TEMPERATURE_BOUNDS = (2., 150.) #K
+BETA_BOUNDS = (0., 5.)
+
+#log posterior of an ensemble of walkers, an (n, 3) array of (temperature, beta, log10 scale).
+#Returns an array of n values, -inf outside the priors.
+def logPosterior(walkers, frequencies, fluxes, fluxes_err):
+    temperature, beta, log_scale = walkers[:, 0:1], walkers[:, 1:2], walkers[:, 2:3]
+    inside = ((temperature > TEMPERATURE_BOUNDS[0]) & (temperature < TEMPERATURE_BOUNDS[1])
+              & (beta > BETA_BOUNDS[0]) & (beta < BETA_BOUNDS[1]))[:, 0]
+    with np.errstate(all = 'ignore'):
+        models = modifiedBlackbody(frequencies[None, :], temperature, beta, 10**log_scale)
+        chi = np.sum(((models - fluxes[None, :]) / fluxes_err[None, :])**2, axis = 1)
+    return np.where(inside & np.isfinite(chi), -0.5 * chi, -np.inf)
+
+#run the ensemble sampler from an (walkers, 3) array of starting positions.
+#Returns (chain, log posteriors, acceptance fraction), with the chain shaped (steps, walkers, 3).
+def sampleEnsemble(start, frequencies, fluxes, fluxes_err, steps, rng, stretch = 2.):
+    walkers = start.copy()
+    count = len(walkers)
+    half = count // 2
+    log_probability = logPosterior(walkers, frequencies, fluxes, fluxes_err)
+    chain = np.empty((steps, count, walkers.shape[1]))
+    log_probabilities = np.empty((steps, count))
+    accepted = 0
+    for step in range(steps):
+        for moving, other in [(slice(0, half), slice(half, count)), (slice(half, count), slice(0, half))]:
+            current = walkers[moving]
+            n = len(current)
+            #stretch factors z drawn from g(z) ~ 1 / sqrt(z) on [1 / a, a]
+            z = ((stretch - 1) * rng.random(n) + 1)**2 / stretch
+            complement = walkers[other]
+            partners = complement[rng.integers(0, len(complement), n)]
+            proposal = partners + z[:, None] * (current - partners)
+            proposal_probability = logPosterior(proposal, frequencies, fluxes, fluxes_err)
+            with np.errstate(invalid = 'ignore'):
+                log_ratio = (walkers.shape[1] - 1) * np.log(z) + proposal_probability - log_probability[moving]
+            accept = np.log(rng.random(n)) < log_ratio
+            walkers[moving] = np.where(accept[:, None], proposal, current)
+            log_probability[moving] = np.where(accept, proposal_probability, log_probability[moving])
+            accepted += np.count_nonzero(accept)
+        chain[step] = walkers
+        log_probabilities[step] = log_probability
+    return (chain, log_probabilities, accepted / (steps * count))
+
+#file name of the chain of an aperture
+def chainPath(chain_directory, label):
+    name = re.sub(r'[^\w.-]+', '_', str(label[0]) + '_' + str(label[1]) + '_' + str(label[2]))
+    return os.path.join(chain_directory, name + '.npz')
+
+#sample the posterior of one aperture. Takes the same arguments as fitter.fitRow and returns the same
+#(output row, message, plot data), with the median of each parameter and half of its 16th - 84th percentile range
+#in place of the best fit and its error. The chi square is that of the most probable sample.
+#The walkers start in a small ball around the least-squares fit, or around the seed if the fit fails.
+@timed('posterior')
+def sampleRow(label, frequencies, fluxes, fluxes_err, guesses, seed = None, chain_directory = 'chains',
+              walkers = 32, steps = 1000, burn = 300, thin = 5):
+    outputrow = list(label)
+    message = None
+    plot = None
+    detections = len(frequencies)
+    if detections < 3:
+        return (outputrow, message, plot)
+
+    start = seed[:3] if seed != None else guesses
+    try:
+        start = fitModifiedBlackbody(frequencies, fluxes, fluxes_err, start)[0]
+    except ValueError:
+        pass
+    if not (start[2] > 0):
+        outputrow.append('Error')
+        message = 'Could not sample ' + str(label[0]) + ': ' + str(label[2]) + '. Try changing the guesses.'
+        return (outputrow, message, plot)
+
+    #the random numbers depend only on the aperture, so reruns give the same chains
+    rng = np.random.default_rng(zlib.crc32((str(label[0]) + str(label[1]) + str(label[2])).encode()))
+    center = np.array([np.clip(start[0], TEMPERATURE_BOUNDS[0] + 0.5, TEMPERATURE_BOUNDS[1] - 0.5),
+                       np.clip(start[1], BETA_BOUNDS[0] + 0.05, BETA_BOUNDS[1] - 0.05), np.log10(start[2])])
+    ball = center + rng.normal(size = (walkers, 3)) * np.array([0.01 * center[0], 0.01, 0.01])
+    chain, log_probabilities, acceptance = sampleEnsemble(ball, frequencies, fluxes, fluxes_err, burn + steps, rng)
+
+    samples = chain[burn:].reshape(-1, 3)
+    low, median, high = np.percentile(samples, [15.865, 50, 84.135], axis = 0)
+    best = samples[np.argmax(log_probabilities[burn:].ravel())]
+    scale_samples = 10**samples[:, 2]
+    scale_low, scale_median, scale_high = np.percentile(scale_samples, [15.865, 50, 84.135])
+
+    outputrow.extend([float(median[0]), float((high[0] - low[0]) / 2), float(median[1]), float((high[1] - low[1]) / 2),
+                      float(scale_median), float((scale_high - scale_low) / 2),
+                      float(-2 * log_probabilities[burn:].max()), detections])
+
+    if chain_directory != None:
+        os.makedirs(chain_directory, exist_ok = True)
+        np.savez_compressed(chainPath(chain_directory, label), chain = chain[burn::thin].astype(np.float32),
+                            log_probability = log_probabilities[burn::thin].astype(np.float32), thin = thin,
+                            parameters = PARAMETERS, percentiles = np.array([low, median, high]), best = best,
+                            acceptance = acceptance, frequencies = frequencies, fluxes = fluxes, fluxes_err = fluxes_err)
+
+    pars = [float(median[0]), float(median[1]), float(scale_median)]
+    plot = (str(label[0]) + ': ' + str(label[2]), frequencies, fluxes, fluxes_err, pars, frequencies.min(), frequencies.max())
+    return (outputrow, message, plot)
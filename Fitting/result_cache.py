@@ -0,0 +1,58 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+#On-disk cache of fit results, so a rerun only refits the rows whose inputs changed.
+#Each result is keyed by a hash of everything that goes into its fit (the fitRow arguments and the fit mode) and is
+#appended to a JSON lines file as soon as it is done. A run that crashes or is killed keeps every finished row, and
+#the next run picks up where it stopped. A partly written last line is ignored.
+
+#bump this when a change to the model or the fitting code changes the results, so old entries are not reused
+FIT_VERSION = 1
+
+#hash of the inputs of one fit: the arguments of fitRow / sampleRow and the fit mode
+def rowKey(job, mode):
+    digest = hashlib.sha1()
+    digest.update(repr((FIT_VERSION, mode, job[0], tuple(job[4]), job[5])).encode())
+    for values in job[1:4]:
+        digest.update(np.ascontiguousarray(values, dtype = float).tobytes())
+    return digest.hexdigest()
+
+class ResultCache:
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        if os.path.exists(path):
+            with open(path) as cache_file:
+                for line in cache_file:
+                    try:
+                        entry = json.loads(line)
+                        self.results[entry['key']] = (entry['row'], entry['message'])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        self._file = None
+
+    def __len__(self):
+        return len(self.results)
+
+    #(output row, message) of a cached fit, or None
+    def get(self, key):
+        return self.results.get(key)
+
+    #add a result and write it to disk straight away
+    def add(self, key, outputrow, message):
+        if self._file == None:
+            self._file = open(self.path, 'a+')
+            if self._file.tell() > 0:
+                self._file.seek(self._file.tell() - 1)
+                if self._file.read(1) != '\n': #finish a line cut off by a crash
+                    self._file.write('\n')
+        self.results[key] = (outputrow, message)
+        self._file.write(json.dumps({'key': key, 'row': outputrow, 'message': message}, default = float) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file != None:
+            self._file.close()
+            self._file = None
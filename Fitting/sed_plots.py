@@ -0,0 +1,86 @@
+from blackbody_kernel import modifiedBlackbody
+import numpy as np
+import multiprocessing
+import os
+import re
+
+#Headless rendering of the SED fit plots. Plots are drawn with the non-interactive Agg backend, so no window ever
+#opens, and are saved as PNG or PDF files. The plots of each galaxy are rendered by one worker process, which draws
+#every plot on the same figure and axes, clearing them in between, and can also collect the galaxy's plots into one
+#multi-page PDF summary.
+
+_figure = None
+_axes = None
+
+#the figure and axes of this process, created on first use
+def _canvas():
+    global _figure, _axes
+    if _figure == None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        _figure, _axes = plt.subplots(figsize = (6.4, 4.8))
+    return (_figure, _axes)
+
+#make a string safe to use in a file name
+def fileName(text):
+    return re.sub(r'[^\w.-]+', '_', text).strip('_')
+
+#draw one plot (see fitter.fitRow for the layout of the plot data) on the shared axes
+def drawPlot(plot):
+    figure, axes = _canvas()
+    title, frequencies, fluxes, fluxes_err, pars, minfreq, maxfreq = plot
+    t = np.arange(minfreq, maxfreq, minfreq * 0.01)
+    axes.clear()
+    axes.set_title(title)
+    axes.set_xlabel('Frequency (Hz)')
+    axes.set_ylabel('Flux (Jy)')
+    axes.errorbar(frequencies, fluxes, yerr = fluxes_err, fmt = 'ko')
+    axes.plot(t, modifiedBlackbody(t, pars[0], pars[1], pars[2]), 'r-')
+    return figure
+
+#render the plots of one galaxy. plots is a list of (file name, plot data) pairs. Writes one file per plot in the given
+#format ('png' or 'pdf'), and with summary a <galaxy>_seds.pdf holding all of them. Returns the list of files written.
+def renderGalaxy(galaxy, plots, directory, image_format = 'png', summary = True):
+    written = []
+    pages = None
+    if summary:
+        from matplotlib.backends.backend_pdf import PdfPages
+        path = os.path.join(directory, fileName(galaxy) + '_seds.pdf')
+        pages = PdfPages(path)
+        written.append(path)
+    try:
+        for name, plot in plots:
+            figure = drawPlot(plot)
+            if image_format != None:
+                path = os.path.join(directory, name + '.' + image_format)
+                figure.savefig(path, format = image_format)
+                written.append(path)
+            if pages != None:
+                pages.savefig(figure)
+    finally:
+        if pages != None:
+            pages.close()
+    return written
+
+#call renderGalaxy with a tuple of arguments, for pool.map
+def _renderJob(job):
+    return renderGalaxy(*job)
+
+#render every plot, grouped by galaxy, on a pool of worker processes. plots is a list of ((galaxy, aperture, ap_name),
+#plot data) pairs; entries with no plot data are skipped. Each plot is saved as <galaxy>_<aperture>_<ap_name>.
+#Returns the list of files written.
+def renderPlots(plots, directory, image_format = 'png', summary = True, workers = 1):
+    os.makedirs(directory, exist_ok = True)
+    galaxies = {}
+    for label, plot in plots:
+        if plot != None:
+            name = fileName(str(label[0]) + '_' + str(label[1]) + '_' + str(label[2]))
+            galaxies.setdefault(label[0], []).append((name, plot))
+    jobs = [(galaxy, galaxy_plots, directory, image_format, summary) for galaxy, galaxy_plots in galaxies.items()]
+    if workers == 1 or len(jobs) < 2:
+        results = [_renderJob(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+            results = pool.map(_renderJob, jobs)
+    return [path for paths in results for path in paths]
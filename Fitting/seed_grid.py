@@ -0,0 +1,103 @@
+from blackbody_kernel import modifiedBlackbody, micronsToHz
+import numpy as np
+import os
+
+try:
+    from profiling import timed #stage timers, when an entry point has put Photometry/ on the path
+except ImportError:
+    def timed(name = None):
+        return lambda function: function
+
+#Precomputed grid of modified blackbody fluxes over temperature and beta, in our bands (24 - 500 um).
+#For each row of the results spreadsheet, the grid point with the lowest chi square gives a starting point for the
+#fit, in place of the hand-written guesses, and can also be used on its own as a fast approximate fit.
+#The scale is not gridded: for a fixed temperature and beta the model is linear in the scale, so the best scale
+#and its chi square have a closed form. The grid is saved to seed_grid.npz and rebuilt if its definition changes.
+#Fluxes are evaluated at the band wavelengths, as in the fits, rather than integrated over filter curves.
+
+BANDS = [24, 70, 100, 160, 250, 350, 500] #um
+TEMPERATURES = np.arange(5., 100.25, 0.25) #K
+BETAS = np.arange(0., 4.05, 0.05)
+
+_grid_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seed_grid.npz')
+_grid = None
+
+#frequencies of the bands in Hz
+def bandFrequencies():
+    return micronsToHz(BANDS)
+
+#compute the grid. Returns (temperatures, betas, fluxes, norms), where fluxes[i, j] is the model for TEMPERATURES[i],
+#BETAS[j] and scale 1 in each band, divided by norms[i, j] to keep the numbers near 1.
+def buildGrid():
+    nu = bandFrequencies()
+    fluxes = modifiedBlackbody(nu[None, None, :], TEMPERATURES[:, None, None], BETAS[None, :, None], 1)
+    norms = fluxes.max(axis = 2)
+    return (TEMPERATURES, BETAS, fluxes / norms[:, :, None], norms)
+
+#load the grid from disk, building and saving it first if it is missing or was made for a different grid
+def loadGrid():
+    global _grid
+    if _grid != None:
+        return _grid
+    try:
+        with np.load(_grid_path) as saved:
+            grid = (saved['temperatures'], saved['betas'], saved['fluxes'], saved['norms'])
+            valid = (np.array_equal(saved['bands'], BANDS) and np.array_equal(grid[0], TEMPERATURES)
+                     and np.array_equal(grid[1], BETAS))
+    except (OSError, KeyError, ValueError):
+        valid = False
+    if not valid:
+        grid = buildGrid()
+        try:
+            np.savez(_grid_path, bands = BANDS, temperatures = grid[0], betas = grid[1], fluxes = grid[2], norms = grid[3])
+        except OSError:
+            pass #the grid still works, it just is not cached
+    _grid = grid
+    return grid
+
+#find the best grid point for every row at once.
+#fluxes and errors are (rows, bands) arrays in Jy; bands to leave out of a row (no data or no detection) have weight 0.
+#Returns (temperatures, betas, scales, chi squares), one per row. Rows with no usable bands get nan.
+#With stride > 1 only every stride-th temperature and beta is searched, for a quicker, coarser seed.
+@timed('seed_grid')
+def gridSeeds(fluxes, errors, use, chunk = 256, stride = 1):
+    temperatures, betas, grid_fluxes, norms = loadGrid()
+    temperatures, betas = temperatures[::stride], betas[::stride]
+    grid_fluxes, norms = grid_fluxes[::stride, ::stride], norms[::stride, ::stride]
+    models = grid_fluxes.reshape(-1, len(BANDS)) #(grid points, bands)
+    fluxes = np.where(use, fluxes, 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        weights = np.where(use, 1 / errors**2, 0)
+
+    count = len(fluxes)
+    best = np.zeros(count, dtype = int)
+    scales = np.full(count, np.nan)
+    chis = np.full(count, np.nan)
+    for start in range(0, count, chunk): #bound the (rows, grid points) arrays
+        stop = min(start + chunk, count)
+        w, f = weights[start:stop], fluxes[start:stop]
+        #chi square at the best scale s = sum(w f m) / sum(w m^2) is sum(w f^2) - sum(w f m)^2 / sum(w m^2)
+        cross = (w * f).dot(models.T)
+        power = w.dot((models**2).T)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            chi = (w * f**2).sum(axis = 1)[:, None] - cross**2 / power
+            chi[~(power > 0)] = np.inf
+            index = np.argmin(chi, axis = 1)
+            rows = np.arange(stop - start)
+            best[start:stop] = index
+            scales[start:stop] = cross[rows, index] / power[rows, index]
+            chis[start:stop] = chi[rows, index]
+
+    t_index, b_index = np.unravel_index(best, norms.shape)
+    empty = ~np.isfinite(chis)
+    seed_temperatures = np.where(empty, np.nan, temperatures[t_index])
+    seed_betas = np.where(empty, np.nan, betas[b_index])
+    seed_scales = scales / norms[t_index, b_index]
+    return (seed_temperatures, seed_betas, seed_scales, np.where(empty, np.nan, np.maximum(chis, 0)))
+
+if __name__ == '__main__':
+    #rebuild the cached grid
+    if os.path.exists(_grid_path):
+        os.remove(_grid_path)
+    temperatures, betas, fluxes, norms = loadGrid()
+    print('Saved a ' + str(len(temperatures)) + ' x ' + str(len(betas)) + ' grid to ' + _grid_path)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from blackbody_kernel import modifiedBlackbody, modifiedBlackbodyJacobian, micronsToHz
+
+#Regression tests of the modified blackbody kernel: the model against dust_emissivity's modified_blackbody, which the
+#fitter used before the kernel, and the analytic Jacobian against finite differences. Run with
+#    python -m pytest Fitting
+#The comparison with dust_emissivity is skipped when it (or astropy) is not installed.
+
+#the bands of the sample, from MIPS 24 to SPIRE 500 microns, and a few wavelengths around them
+WAVELENGTHS = [10, 24, 70, 100, 160, 250, 350, 500, 850, 1200]
+TEMPERATURES = [3., 5., 10., 20., 40., 80., 150.]
+BETAS = [0., 1., 1.75, 2.5, 4.]
+
+@pytest.mark.parametrize('temperature', TEMPERATURES)
+@pytest.mark.parametrize('beta', BETAS)
+def test_model_matches_dust_emissivity(temperature, beta):
+    u = pytest.importorskip('astropy.units')
+    blackbody = pytest.importorskip('dust_emissivity.blackbody')
+    nu = micronsToHz(WAVELENGTHS)
+    for scale in [1e-40, 1e-30]:
+        reference = blackbody.modified_blackbody(nu * u.Hz, temperature * u.K, beta, scale)
+        reference = np.array(reference.to(u.erg/u.s/u.cm**2/u.Hz/u.sr).value, dtype = float) * 10**23 #Jy / sr
+        model = modifiedBlackbody(nu, temperature, beta, scale)
+        nonzero = reference != 0
+        assert np.all(model[~nonzero] == 0)
+        np.testing.assert_allclose(model[nonzero], reference[nonzero], rtol = 1e-10)
+
+def test_frequencies_match_astropy():
+    u = pytest.importorskip('astropy.units')
+    expected = (np.array(WAVELENGTHS) * u.um).to(u.Hz, u.spectral()).value
+    np.testing.assert_allclose(micronsToHz(WAVELENGTHS), expected, rtol = 1e-14)
+
+@pytest.mark.parametrize('temperature', TEMPERATURES)
+@pytest.mark.parametrize('beta', BETAS)
+def test_jacobian_matches_finite_differences(temperature, beta):
+    nu = micronsToHz(WAVELENGTHS)
+    scale = 1e-40
+    jacobian = modifiedBlackbodyJacobian(nu, temperature, beta, scale)
+    steps = [temperature * 1e-6, 1e-6, scale * 1e-6]
+    for k in range(3):
+        low = [temperature, beta, scale]
+        high = [temperature, beta, scale]
+        low[k] -= steps[k]
+        high[k] += steps[k]
+        numeric = (modifiedBlackbody(nu, *high) - modifiedBlackbody(nu, *low)) / (2 * steps[k])
+        significant = np.abs(numeric) > 1e-300
+        np.testing.assert_allclose(jacobian[significant, k], numeric[significant], rtol = 1e-5)
+
+def test_model_broadcasts():
+    nu = micronsToHz(WAVELENGTHS)
+    temperatures = np.array(TEMPERATURES)[:, None, None]
+    betas = np.array(BETAS)[None, :, None]
+    grid = modifiedBlackbody(nu[None, None, :], temperatures, betas, 1e-40)
+    assert grid.shape == (len(TEMPERATURES), len(BETAS), len(WAVELENGTHS))
+    np.testing.assert_allclose(grid[2, 3], modifiedBlackbody(nu, TEMPERATURES[2], BETAS[3], 1e-40), rtol = 1e-15)
@@ -0,0 +1,93 @@
+from scipy import sparse
+import numpy as np
+
+try:
+    from profiling import timed #stage timers, when an entry point has put Photometry/ on the path
+except ImportError:
+    def timed(name = None):
+        return lambda function: function
+
+#HI masses straight from spectral cubes, without making a moment-0 map first. The aperture masks (mask stacks, see
+#Photometry/aperture_stack.py) are built once on the sky plane, and the cube is read a few channels at a time, only
+#inside the bounding box of the apertures. Each chunk of channels is multiplied by the masks in one sparse product,
+#so every aperture is integrated over the velocity window in a single pass while at most a chunk of planes of the
+#bounding box is in memory. With a memory-mapped file (see Photometry/fits_cache.py) the rest of the cube is never read.
+
+HI_REST_FREQUENCY = 1420405751.768 #Hz
+SPEED_OF_LIGHT = 299792.458 #km / s
+
+#velocity of every channel of a cube in km / s, from the spectral axis (axis 3) of its header.
+#Frequency axes are converted with the radio convention.
+def channelVelocities(header):
+    values = header['CRVAL3'] + (np.arange(header['NAXIS3']) + 1 - header['CRPIX3']) * header['CDELT3']
+    if str(header.get('CTYPE3', 'VELO')).upper().startswith('FREQ'):
+        rest = header.get('RESTFRQ', header.get('RESTFREQ', HI_REST_FREQUENCY))
+        return SPEED_OF_LIGHT * (1 - values / rest)
+    if str(header.get('CUNIT3', 'm/s')).strip().lower() == 'km/s':
+        return values
+    return values / 1000 #m / s
+
+#the channels with velocities between vmin and vmax (None for no limit), and the width of every channel in km / s.
+#Returns (first channel, last channel + 1, widths of the channels in between).
+def velocityWindow(velocities, vmin = None, vmax = None):
+    inside = np.ones(len(velocities), dtype = bool)
+    if vmin != None:
+        inside &= velocities >= vmin
+    if vmax != None:
+        inside &= velocities <= vmax
+    channels = np.nonzero(inside)[0]
+    if len(channels) == 0:
+        raise ValueError('No channels between ' + str(vmin) + ' and ' + str(vmax) + ' km/s')
+    widths = np.abs(np.gradient(velocities)) if len(velocities) > 1 else np.ones(1)
+    return (channels[0], channels[-1] + 1, widths[channels[0]:channels[-1] + 1])
+
+#the data of a cube as (channel, y, x), dropping degenerate leading axes such as a single Stokes axis
+def cubePlanes(data):
+    while data.ndim > 3 and data.shape[0] == 1:
+        data = data[0]
+    if data.ndim != 3:
+        raise ValueError('Not a spectral cube: data has shape ' + str(data.shape))
+    return data
+
+#the bounding box around the apertures of several mask stacks, and for each stack a sparse (pixels, apertures) matrix
+#of its weights on the flattened box
+def stackMatrices(stacks):
+    used = [stack for stack in stacks if len(stack[1]) > 0]
+    if len(used) == 0:
+        return ((0, 0, 0, 0), [sparse.csr_matrix((0, stack[3])) for stack in stacks])
+    ymin = min(stack[4][0] for stack in used)
+    ymax = max(stack[4][1] for stack in used)
+    xmin = min(stack[4][2] for stack in used)
+    xmax = max(stack[4][3] for stack in used)
+    size = (ymax - ymin) * (xmax - xmin)
+    matrices = []
+    for stack in stacks:
+        numbers, indices, weights, count, bounds = stack
+        width = bounds[3] - bounds[2]
+        if len(indices) == 0:
+            matrices.append(sparse.csr_matrix((size, count)))
+            continue
+        pixels = (indices // width + bounds[0] - ymin) * (xmax - xmin) + indices % width + bounds[2] - xmin
+        matrices.append(sparse.csr_matrix((weights, (pixels, numbers)), shape = (size, count)))
+    return ((ymin, ymax, xmin, xmax), matrices)
+
+#integrate the apertures of several mask stacks over channels start to stop of a cube, in chunks of channels.
+#widths are the channel widths in km / s, so the results are in the cube's units times km / s (Jy / beam km / s for a
+#cube in Jy / beam). Blank (nan) pixels count as zero. Like stackPhotometry, apertures that do not overlap the image get nan.
+#Returns one array of aperture sums per stack.
+@timed('hi_cube_integrate')
+def integrateStacks(data, stacks, start, stop, widths, chunk = 16):
+    data = cubePlanes(data)
+    bounds, matrices = stackMatrices(stacks)
+    ymin, ymax, xmin, xmax = bounds
+    totals = [np.zeros(stack[3]) for stack in stacks]
+    if ymax > ymin and xmax > xmin:
+        for first in range(start, stop, chunk):
+            last = min(first + chunk, stop)
+            planes = np.asarray(data[first:last, ymin:ymax, xmin:xmax], dtype = float).reshape(last - first, -1)
+            integrated = widths[first - start:last - start].dot(np.nan_to_num(planes)) #each channel times its width, added up
+            for total, matrix in zip(totals, matrices):
+                total += matrix.T.dot(integrated)
+    for total, stack in zip(totals, stacks):
+        total[np.bincount(stack[0], minlength = stack[3]) == 0] = np.nan
+    return totals
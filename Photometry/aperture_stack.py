@@ -0,0 +1,146 @@
+import numpy as np
+from profiling import timed
+
+#Measure many apertures at once. Instead of one aperture_photometry call (and one results table) per aperture,
+#the exact-overlap masks of all apertures are flattened into one list of (aperture number, pixel index, weight)
+#entries. The sums for every aperture then come from a single gather of the image and one np.bincount.
+#Only the bounding box around all of the apertures is read from the image, so with a memory-mapped file
+#(see fits_cache.py) the rest of the pixels never leave the disk.
+
+#build the mask stack of a list of apertures for an image of the given shape.
+#Returns a tuple (aperture numbers, pixel indices, weights, number of apertures, bounds).
+#bounds is (ymin, ymax, xmin, xmax), the pixel bounding box around all of the apertures, and the pixel indices
+#point into the flattened cutout of the image inside that box.
+#Apertures with several positions get one entry per position, in order.
+@timed('aperture_masks')
+def maskStack(apertures, shape):
+    pieces = []
+    count = 0
+    for aperture in apertures:
+        masks = aperture.to_mask(method = 'exact')
+        if not isinstance(masks, list): #newer photutils returns a single mask for a single position
+            masks = [masks]
+        for mask in masks:
+            bbox = mask.bbox
+            #clip the mask to the image
+            ymin, ymax = max(bbox.iymin, 0), min(bbox.iymax, shape[0])
+            xmin, xmax = max(bbox.ixmin, 0), min(bbox.ixmax, shape[1])
+            if ymin < ymax and xmin < xmax:
+                mask_data = mask.data[ymin - bbox.iymin:ymax - bbox.iymin, xmin - bbox.ixmin:xmax - bbox.ixmin]
+                y, x = np.nonzero(mask_data)
+                pieces.append((count, y + ymin, x + xmin, mask_data[y, x]))
+            count += 1
+
+    if len(pieces) == 0:
+        return (np.zeros(0, dtype = int), np.zeros(0, dtype = int), np.zeros(0), count, (0, 0, 0, 0))
+
+    #combined bounding box of all of the apertures
+    ymin = min(piece[1].min() for piece in pieces)
+    ymax = max(piece[1].max() for piece in pieces) + 1
+    xmin = min(piece[2].min() for piece in pieces)
+    xmax = max(piece[2].max() for piece in pieces) + 1
+    width = xmax - xmin
+
+    numbers = np.concatenate([np.full(len(piece[3]), piece[0]) for piece in pieces])
+    indices = np.concatenate([(piece[1] - ymin) * width + piece[2] - xmin for piece in pieces])
+    weights = np.concatenate([piece[3] for piece in pieces])
+    return (numbers, indices, weights, count, (ymin, ymax, xmin, xmax))
+
+#cut the bounding box of a mask stack out of an image. Works on arrays, memory maps and HDU sections.
+def cutout(stack, image_data):
+    ymin, ymax, xmin, xmax = stack[4]
+    return np.asarray(image_data[ymin:ymax, xmin:xmax])
+
+#turn the mask stack of nested apertures, sorted largest first, into the stack of the regions between them.
+#Region i (for i < count - 1) is the ring inside aperture i and outside aperture i + 1, region count - 1 is the
+#innermost aperture (the center) and region count is the whole of aperture 0 (the galaxy). Each pixel gets the net
+#weight of its part of each region, so at the boundaries the rings share pixels by their exact overlap, and one
+#stackPhotometry() call on the result measures every region at once.
+def ringStack(stack):
+    numbers, indices, weights, count, bounds = stack
+    if len(indices) == 0:
+        return (numbers, indices, weights, count + 1, bounds)
+    inner = numbers > 0
+    outer = numbers == 0
+    labels = np.concatenate([numbers, numbers[inner] - 1, np.full(np.count_nonzero(outer), count)])
+    pixels = np.concatenate([indices, indices[inner], indices[outer]])
+    signed = np.concatenate([weights, -weights[inner], weights[outer]])
+
+    #add up the entries of each region and pixel
+    size = int(indices.max()) + 1
+    keys, inverse = np.unique(labels * size + pixels, return_inverse = True)
+    net = np.bincount(inverse.ravel(), weights = signed)
+    keep = np.abs(net) > 1e-12
+    return (keys[keep] // size, keys[keep] % size, net[keep], count + 1, bounds)
+
+#measure every aperture of a mask stack. Returns (aperture sums, aperture errors) as arrays.
+#The errors are computed the way aperture_photometry does, sqrt(sum(error^2 * weight)), and are zero without an error image.
+#Like aperture_photometry, apertures that do not overlap the image get nan.
+@timed('aperture_photometry')
+def stackPhotometry(stack, value_data, error_data):
+    numbers, indices, weights, count, bounds = stack
+    values = np.take(cutout(stack, value_data), indices)
+    sums = np.bincount(numbers, weights = weights * values, minlength = count)
+    if error_data is None:
+        errors = np.zeros(count)
+    else:
+        variances = np.take(cutout(stack, error_data), indices)
+        variances = variances * variances
+        errors = np.sqrt(np.bincount(numbers, weights = np.abs(weights) * variances, minlength = count))
+    outside = np.bincount(numbers, minlength = count) == 0
+    sums[outside] = np.nan
+    errors[outside] = np.nan
+    return (sums, errors)
+
+#bounding box of a polygon mask, with the same attributes as the photutils BoundingBox
+class _BoundingBox:
+    def __init__(self, ixmin, ixmax, iymin, iymax):
+        self.ixmin = ixmin
+        self.ixmax = ixmax
+        self.iymin = iymin
+        self.iymax = iymax
+
+#mask of a polygon aperture, with the same attributes as the photutils ApertureMask
+class _PolygonMask:
+    def __init__(self, data, bbox):
+        self.data = data
+        self.bbox = bbox
+
+#a polygon aperture in pixel coordinates, for DS9 polygon regions. photutils has no polygon aperture, so this
+#provides what maskStack() needs. The pixel overlap is found by sampling each pixel on a subpixels x subpixels grid.
+class PolygonAperture:
+    def __init__(self, vertices, subpixels = 10):
+        self.vertices = np.asarray(vertices, dtype = float) #(n, 2) array of x, y pixel positions
+        self.subpixels = subpixels
+
+    #area in pixels (shoelace formula)
+    def area(self):
+        x, y = self.vertices[:, 0], self.vertices[:, 1]
+        return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+    #the method argument is accepted for compatibility with the photutils apertures
+    def to_mask(self, method = 'exact'):
+        ixmin = int(np.floor(self.vertices[:, 0].min() + 0.5))
+        ixmax = int(np.floor(self.vertices[:, 0].max() + 0.5)) + 1
+        iymin = int(np.floor(self.vertices[:, 1].min() + 0.5))
+        iymax = int(np.floor(self.vertices[:, 1].max() + 0.5)) + 1
+
+        #subpixel centers, with pixel i covering i - 0.5 to i + 0.5
+        offsets = (np.arange(self.subpixels) + 0.5) / self.subpixels - 0.5
+        x = (np.arange(ixmin, ixmax)[:, None] + offsets[None, :]).ravel()
+        y = (np.arange(iymin, iymax)[:, None] + offsets[None, :]).ravel()
+        x, y = np.meshgrid(x, y)
+
+        #even-odd rule: a point is inside if a ray from it crosses the edges an odd number of times
+        inside = np.zeros(x.shape, dtype = bool)
+        x1, y1 = self.vertices[:, 0], self.vertices[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        for i in range(len(x1)):
+            crosses = (y1[i] > y) != (y2[i] > y)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                x_cross = x1[i] + (y - y1[i]) * (x2[i] - x1[i]) / (y2[i] - y1[i])
+            inside ^= crosses & (x < x_cross)
+
+        shape = (iymax - iymin, self.subpixels, ixmax - ixmin, self.subpixels)
+        data = inside.reshape(shape).mean(axis = (1, 3))
+        return _PolygonMask(data, _BoundingBox(ixmin, ixmax, iymin, iymax))
@@ -0,0 +1,202 @@
+from astropy.io import fits
+from scipy import fft
+import numpy as np
+import argparse
+import hashlib
+import os
+import re
+from profiling import timed
+
+#Match the resolution of every band to a target beam, making the <galaxy>_<band>_convolved.fits and
+#<galaxy>_<band>_error_convolved.fits images that photometry_batch.py --convolved and map_fitter.py use.
+#The beams are taken as Gaussians with the FWHMs below, so the matching kernel is the Gaussian with
+#FWHM^2 = target^2 - source^2, normalized to a sum of 1 to keep the flux. Images are convolved with real FFTs on
+#several threads, and the kernel transforms are cached per (source band, target band, pixel scale, image size), so the
+#value and error maps of a band, and images on the same grid, share one transform.
+#Blank (nan) pixels are left out: the image is convolved with its blanks set to zero and divided by the convolved
+#coverage, and blank pixels stay blank. The error maps are propagated as sqrt(error^2 convolved with the kernel).
+#Convolved pixels are correlated with their neighbours, and the photometry adds pixel errors in quadrature as if they
+#were not; with this error map that quadrature sum over an aperture much larger than the kernel equals the error of
+#the same aperture on the original image, which is the error the flux really has. (The error of a single convolved
+#pixel, sqrt(error^2 convolved with kernel^2), would make every aperture error too small by the kernel's size.)
+#Every output records a signature of its input and settings, and is only remade when they change. Existing outputs
+#without a signature, such as the hand-made _convolved images of the sample, are kept unless --force is given.
+
+#beam FWHM in arcsec of each band: MIPS 24, PACS 70 / 100 / 160 and SPIRE 250 / 350 / 500 microns
+BEAMS = {24: 6.0, 70: 5.6, 100: 6.8, 160: 11.4, 250: 18.1, 350: 24.9, 500: 36.4}
+
+#bump this when a change to the convolution changes the outputs, so they are remade
+CONVOLUTION_VERSION = 1
+
+#matches the original images, <galaxy>_<band>.fits and <galaxy>_<band>_error.fits
+_input_pattern = re.compile(r'^(?P<galaxy>.+?)_(?P<band>\d+)(?P<error>_error)?\.fits$')
+
+_kernel_transforms = {}
+
+#the matching kernel from source_band to target_band on a grid with the given pixel scale (degrees / pixel), as an
+#odd-sized array that adds up to 1. Returns None if the source beam is not smaller than the target beam.
+def matchingKernel(source_band, target_band, scale):
+    fwhm2 = BEAMS[target_band]**2 - BEAMS[source_band]**2
+    if fwhm2 <= 0:
+        return None
+    sigma = np.sqrt(fwhm2) / 2.3548 / 3600 / scale #pixels
+    half = int(np.ceil(4 * sigma))
+    offsets = np.arange(-half, half + 1)
+    profile = np.exp(-offsets * offsets / (2 * sigma * sigma))
+    kernel = np.outer(profile, profile)
+    return kernel / kernel.sum()
+
+#shape to pad an image to for a linear (not circular) convolution with a kernel, rounded up to fast FFT sizes
+def paddedShape(image_shape, kernel_shape):
+    return tuple(fft.next_fast_len(size + kernel_size - 1, real = True) for size, kernel_size in zip(image_shape, kernel_shape))
+
+#real FFT of the matching kernel on a padded grid, cached per (source band, target band, pixel scale, padded shape).
+#Returns (kernel shape, kernel transform), or None if no convolution is needed.
+def kernelTransforms(source_band, target_band, scale, image_shape, workers = -1):
+    kernel = matchingKernel(source_band, target_band, scale)
+    if kernel is None:
+        return None
+    shape = paddedShape(image_shape, kernel.shape)
+    key = (source_band, target_band, round(scale, 12), shape)
+    if key not in _kernel_transforms:
+        _kernel_transforms[key] = (kernel.shape, fft.rfft2(kernel, shape, workers = workers))
+    return _kernel_transforms[key]
+
+#convolve an image with a kernel transform made by kernelTransforms, keeping the image size (the kernel is centered)
+def _convolve(image, kernel_shape, transform, shape, workers):
+    full = fft.irfft2(fft.rfft2(image, shape, workers = workers) * transform, shape, workers = workers)
+    top, left = kernel_shape[0] // 2, kernel_shape[1] // 2
+    return full[top:top + image.shape[0], left:left + image.shape[1]]
+
+#convolve a value image, and optionally its error image, from source_band to the beam of target_band.
+#Returns (values, errors); errors is None without an error image.
+@timed('convolve')
+def matchImages(value_data, error_data, source_band, target_band, scale, workers = -1):
+    transforms = kernelTransforms(source_band, target_band, scale, value_data.shape, workers)
+    if transforms is None:
+        raise ValueError('The ' + str(source_band) + ' micron beam is not smaller than the ' + str(target_band) + ' micron beam')
+    kernel_shape, transform = transforms
+    shape = paddedShape(value_data.shape, kernel_shape)
+
+    valid = np.isfinite(value_data)
+    coverage = _convolve(valid.astype(float), kernel_shape, transform, shape, workers)
+    coverage[coverage < 1e-6] = np.nan #too far from any data to say anything
+    values = _convolve(np.where(valid, value_data, 0), kernel_shape, transform, shape, workers) / coverage
+    values[~valid] = np.nan
+
+    errors = None
+    if error_data is not None:
+        variances = np.where(valid & np.isfinite(error_data), np.asarray(error_data, dtype = float)**2, 0)
+        errors = np.sqrt(np.clip(_convolve(variances, kernel_shape, transform, shape, workers), 0, None) / coverage)
+        errors[~valid] = np.nan
+    return (values, errors)
+
+#path of the convolved version of an image
+def convolvedPath(path):
+    return path[:-len('.fits')] + '_convolved.fits'
+
+#signature of an input file and the settings it is convolved with, stored in the output header
+def signature(path, target_band, level):
+    status = os.stat(path)
+    text = repr((CONVOLUTION_VERSION, os.path.basename(path), status.st_size, status.st_mtime, target_band, level, sorted(BEAMS.items())))
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+#state of the convolved image of path: 'missing', 'current' if it was made from the same input and settings, 'stale' if
+#it was made by this script from another input or settings (or cannot be read), or 'foreign' if it has no signature,
+#like the hand-made _convolved images of the sample, which are only replaced with force
+def outputState(path, target_band, level):
+    output_path = convolvedPath(path)
+    if not os.path.exists(output_path):
+        return 'missing'
+    try:
+        with fits.open(output_path) as output:
+            header = output[level].header
+            if 'CONVSIG' not in header:
+                return 'foreign'
+            return 'current' if header['CONVSIG'] == signature(path, target_band, level) else 'stale'
+    except (OSError, IndexError):
+        return 'stale'
+
+#write a convolved image next to its input, with the same HDUs and headers and the data of one level replaced
+def writeConvolved(path, level, data, source_band, target_band):
+    with fits.open(path) as original:
+        hdus = fits.HDUList([hdu.copy() for hdu in original])
+    hdus[level].data = data.astype(np.float32)
+    header = hdus[level].header
+    header['CONVBEAM'] = (BEAMS[target_band], 'FWHM in arcsec of the beam matched to')
+    header['CONVBAND'] = (target_band, 'band in microns of the beam matched to')
+    header['CONVSIG'] = (signature(path, target_band, level), 'signature of the input and settings')
+    header.add_history('Convolved from the ' + str(source_band) + ' to the ' + str(target_band) + ' micron beam with a Gaussian kernel')
+    hdus.writeto(convolvedPath(path), overwrite = True)
+
+#find the images to convolve under root, laid out like 'FITS Files/' (one directory per galaxy).
+#Returns a list of (galaxy, band, image path, error path or None) for the bands with a smaller beam than target_band.
+def findImages(root, target_band):
+    images = []
+    for galaxy in sorted(os.listdir(root)):
+        directory = os.path.join(root, galaxy)
+        if not os.path.isdir(directory):
+            continue
+        values = {}
+        errors = {}
+        for name in sorted(os.listdir(directory)):
+            match = _input_pattern.match(name)
+            if match == None or match.group('galaxy') != galaxy:
+                continue
+            band = int(match.group('band'))
+            if match.group('error') != None:
+                errors[band] = os.path.join(directory, name)
+            else:
+                values[band] = os.path.join(directory, name)
+        for band in sorted(values):
+            if band in BEAMS and BEAMS[band] < BEAMS[target_band]:
+                images.append((galaxy, band, values[band], errors.get(band)))
+    return images
+
+#convolve one band of a galaxy, unless its outputs are up to date. Outputs not made by this script are kept unless
+#force is given. Returns 'convolved', 'up to date' or 'kept'.
+def convolveBand(image_path, error_path, band, target_band, level = 1, workers = -1, force = False):
+    paths = [image_path] + ([error_path] if error_path != None else [])
+    if not force:
+        states = [outputState(path, target_band, level) for path in paths]
+        if 'foreign' in states:
+            return 'kept'
+        if all(state == 'current' for state in states):
+            return 'up to date'
+    with fits.open(image_path, memmap = True) as image:
+        value_data = np.asarray(image[level].data, dtype = float)
+        scale = abs(image[level].header['CDELT1'])
+    error_data = None
+    if error_path != None:
+        with fits.open(error_path, memmap = True) as error_image:
+            error_data = np.asarray(error_image[level].data, dtype = float)
+    values, errors = matchImages(value_data, error_data, band, target_band, scale, workers)
+    writeConvolved(image_path, level, values, band, target_band)
+    if error_path != None:
+        writeConvolved(error_path, level, errors, band, target_band)
+    return 'convolved'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Convolve every band to the beam of a target band, writing the _convolved images.')
+    parser.add_argument('root', nargs = '?', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FITS Files'),
+                        help = 'directory holding one directory per galaxy (default: FITS Files)')
+    parser.add_argument('--target', type = int, default = 350, choices = sorted(BEAMS), help = 'band in microns whose beam to match (default: 350)')
+    parser.add_argument('--level', type = int, default = 1, help = 'level of the FITS files to convolve')
+    parser.add_argument('--workers', type = int, default = -1, help = 'FFT threads (default: one per core)')
+    parser.add_argument('--force', action = 'store_true', help = 'remake the outputs even if their inputs have not changed')
+    args = parser.parse_args()
+
+    made = 0
+    kept = 0
+    images = findImages(args.root, args.target)
+    for galaxy, band, image_path, error_path in images:
+        state = convolveBand(image_path, error_path, band, args.target, args.level, args.workers, args.force)
+        if state == 'kept':
+            print(galaxy + ' ' + str(band) + ': kept, the existing _convolved images were not made by this script')
+            kept += 1
+        else:
+            print(galaxy + ' ' + str(band) + ': ' + state)
+            made += state == 'convolved'
+    print('\nConvolved ' + str(made) + ' of ' + str(len(images)) + ' images to the ' + str(args.target) + ' micron beam')
+    if kept > 0:
+        print('Kept the existing _convolved images of ' + str(kept) + ' bands, which were not made by this script; use --force to replace them')
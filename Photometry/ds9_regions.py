@@ -0,0 +1,220 @@
+import numpy as np
+import os
+import re
+from profiling import timed
+
+#Parser for DS9 region files. Handles circle, ellipse, box, annulus and polygon regions in fk5/icrs/j2000
+#(sexagesimal or degrees) or image/physical coordinates, with attributes such as color and tag in any order.
+#The regions of a file are kept in a RegionSet of NumPy arrays, and parsed files are cached by modification time.
+
+SHAPES = ['circle', 'ellipse', 'box', 'annulus', 'polygon']
+SKY_SYSTEMS = ['fk5', 'icrs', 'j2000']
+PIXEL_SYSTEMS = ['image', 'physical']
+
+_shape_pattern = re.compile(r'^([+-]?)\s*(' + '|'.join(SHAPES) + r')\s*\((.*)\)\s*$')
+_attribute_pattern = re.compile(r'(\w+)\s*=\s*(\{[^}]*\}|"[^"]*"|\'[^\']*\'|[^\s]+)')
+_degrees_pattern = re.compile(r'^[+-]?[\d.]+(?:[eE][+-]?\d+)?d?$')
+_size_pattern = re.compile(r'^([+-]?[\d.]+(?:[eE][+-]?\d+)?)(["\'dpi]?)$')
+
+#hex colors that DS9 writes for its named colors
+_color_names = {'#ff0000': 'red', '#f00': 'red', '#00ff00': 'green', '#0f0': 'green'}
+
+#the regions of one file, stored as arrays with one entry per region
+class RegionSet:
+    def __init__(self, shapes, x, y, sizes, angles, sky, include, colors, tags, vertex_offsets, vertices):
+        self.shapes = shapes #index into SHAPES
+        self.x = x #RA in degrees for sky regions, x pixel (1-based, as in DS9) for image regions
+        self.y = y #declination in degrees for sky regions, y pixel for image regions
+        self.sizes = sizes #(n, 2) array: radius / both radii / width and height / inner and outer radius, in arcsec or pixels
+        self.angles = angles #rotation angle in degrees
+        self.sky = sky #True if the region is in sky coordinates, False if it is in image coordinates
+        self.include = include #False for excluded regions (written with a leading '-')
+        self.colors = colors #list of color names
+        self.tags = tags #list of tuples of tag names
+        self.vertex_offsets = vertex_offsets #polygon i has the vertices vertices[vertex_offsets[i]:vertex_offsets[i + 1]]
+        self.vertices = vertices #(m, 2) array of polygon vertices, in the same coordinates as x and y
+        self._pixels = {} #pixel positions and sizes, per image WCS
+
+    def __len__(self):
+        return len(self.shapes)
+
+    #name of the shape of region i
+    def shape(self, i):
+        return SHAPES[self.shapes[i]]
+
+    #vertices of region i, empty unless it is a polygon
+    def polygon(self, i):
+        return self.vertices[self.vertex_offsets[i]:self.vertex_offsets[i + 1]]
+
+    #True for the regions that mark the galaxy itself (red), False for background regions
+    def galaxy(self):
+        return np.array([color == 'red' for color in self.colors], dtype = bool)
+
+    #convert every region to 0-based pixel coordinates on an image with the given WCS and pixel scale (degrees / pixel).
+    #Returns (x, y, sizes, vertices) arrays laid out like the attributes of the same names.
+    #All sky positions, including polygon vertices, go through a single all_world2pix call, and the result is
+    #cached for each WCS, so measuring several images that share a WCS only converts the regions once.
+    @timed('wcs_convert')
+    def toPixels(self, coord_info, scale):
+        key = (id(coord_info), scale)
+        if key in self._pixels and self._pixels[key][0] is coord_info:
+            return self._pixels[key][1]
+
+        #image regions only need shifting from DS9's 1-based pixels
+        x, y = self.x - 1, self.y - 1
+        sizes = self.sizes.copy()
+        vertices = self.vertices - 1
+        vertex_sky = np.repeat(self.sky, np.diff(self.vertex_offsets))
+
+        #convert all sky positions and polygon vertices in one call
+        ra = np.concatenate([self.x[self.sky], self.vertices[vertex_sky, 0]])
+        dec = np.concatenate([self.y[self.sky], self.vertices[vertex_sky, 1]])
+        if len(ra) > 0:
+            pixel_x, pixel_y = coord_info.all_world2pix(ra, dec, 0)
+            count = np.count_nonzero(self.sky)
+            x[self.sky], y[self.sky] = pixel_x[:count], pixel_y[:count]
+            vertices[vertex_sky, 0], vertices[vertex_sky, 1] = pixel_x[count:], pixel_y[count:]
+        sizes[self.sky] = sizes[self.sky] / 3600 / scale #arcsec to pixels
+
+        pixels = (x, y, sizes, vertices)
+        self._pixels[key] = (coord_info, pixels)
+        return pixels
+
+#convert a sexagesimal ('11:53:59.065', '-7:32:24.10', '11h53m59.065s', '+60d41m01s') or decimal ('178.496', '178.496d')
+#coordinate to degrees
+def parseCoordinate(text, ra):
+    text = text.strip()
+    if _degrees_pattern.match(text):
+        return float(text.rstrip('d'))
+    negative = text.startswith('-')
+    parts = [float(part) for part in re.split(r'[:hdms]', text.lstrip('+-')) if part != '']
+    if len(parts) == 0 or len(parts) > 3:
+        raise ValueError('Invalid coordinate: ' + text)
+    while len(parts) < 3:
+        parts.append(0)
+    value = parts[0] + parts[1] / 60 + parts[2] / 3600
+    if ra:
+        value = value * 15 #hours to degrees
+    if negative:
+        value = -value
+    return value
+
+#convert a size to arcsec for sky regions or pixels for image regions
+def parseSize(text, sky):
+    match = _size_pattern.match(text.strip())
+    if match == None:
+        raise ValueError('Invalid size: ' + text)
+    value, unit = float(match.group(1)), match.group(2)
+    if not sky:
+        if unit not in ['', 'p', 'i']:
+            raise ValueError('Sky size in an image region: ' + text)
+        return value
+    if unit == '"':
+        return value
+    elif unit == '\'':
+        return value * 60
+    elif unit == 'd' or unit == '':
+        return value * 3600 #plain numbers are degrees in sky systems
+    raise ValueError('Pixel size in a sky region: ' + text)
+
+#parse the attributes of a region comment (' color=red tag={ring} width=2') into a dictionary.
+#Tags can be repeated, so they are returned as a list.
+def parseAttributes(text):
+    attributes = {'tag': []}
+    for key, value in _attribute_pattern.findall(text):
+        value = value.strip('{}"\'')
+        if key == 'tag':
+            attributes['tag'].append(value)
+        else:
+            attributes[key] = value
+    return attributes
+
+#parse the lines of a region file into a RegionSet
+@timed('region_parse')
+def parseRegions(lines):
+    shapes, xs, ys, sizes, angles, sky_flags, include_flags, colors, tags = [], [], [], [], [], [], [], [], []
+    vertex_offsets = [0]
+    vertices = []
+    default_color = 'green' #DS9 default, overridden by a 'global' line
+    system = 'fk5'
+
+    def add(shape, x, y, size, angle, include, attributes, polygon_vertices = []):
+        shapes.append(SHAPES.index(shape))
+        xs.append(x)
+        ys.append(y)
+        sizes.append(size)
+        angles.append(angle)
+        sky_flags.append(system in SKY_SYSTEMS)
+        include_flags.append(include)
+        color = attributes.get('color', default_color).lower()
+        colors.append(_color_names.get(color, color))
+        tags.append(tuple(attributes['tag']))
+        vertices.extend(polygon_vertices)
+        vertex_offsets.append(len(vertices))
+
+    for number, line in enumerate(lines):
+        body, hash_mark, comment = line.partition('#')
+        if body.strip().startswith('global'):
+            default_color = parseAttributes(body).get('color', default_color)
+            continue
+        attributes = parseAttributes(comment)
+        for piece in body.split(';'):
+            piece = piece.strip()
+            if piece == '':
+                continue
+            if piece.lower() in SKY_SYSTEMS or piece.lower() in PIXEL_SYSTEMS:
+                system = piece.lower()
+                continue
+            match = _shape_pattern.match(piece)
+            if match == None:
+                if re.match(r'^[a-z]+$', piece.lower()): #another coordinate system
+                    raise ValueError('Unsupported coordinate system on line ' + str(number + 1) + ': ' + piece)
+                continue #text, points and other regions that are not apertures
+            include = match.group(1) != '-'
+            shape = match.group(2)
+            sky = system in SKY_SYSTEMS
+            arguments = [argument for argument in re.split(r'[,\s]+', match.group(3).strip()) if argument != '']
+            try:
+                if shape == 'polygon':
+                    points = [(parseCoordinate(arguments[i], True) if sky else float(arguments[i]),
+                               parseCoordinate(arguments[i + 1], False) if sky else float(arguments[i + 1]))
+                              for i in range(0, len(arguments) - 1, 2)]
+                    if len(points) < 3:
+                        raise ValueError('A polygon needs at least three vertices')
+                    center = np.mean(points, axis = 0)
+                    add(shape, center[0], center[1], [np.nan, np.nan], 0, include, attributes, points)
+                    continue
+                x = parseCoordinate(arguments[0], True) if sky else float(arguments[0])
+                y = parseCoordinate(arguments[1], False) if sky else float(arguments[1])
+                if shape == 'circle':
+                    add(shape, x, y, [parseSize(arguments[2], sky), np.nan], 0, include, attributes)
+                elif shape == 'ellipse' or shape == 'box':
+                    if len(arguments) != 5:
+                        raise ValueError('Only single ' + shape + ' regions are supported')
+                    add(shape, x, y, [parseSize(arguments[2], sky), parseSize(arguments[3], sky)], float(arguments[4]), include, attributes)
+                else: #an annulus with n radii is n - 1 nested annuli
+                    radii = [parseSize(argument, sky) for argument in arguments[2:]]
+                    if len(radii) < 2:
+                        raise ValueError('An annulus needs at least two radii')
+                    for inner, outer in zip(radii[:-1], radii[1:]):
+                        add(shape, x, y, [inner, outer], 0, include, attributes)
+            except (IndexError, ValueError) as error:
+                raise ValueError('Could not parse line ' + str(number + 1) + ': ' + line.strip() + ' (' + str(error) + ')')
+
+    return RegionSet(np.array(shapes, dtype = int), np.array(xs, dtype = float), np.array(ys, dtype = float),
+                     np.array(sizes, dtype = float).reshape(-1, 2), np.array(angles, dtype = float),
+                     np.array(sky_flags, dtype = bool), np.array(include_flags, dtype = bool), colors, tags,
+                     np.array(vertex_offsets, dtype = int), np.array(vertices, dtype = float).reshape(-1, 2))
+
+_parsed_files = {}
+
+#read and parse a region file, reusing the parsed regions if the file has not changed since it was last read
+def readRegions(path):
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    if path in _parsed_files and _parsed_files[path][0] == mtime:
+        return _parsed_files[path][1]
+    with open(path) as regions_file:
+        regions = parseRegions(regions_file.readlines())
+    _parsed_files[path] = (mtime, regions)
+    return regions
@@ -0,0 +1,83 @@
+from astropy.io import fits    #handle fits files
+from astropy import wcs    #world coordinate system transformations
+from collections import OrderedDict
+import os
+from profiling import timed
+
+#Shared access to FITS files. Files are opened memory-mapped with lazy HDU loading, so only the level that is
+#asked for is read, and only the pixels that are touched are paged in. Open files and parsed WCS objects are kept
+#in least-recently-used caches, so measuring the same image against several region files costs no extra I/O.
+#Cache entries are keyed by path and modification time, so a file that changes on disk is opened again.
+
+_cache_size = 16 #maximum number of open files, and of parsed WCS objects, to keep
+_open_files = OrderedDict()
+_wcs_objects = OrderedDict()
+
+#key identifying a version of a file on disk
+def _fileKey(path):
+    path = os.path.abspath(path)
+    return (path, os.path.getmtime(path))
+
+#drop the least recently used entries until the cache fits its size limit
+def _trim(cache, close):
+    while len(cache) > _cache_size:
+        key, value = cache.popitem(last = False)
+        if close:
+            value.close()
+
+#change the number of open files and WCS objects that are kept
+def setCacheSize(size):
+    global _cache_size
+    _cache_size = max(int(size), 1)
+    _trim(_open_files, True)
+    _trim(_wcs_objects, False)
+
+#open a FITS file, or return it from the cache if it is already open.
+#Raises the same errors as fits.open (FileNotFoundError, OSError, ...).
+@timed('fits_open')
+def openFits(path):
+    key = _fileKey(path)
+    if key in _open_files:
+        _open_files.move_to_end(key)
+        return _open_files[key]
+    hdus = fits.open(key[0], memmap = True, lazy_load_hdus = True)
+    _open_files[key] = hdus
+    _trim(_open_files, True)
+    return hdus
+
+#get the header of one level of a FITS file
+def getHeader(path, level):
+    return openFits(path)[level].header
+
+#get the data of one level of a FITS file. The array is memory-mapped where the file allows it.
+@timed('fits_read')
+def getData(path, level):
+    return openFits(path)[level].data
+
+#get the WCS of one level of a FITS file, parsing the header only the first time
+@timed('wcs_build')
+def getWcs(path, level):
+    key = _fileKey(path) + (level,)
+    if key in _wcs_objects:
+        _wcs_objects.move_to_end(key)
+        return _wcs_objects[key]
+    coord_info = wcs.WCS(getHeader(path, level))
+    _wcs_objects[key] = coord_info
+    _trim(_wcs_objects, False)
+    return coord_info
+
+#check whether an image is SPIRE data in MJy / sr rather than PACS data in Jy / pix, from the BUNIT of its header, or
+#from its band in microns without one. Raises ValueError if the header has no BUNIT and no band is given.
+def isSpire(header, band = None):
+    if 'BUNIT' in header:
+        return 'sr' in str(header['BUNIT']).lower()
+    if band == None:
+        raise ValueError('The image has no BUNIT, so its band is needed to tell SPIRE data from PACS data')
+    return band >= 250
+
+#close every cached file and forget every cached WCS
+def closeAll():
+    while len(_open_files) > 0:
+        key, hdus = _open_files.popitem()
+        hdus.close()
+    _wcs_objects.clear()
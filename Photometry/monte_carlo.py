@@ -0,0 +1,101 @@
+from aperture_stack import maskStack, stackPhotometry, cutout
+import numpy as np
+from profiling import timed
+
+#Monte-Carlo error propagation for region photometry. Each realisation redraws
+#    the image noise: the sums of all galaxy and background apertures, drawn together from their covariance, which
+#        comes from the error map. Nested apertures share pixels, so their noise is correlated, and the
+#        differences between them ('Next Region') get the right error;
+#    the sky level: a bootstrap resample of the background apertures, or for a sky estimated from their pixels
+#        (the clipped mean or median of sky.py) a normal draw about that estimate with its error;
+#    the calibration: one factor per realisation, shared by every aperture of the image;
+#    any further factor, such as the distance in the HI mass.
+#Since aperture sums are linear in the pixels, drawing them from their covariance is the same as drawing a noise
+#image and measuring it, without touching a pixel per realisation. Realisations are made in chunks, so 10^4 or more
+#per galaxy take a fraction of a second. Errors are half of the 16th - 84th percentile range.
+
+#covariance of the sums of the apertures of a mask stack, from an error map: cov[i, j] = sum(w_i * w_j * error^2)
+def apertureCovariance(stack, error_data):
+    numbers, indices, weights, count, bounds = stack
+    covariance = np.zeros((count, count))
+    if error_data is None or len(indices) == 0:
+        return covariance
+    variances = np.take(cutout(stack, error_data), indices)
+    variances = variances * variances
+    size = int(indices.max()) + 1
+    for i in range(count):
+        own = numbers == i
+        weighted = np.bincount(indices[own], weights = weights[own] * variances[own], minlength = size) #w_i * error^2 per pixel
+        covariance[i] = np.bincount(numbers, weights = weights * weighted[indices], minlength = count)
+    return np.nan_to_num(covariance)
+
+#matrix L with L L^T = covariance, which also works for singular covariances (identical apertures, no error map)
+def _covarianceRoot(covariance):
+    values, vectors = np.linalg.eigh(covariance)
+    return vectors * np.sqrt(np.clip(values, 0, None))
+
+#names of the regions made from a number of nested apertures, as in photometry_regions.ringPhotometry
+def regionNames(count):
+    return ['Galaxy'] + ['Next Region'] * (count - 1) + ['Center']
+
+#region values from the values of nested apertures sorted largest first (last axis): the whole galaxy, each
+#difference between neighbouring apertures, and the center
+def nestedRegions(values):
+    return np.concatenate([values[..., :1], values[..., :-1] - values[..., 1:], values[..., -1:]], axis = -1)
+
+#draw realisations of the region fluxes, in chunks. galaxy_apertures must be sorted largest first.
+#multiplier converts image units to flux. Yields (noise, total) arrays shaped (chunk, regions): noise has the image
+#noise and sky, total also has the calibration (error_cal, a fraction) and factor(rng, n), if given.
+#sky is None to bootstrap the background apertures, or the (level, error) per pixel of a sky estimated beforehand
+#(see skyEstimate in sky.py), which is then drawn about its level and the background apertures are not needed.
+def drawRegions(value_data, error_data, galaxy_apertures, background_apertures, multiplier, error_cal,
+                draws = 10000, chunk = 1000, rng = None, factor = None, sky = None):
+    if rng == None:
+        rng = np.random.default_rng()
+    if sky != None:
+        background_apertures = []
+    apertures = list(galaxy_apertures) + list(background_apertures)
+    stack = maskStack(apertures, value_data.shape)
+    sums = stackPhotometry(stack, value_data, None)[0]
+    root = _covarianceRoot(apertureCovariance(stack, error_data))
+    areas = np.array([aperture.area() for aperture in apertures])
+    count = len(galaxy_apertures)
+    background_count = len(background_apertures)
+
+    for start in range(0, draws, chunk):
+        n = min(chunk, draws - start)
+        drawn = sums[None, :] + rng.standard_normal((n, len(apertures))).dot(root.T)
+        if sky != None:
+            sky_draws = sky[0] + sky[1] * rng.standard_normal(n)
+        elif background_count > 0:
+            per_pixel = drawn[:, count:] / areas[count:]
+            picks = rng.integers(0, background_count, (n, background_count))
+            sky_draws = np.take_along_axis(per_pixel, picks, axis = 1).mean(axis = 1)
+        else:
+            sky_draws = np.zeros(n)
+        noise = nestedRegions((drawn[:, :count] - sky_draws[:, None] * areas[None, :count]) * multiplier)
+        scaling = 1 + error_cal * rng.standard_normal(n)
+        if factor != None:
+            scaling = scaling * factor(rng, n)
+        yield (noise, noise * scaling[:, None])
+
+#Monte-Carlo errors of the regions of nested apertures. Takes the same apertures as drawRegions, and nominal, the
+#region values without any noise, so the results line up with the analytic ones, and the sky of drawRegions.
+#Returns (regions, percentiles): regions is a list of (region name, value, noise error, total error) tuples like
+#ringPhotometry gives, and percentiles is a (regions, 3) array of the 16th, 50th and 84th percentiles of the total.
+@timed('monte_carlo')
+def monteCarloRegions(value_data, error_data, galaxy_apertures, background_apertures, multiplier, error_cal, nominal,
+                      draws = 10000, chunk = 1000, seed = None, factor = None, sky = None):
+    rng = np.random.default_rng(seed)
+    noise_draws = []
+    total_draws = []
+    for noise, total in drawRegions(value_data, error_data, galaxy_apertures, background_apertures, multiplier, error_cal,
+                                    draws, chunk, rng, factor, sky):
+        noise_draws.append(noise)
+        total_draws.append(total)
+    noise_percentiles = np.percentile(np.concatenate(noise_draws), [15.865, 50, 84.135], axis = 0).T
+    percentiles = np.percentile(np.concatenate(total_draws), [15.865, 50, 84.135], axis = 0).T
+    regions = []
+    for name, value, noise_range, total_range in zip(regionNames(len(galaxy_apertures)), nominal, noise_percentiles, percentiles):
+        regions.append((name, value, (noise_range[2] - noise_range[0]) / 2, (total_range[2] - total_range[0]) / 2))
+    return (regions, percentiles)
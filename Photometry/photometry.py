@@ -1,11 +1,18 @@
-from astropy.io import fits    #handle fits files
-from astropy import wcs    #world coordinate system transformations
 from photutils import CircularAperture
 from photutils import EllipticalAperture
 from photutils import aperture_photometry
-import numpy as np
-import xlrd
 import math
+from fits_cache import openFits, getWcs, closeAll
+from photometry_regions import fluxUnits
+from results_store import StoreWriter, configHash, DEFAULT_STORE
+from profiling import timed
+
+#convert RA/declination from "time"/"arctime" split into three numbers to degrees
+def positionToDegrees(a, b, c, ra):
+    if ra: #perform RA conversion if RA is true
+        return(a * 15 + b * 0.25 + c / 240)
+    else: #otherwise, perform declination conversion
+        return(a + b /60 + c / 3600)
 
 #convert RA/declination from "time"/"arctime" to degrees
 def positionStringtoInt(input_string, ra):
@@ -23,18 +30,14 @@ def positionStringtoInt(input_string, ra):
             input_string = str(input('Invalid number. Try again: '))
             str_split = input_string.split(' ')
 
-    int_split = [a, b, c]
-
-    if ra: #perform RA conversion if RA is true
-        return(int_split[0] * 15 + int_split[1] * 0.25 + int_split[2] / 240)
-    else: #otherwise, perform declination conversion
-        return(int_split[0] + int_split[1] /60 + int_split[2] / 3600)
+    return positionToDegrees(a, b, c, ra)
 
 #convert arcsec to number of pixels
 def arcsecToPix(arcsec, scale):
     return arcsec / 3600 / scale
 
 #perform photometry on a circular aperture. Returns tuple in the form (x position, y position, aperture sum, error)
+@timed('aperture_photometry')
 def circularPhotometry(value_data, error_data, coord_info, scale, ra, dec, radius):
     # convert to pixels
     x, y = coord_info.all_world2pix(ra, dec, 0)
@@ -52,6 +55,7 @@ def circularPhotometry(value_data, error_data, coord_info, scale, ra, dec, radiu
         return (results[1], results[2], results[3], results[4])
 
 
+@timed('aperture_photometry')
 def ellipticalPhotometry(value_data, error_data, coord_info, scale, ra, dec, semimajor, semiminor, angle):
     # convert to pixels
     x, y = coord_info.all_world2pix(ra, dec, 0)
@@ -69,86 +73,127 @@ def ellipticalPhotometry(value_data, error_data, coord_info, scale, ra, dec, sem
     else:
         return (results[1], results[2], results[3], results[4])
 
-#get file paths and load the files
-print('Enter the file path of the FITS image.')
-values_path = str(input('Image File Path: '))
-while True:
-    try:
-        fits_values = fits.open(values_path)
-        break
-    except ValueError:
-        values_path = str(input('Invalid input. Try again: '))
-    except FileNotFoundError:
-        values_path = str(input('File not found. Try again: '))
-    except OSError:
-        values_path = str(input('Invalid file. Try again: '))
-
-print('Enter the file path of the FITS image error. Enter \'s\' to skip using an error file.')
-errors_path = str(input('Error File Path: '))
-while True:
-    try:
-        if errors_path == 's':
-            fits_errors = None
-            break
-        else:
-            fits_errors = fits.open(errors_path)
-            break
-    except ValueError:
-        errors_path = str(input('Invalid input. Try again: '))
-    except FileNotFoundError:
-        errors_path = str(input('File not found. Try again: '))
-    except OSError:
-        errors_path = str(input('Invalid file. Try again: '))
-
-#get right ascension and declination
-ra_in = str(input('Enter right ascension of the object in the format \'hour min sec\': '))
-ra = positionStringtoInt(ra_in, True)
-
-dec_in = str(input('Enter declination of the object in the format \'deg arcmin arcsec\': '))
-dec = positionStringtoInt(dec_in, False)
-
-#get aperture type
-print('Would you like to use a circular or elliptical aperture?')
-aperture_type = ' '
-while (aperture_type != 'circular' and aperture_type != 'elliptical'):
-    aperture_type = str(input('Enter \'circular\' or \'elliptical\': '))
-
-#load image headers
-values_hdr = fits_values[1].header
-pix_scale = abs(values_hdr['CDELT1'])
-
-#parse WCS info from headers
-values_wcs = wcs.WCS(values_hdr)
-
-#retrieve data from the fits files
-value_data = fits_values[1].data
-
-if errors_path == 's':
-    error_data = None
-else:
-    error_data = fits_errors[1].data
-
-#get the necessary information for the selected aperture
-if aperture_type == 'circular':
+#perform photometry on a circular aperture (radius in arcseconds) or, with radius None, an elliptical aperture (axes in
+#arcseconds, angle in radians). Returns (photometry results like circularPhotometry(), pixels in the aperture, settings).
+def measureAperture(value_data, error_data, coord_info, scale, ra, dec, radius = None, semimajor = None, semiminor = None, angle = 0):
+    if radius != None:
+        photometry_results = circularPhotometry(value_data, error_data, coord_info, scale, ra, dec, radius)
+        pixels = math.pi * arcsecToPix(radius, scale)**2
+        settings = {'aperture': 'circular', 'ra': ra, 'dec': dec, 'radius': radius}
+    else:
+        photometry_results = ellipticalPhotometry(value_data, error_data, coord_info, scale, ra, dec, semimajor, semiminor, angle)
+        pixels = math.pi * arcsecToPix(semimajor, scale) * arcsecToPix(semiminor, scale)
+        settings = {'aperture': 'elliptical', 'ra': ra, 'dec': dec, 'semimajor': semimajor, 'semiminor': semiminor, 'angle': angle}
+    return (photometry_results, pixels, settings)
+
+#save the aperture sum given by measureAperture() to the results store, where Fitting/fitter.py can read it
+def saveAperture(galaxy_name, band, aperture_name, photometry_results, pixels, scale, spire, settings, path = DEFAULT_STORE):
+    multiplier, error_cal = fluxUnits(scale, spire)
+    flux = photometry_results[2] * multiplier
+    sky_error = photometry_results[3] * multiplier #no sky is subtracted, so this is only the error from the error file
+    total_error = math.sqrt(sky_error * sky_error + flux * error_cal * flux * error_cal)
+    with StoreWriter(path) as store:
+        store.add(galaxy_name, band, aperture_name, flux, sky_error, total_error, pixels, configHash(settings))
+    print('Saved to ' + store.path)
+
+if __name__ == '__main__':
+    #get file paths and load the files
+    print('Enter the file path of the FITS image.')
+    values_path = str(input('Image File Path: '))
     while True:
         try:
-            radius = abs(float(input('Enter the aperture radius in arcseconds: ')))
+            fits_values = openFits(values_path)
             break
         except ValueError:
-            print('Invalid input.')
-
-    photometry_results = circularPhotometry(value_data, error_data, values_wcs, pix_scale, ra, dec, radius)
-else:
+            values_path = str(input('Invalid input. Try again: '))
+        except FileNotFoundError:
+            values_path = str(input('File not found. Try again: '))
+        except OSError:
+            values_path = str(input('Invalid file. Try again: '))
+
+    print('Enter the file path of the FITS image error. Enter \'s\' to skip using an error file.')
+    errors_path = str(input('Error File Path: '))
     while True:
         try:
-            semimajor = abs(float(input('Enter the semimajor axis in arcseconds: ')))
-            semiminor = abs(float(input('Enter the semiminor axis in arcseconds: ')))
-            angle = float(input('Enter the rotation angle in degrees: ')) * math.pi / 180
-            break
+            if errors_path == 's':
+                fits_errors = None
+                break
+            else:
+                fits_errors = openFits(errors_path)
+                break
         except ValueError:
-            print('Invalid input.')
+            errors_path = str(input('Invalid input. Try again: '))
+        except FileNotFoundError:
+            errors_path = str(input('File not found. Try again: '))
+        except OSError:
+            errors_path = str(input('Invalid file. Try again: '))
+
+    #get right ascension and declination
+    ra_in = str(input('Enter right ascension of the object in the format \'hour min sec\': '))
+    ra = positionStringtoInt(ra_in, True)
+
+    dec_in = str(input('Enter declination of the object in the format \'deg arcmin arcsec\': '))
+    dec = positionStringtoInt(dec_in, False)
+
+    #get aperture type
+    print('Would you like to use a circular or elliptical aperture?')
+    aperture_type = ' '
+    while (aperture_type != 'circular' and aperture_type != 'elliptical'):
+        aperture_type = str(input('Enter \'circular\' or \'elliptical\': '))
 
-    photometry_results = ellipticalPhotometry(value_data, error_data, values_wcs, pix_scale, ra, dec, semimajor, semiminor, angle)
+    #load image headers
+    values_hdr = fits_values[1].header
+    pix_scale = abs(values_hdr['CDELT1'])
 
-print(photometry_results)
-fits_values.close()
+    #parse WCS info from headers
+    values_wcs = getWcs(values_path, 1)
+
+    #retrieve data from the fits files
+    value_data = fits_values[1].data
+
+    if errors_path == 's':
+        error_data = None
+    else:
+        error_data = fits_errors[1].data
+
+    #get the necessary information for the selected aperture
+    if aperture_type == 'circular':
+        while True:
+            try:
+                radius = abs(float(input('Enter the aperture radius in arcseconds: ')))
+                break
+            except ValueError:
+                print('Invalid input.')
+
+        photometry_results, pixels, settings = measureAperture(value_data, error_data, values_wcs, pix_scale, ra, dec, radius)
+    else:
+        while True:
+            try:
+                semimajor = abs(float(input('Enter the semimajor axis in arcseconds: ')))
+                semiminor = abs(float(input('Enter the semiminor axis in arcseconds: ')))
+                angle = float(input('Enter the rotation angle in degrees: ')) * math.pi / 180
+                break
+            except ValueError:
+                print('Invalid input.')
+
+        photometry_results, pixels, settings = measureAperture(value_data, error_data, values_wcs, pix_scale, ra, dec, None, semimajor, semiminor, angle)
+
+    print(photometry_results)
+
+    #save the aperture sum to the results store, where Fitting/fitter.py can read it
+    print('Enter the name of the galaxy to save this result to the results store. Enter \'s\' to skip saving.')
+    galaxy_name = str(input('Galaxy: '))
+    if galaxy_name != 's':
+        while True:
+            try:
+                band = int(input('Band (microns): '))
+                break
+            except ValueError:
+                print('Invalid input. Try again.')
+        aperture_name = str(input('Aperture name: '))
+        print('Is this SPIRE data?') #assumes the fits file has units of MJy / sr for SPIRE and Jy / pix for PACS
+        spire = ' '
+        while (spire != 'y' and spire != 'n'):
+            spire = str(input('y/n: '))
+        saveAperture(galaxy_name, band, aperture_name, photometry_results, pixels, pix_scale, spire == 'y', settings)
+    closeAll() #closes the error file as well
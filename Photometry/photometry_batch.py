@@ -0,0 +1,249 @@
+from fits_cache import getHeader, getData, getWcs, closeAll, isSpire
+from photometry_regions import regionPhotometry, regionAreas
+from sky import METHODS
+from ds9_regions import readRegions
+from results_table import BANDS, makeTable, writeTable
+from results_store import DEFAULT_STORE, StoreWriter, configHash, regionNames
+import argparse
+import csv
+import multiprocessing
+import os
+import re
+
+#matches file names of the form <galaxy>_<band>[_error][_convolved].fits
+_image_pattern = re.compile(r'^(?P<galaxy>.+?)_(?P<band>\d+)(?P<error>_error)?(?P<convolved>_convolved)?\.fits$')
+
+#region files for the HI maps (HI Mass/mass.py), which are not measured on the IR bands
+HI_REGIONS_SUFFIX = '_HI'
+
+#find every galaxy x band x region file combination in a directory laid out like 'FITS Files/'.
+#Each galaxy has its own directory holding <galaxy>_<band>[_error][_convolved].fits images and <galaxy>_* region files,
+#apart from the <galaxy>_*_HI region files of the HI maps.
+#If convolved is True, the _convolved images are used, falling back to the original image for bands without one.
+#Without convolved, bands that only have a _convolved image are skipped.
+def discover(root, convolved, level):
+    jobs = []
+    for galaxy in sorted(os.listdir(root)):
+        directory = os.path.join(root, galaxy)
+        if not os.path.isdir(directory):
+            continue
+        images = {}
+        errors = {}
+        region_files = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            match = _image_pattern.match(name)
+            if match != None:
+                if match.group('galaxy') != galaxy:
+                    continue
+                band = int(match.group('band'))
+                key = (band, match.group('convolved') != None)
+                if match.group('error') != None:
+                    errors[key] = path
+                else:
+                    images[key] = path
+            elif name.startswith(galaxy + '_') and not name.endswith('.fits') and not name.endswith(HI_REGIONS_SUFFIX):
+                region_files.append(path)
+
+        for band in sorted(set(key[0] for key in images)):
+            if convolved and (band, True) in images:
+                key = (band, True)
+            elif (band, False) in images:
+                key = (band, False)
+            else:
+                continue #only a _convolved image, which is not used without convolved
+            for region_file in region_files:
+                jobs.append({'galaxy': galaxy, 'band': band, 'image': images[key], 'error': errors.get(key),
+                             'regions': region_file, 'level': level})
+    return jobs
+
+#read the jobs from a manifest csv with the columns galaxy, band, image, error, regions and optionally level.
+#Paths are relative to the manifest, and an empty error column means no error file is used.
+def readManifest(manifest_path, level):
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    with open(manifest_path, newline = '') as manifest:
+        for row in csv.DictReader(manifest):
+            error = row.get('error') or None
+            if error != None:
+                error = os.path.join(directory, error)
+            jobs.append({'galaxy': row['galaxy'], 'band': int(row['band']), 'image': os.path.join(directory, row['image']),
+                         'error': error, 'regions': os.path.join(directory, row['regions']),
+                         'level': int(row['level']) if row.get('level') else level})
+    return jobs
+
+#name of a region set, taken from the region file name with the galaxy prefix removed (NGC2685_innerRing -> innerRing)
+def regionSetName(job):
+    name = os.path.basename(job['regions'])
+    if name.startswith(job['galaxy'] + '_'):
+        name = name[len(job['galaxy']) + 1:]
+    return name
+
+#run the photometry for a single job. Returns a list of (region name, flux, sky error, total error, pixels) tuples.
+#Images are read through fits_cache, so jobs that share an image only load it once.
+def runJob(job):
+    values_hdr = getHeader(job['image'], job['level'])
+    pix_scale = abs(values_hdr['CDELT1'])
+    values_wcs = getWcs(job['image'], job['level'])
+    value_data = getData(job['image'], job['level'])
+
+    if job['error'] == None:
+        error_data = None
+    else:
+        error_data = getData(job['error'], job['level'])
+
+    regions_file = readRegions(job['regions'])
+    spire = isSpire(values_hdr, job['band'])
+    regions, sky, galaxy_apertures_sorted = regionPhotometry(value_data, error_data, values_wcs, pix_scale, regions_file, spire,
+                                                             job.get('sky', 'mean'), job.get('local_sky', False), job.get('draws', 0))
+    pixels = regionAreas(galaxy_apertures_sorted)
+    return [region + (count,) for region, count in zip(regions, pixels)]
+
+#hash of the settings a job was measured with (see results_store.py)
+def jobConfig(job):
+    return configHash({'level': job['level'], 'convolved': job['image'].endswith('_convolved.fits'), 'draws': job.get('draws', 0),
+                       'sky': job.get('sky', 'mean'), 'local_sky': job.get('local_sky', False)})
+
+#append the regions of every job to the results store
+def storeResults(store_path, jobs, job_results):
+    with StoreWriter(store_path) as store:
+        for job, regions in zip(jobs, job_results):
+            store.addRegions(job['galaxy'], job['band'], regionSetName(job), regions, [region[4] for region in regions], jobConfig(job))
+    return store.written
+
+#run a job, capturing any error so that one bad file does not stop the whole batch.
+#Returns (regions, None) if the job succeeded and (None, error message) if it failed.
+def runJobSafely(job):
+    try:
+        return (runJob(job), None)
+    except Exception as error:
+        return (None, type(error).__name__ + ': ' + str(error))
+
+#run a group of jobs that measure the same image in one worker, so the image is opened once
+def runJobGroup(group):
+    return [runJobSafely(job) for job in group]
+
+#split the jobs into groups of neighbouring jobs that measure the same image
+def groupJobs(jobs):
+    groups = []
+    for job in jobs:
+        if len(groups) > 0 and (groups[-1][0]['image'], groups[-1][0]['error'], groups[-1][0]['level']) == (job['image'], job['error'], job['level']):
+            groups[-1].append(job)
+        else:
+            groups.append([job])
+    return groups
+
+#run every job on a pool of worker processes. Results come back in the same order as the jobs.
+#With one worker the jobs are run in this process.
+def runJobs(jobs, workers):
+    groups = groupJobs(jobs)
+    #parse every region file once up front. Forked workers inherit the parsed regions instead of parsing each file per band.
+    for region_file in sorted(set(job['regions'] for job in jobs)):
+        try:
+            readRegions(region_file)
+        except (OSError, ValueError):
+            pass #reported by the jobs that use the file
+    if workers == 1:
+        outcomes = map(runJobGroup, groups)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        outcomes = pool.imap(runJobGroup, groups, chunksize = 1)
+
+    job_results = []
+    try:
+        for group, group_outcomes in zip(groups, outcomes):
+            for job, outcome in zip(group, group_outcomes):
+                if outcome[1] == None:
+                    print(job['galaxy'] + ' ' + str(job['band']) + ' ' + regionSetName(job))
+                else:
+                    print(job['galaxy'] + ' ' + str(job['band']) + ' ' + regionSetName(job) + ' failed: ' + outcome[1])
+                job_results.append(outcome)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+        closeAll()
+    return job_results
+
+#gather the results of every job into rows laid out the way Fitting/fitter.py reads them:
+#galaxy, aperture number, aperture name, (flux, sky error, total error) for each band, then the temperature, beta and scale guesses.
+#The aperture names are the ones the results store uses (see regionNames in results_store.py), so every ring gets its own row.
+def tabulate(jobs, job_results, guesses):
+    table = {}
+    order = []
+    for job, regions in zip(jobs, job_results):
+        set_name = regionSetName(job)
+        for i, name in regionNames(set_name, regions):
+            key = (job['galaxy'], name)
+            if key not in table:
+                table[key] = {}
+                order.append(key)
+            table[key][job['band']] = regions[i][1:4]
+
+    rows = []
+    aperture_numbers = {}
+    for key in order:
+        number = aperture_numbers.get(key[0], 0)
+        aperture_numbers[key[0]] = number + 1
+        row = [key[0], number, key[1]]
+        for band in BANDS:
+            if band in table[key]:
+                row.extend(table[key][band])
+            else:
+                row.extend(['', '', '']) #fitter.py skips bands with no data
+        row.extend(guesses)
+        rows.append(row)
+    return rows
+
+#write the results table, as a .npy record array or a csv depending on the file name (see results_table.py)
+def writeResults(output_path, rows):
+    writeTable(output_path, makeTable(rows))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Run region photometry on every galaxy, band and region file without prompts.')
+    parser.add_argument('root', nargs = '?', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FITS Files'),
+                        help = 'directory holding one directory per galaxy (default: FITS Files)')
+    parser.add_argument('--manifest', help = 'csv listing galaxy, band, image, error, regions (and optionally level) instead of searching root')
+    parser.add_argument('--output', default = 'photometry_results.csv', help = 'results table to write, .npy for a typed table or .csv')
+    parser.add_argument('--convolved', action = 'store_true', help = 'use the _convolved images where they exist')
+    parser.add_argument('--level', type = int, default = 1, help = 'level of the FITS files to analyze')
+    parser.add_argument('--workers', type = int, default = 0, help = 'number of worker processes (default: one per core)')
+    parser.add_argument('--monte-carlo', type = int, default = 0, metavar = 'N',
+                        help = 'use N Monte-Carlo realisations for the errors instead of the analytic errors')
+    parser.add_argument('--sky', choices = METHODS, default = 'mean',
+                        help = 'sky estimate: mean of the background apertures, or the sigma clipped mean or median of their pixels')
+    parser.add_argument('--local-sky', action = 'store_true', help = 'measure the sky in an annulus around each galaxy instead of the background apertures')
+    parser.add_argument('--guesses', type = float, nargs = 3, default = [20, 2, 1], metavar = ('T', 'BETA', 'SCALE'),
+                        help = 'initial guesses written for the fitter')
+    parser.add_argument('--store', default = DEFAULT_STORE, help = 'results store to append the measurements to (default: Photometry/photometry_store.csv)')
+    parser.add_argument('--no-store', action = 'store_true', help = 'do not append the measurements to the results store')
+    args = parser.parse_args()
+
+    if args.manifest != None:
+        jobs = readManifest(args.manifest, args.level)
+    else:
+        jobs = discover(args.root, args.convolved, args.level)
+    for job in jobs:
+        job['draws'] = args.monte_carlo
+        job['sky'] = args.sky
+        job['local_sky'] = args.local_sky
+
+    workers = args.workers
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    workers = min(workers, max(len(groupJobs(jobs)), 1))
+
+    job_results = runJobs(jobs, workers)
+    succeeded = [(job, outcome[0]) for job, outcome in zip(jobs, job_results) if outcome[1] == None]
+    failed = [(job, outcome[1]) for job, outcome in zip(jobs, job_results) if outcome[1] != None]
+
+    writeResults(args.output, tabulate([job for job, regions in succeeded], [regions for job, regions in succeeded], args.guesses))
+    print('\nWrote ' + str(len(succeeded)) + ' measurements to ' + args.output)
+    if not args.no_store:
+        rows = storeResults(args.store, [job for job, regions in succeeded], [regions for job, regions in succeeded])
+        print('Appended ' + str(rows) + ' rows to ' + args.store)
+    if len(failed) > 0:
+        print(str(len(failed)) + ' measurements failed:')
+        for job, message in failed:
+            print('\t' + job['image'] + ' with ' + job['regions'] + ': ' + message)
@@ -1,25 +1,17 @@
-from astropy.io import fits    #handle fits files
-from astropy import wcs    #world coordinate system transformations
 from photutils import CircularAperture
 from photutils import EllipticalAperture
-from photutils import aperture_photometry
+from photutils import RectangularAperture
+from photutils import CircularAnnulus
+from aperture_stack import maskStack, stackPhotometry, ringStack, PolygonAperture
+from ds9_regions import parseRegions, readRegions
+from fits_cache import openFits, getWcs, closeAll
+from monte_carlo import monteCarloRegions
+from sky import skyEstimate, localAnnulus
+from results_store import StoreWriter, configHash, DEFAULT_STORE
+from profiling import timed
 import numpy as np
-import xlrd
 import math
 
-#convert RA/declination from "time"/"arctime" to degrees
-def positionStringtoInt(input_string, ra):
-    str_split = input_string.split(':') #split the string at the colon
-    a, b, c = float(str_split[0]), float(str_split[1]), float(str_split[2])
-    int_split = [a, b, c]
-
-    if ra: #perform RA conversion if RA is true
-        return(int_split[0] * 15 + int_split[1] * 0.25 + int_split[2] / 240)
-    elif int_split[0] > 0: #otherwise, perform declination conversion
-        return(int_split[0] + int_split[1] / 60 + int_split[2] / 3600)
-    else:
-        return(int_split[0] - int_split[1] / 60 - int_split[2] / 3600)
-
 #convert arcsec to number of pixels
 def arcsecToPix(arcsec, scale):
     return arcsec / 3600 / scale
@@ -28,229 +20,316 @@ def arcsecToPix(arcsec, scale):
 def solidAngle(scale):
     return scale * scale * math.pi * math.pi / 180 / 180
 
-#parse the relevant information from a region file line. Return None if the line is not an object.
-#Otherwise, return relevant region information in a tuple with a boolean.
-#The boolean is True if the aperture is for the galaxy itself, False otherwise
-def translate(line, coord_info, scale):
-    galaxy_aperture = False
-    line_array = line.split('(') #split line at the '(' to determine region shape
-    if line_array[0] == 'circle' or line_array[0] == 'ellipse':
-        remainder = line_array[1]
-        remainder_colorcheck = remainder.split('#') #check if there is a comment on the line
-        if len(remainder_colorcheck) == 2:
-            if remainder_colorcheck[1] == ' color=red\n': #check if the region is red
-                galaxy_aperture = True
-        remainder = remainder_colorcheck[0] #now the remaining string looks something like '11:53:59.065,+60:41:01.37,89.7417")'
-        remainder_commasplit = remainder.split(',')
-        #the first entry of remainder_commasplit is right ascension. Pass directly to the converter.
-        ra = positionStringtoInt(remainder_commasplit[0], True)
-        #the second entry of remainder_commasplit is declination. Pass directly to the converter.
-        dec = positionStringtoInt(remainder_commasplit[1], False)
-        #the third entry is the radius for circular apertures, or the one of the axes for elliptical apertures
-        radius1 = float(remainder_commasplit[2].split('"')[0]) #cut the quotation mark away from the number
-
-        #convert ra, dec, and radius to pixels
-        x, y = coord_info.all_world2pix(ra, dec, 0)
-        radius1_pix = arcsecToPix(radius1, scale)
-
-        if line_array[0] == 'circle': #if we have a circular object, we're all done!
-            return (galaxy_aperture, CircularAperture((x, y), radius1_pix))
-        else: #otherwise, we still need to grab some information
-            #the fourth entry is the other axis for elliptical apertures
-            radius2 = float(remainder_commasplit[3].split('"')[0]) #cut the quotation mark away from the number
-            radius2_pix = arcsecToPix(radius2, scale)
-            #the fifth entry is the rotation angle for elliptical apertures
-            angle = float(remainder_commasplit[4].split(')')[0]) * math.pi / 180 #cut the closing parenthesis away from the number and convert to radians
+#convert the regions parsed from a region file into apertures on an image.
+#Returns a list of (galaxy, aperture) tuples, where galaxy is True if the aperture is for the galaxy itself (red) and False otherwise.
+#Excluded regions are skipped.
+@timed('translate')
+def translateRegions(regions, coord_info, scale):
+    galaxy = regions.galaxy()
+    x, y, sizes, vertices = regions.toPixels(coord_info, scale) #convert every region to pixels at once
+    apertures = []
+    for i in range(len(regions)):
+        if not regions.include[i]:
+            continue
+        shape = regions.shape(i)
+        radius1_pix, radius2_pix = sizes[i]
+        angle = regions.angles[i] * math.pi / 180 #convert to radians
+
+        if shape == 'circle':
+            aperture = CircularAperture((x[i], y[i]), radius1_pix)
+        elif shape == 'ellipse':
             #determine which axis is which
             #the angle reported by ds9 is the angle of radius2 east of north. it needs to be converted to angle of th semimajor axis above the positive x axis
-            if radius1 < radius2:
+            if radius1_pix < radius2_pix:
                 semiminor = radius1_pix
                 semimajor = radius2_pix
                 angle = angle + math.pi / 2
             else:
                 semiminor = radius2_pix
                 semimajor = radius1_pix
-            return (galaxy_aperture, EllipticalAperture((x, y), semimajor, semiminor, angle))
-    else:
+            aperture = EllipticalAperture((x[i], y[i]), semimajor, semiminor, angle)
+        elif shape == 'box':
+            aperture = RectangularAperture((x[i], y[i]), radius1_pix, radius2_pix, angle)
+        elif shape == 'annulus':
+            aperture = CircularAnnulus((x[i], y[i]), radius1_pix, radius2_pix)
+        else: #polygon
+            aperture = PolygonAperture(vertices[regions.vertex_offsets[i]:regions.vertex_offsets[i + 1]])
+        apertures.append((bool(galaxy[i]), aperture))
+    return apertures
+
+#parse the relevant information from a region file line. Return None if the line is not an object.
+#Otherwise, return relevant region information in a tuple with a boolean.
+#The boolean is True if the aperture is for the galaxy itself, False otherwise
+def translate(line, coord_info, scale):
+    apertures = translateRegions(parseRegions([line]), coord_info, scale)
+    if len(apertures) == 0:
         return None
+    return apertures[0]
+
+#given the data and a list of background apertures, calculate the sky per pixel and its error.
+#method is one of the sky estimates in sky.py: 'mean' (the mean of the aperture means), 'clipped' or 'median'.
+#Returns (sky level, error of the level, pixel scatter, number of pixels used) like skyEstimate().
+@timed('background')
+def background(value_data, error_data, apertures, method = 'mean'):
+    return skyEstimate(value_data, error_data, apertures, method)
+
+#sort a list of apertures from highest area to lowest area
+def sortApertures(apertures):
+    aperture_areas = []
+    for aperture in apertures:
+        aperture_areas.append((aperture.area(), apertures.index(aperture)))
+    aperture_areas_sorted = sorted(aperture_areas, key=lambda aperture: aperture[0]) #sort by area
+    apertures_sorted = []
+    for aperture in aperture_areas_sorted:
+        apertures_sorted.insert(0, apertures[aperture[1]])
+    return apertures_sorted
+
+#get the multiplier from image units to Jy per pixel and the calibration error.
+#Assumes the fits file has units of MJy / sr for SPIRE and Jy / pix for PACS
+def fluxUnits(scale, spire):
+    if spire:
+        multiplier = solidAngle(scale) * 1000000 #get the solid angle per pixel, multiply by a million to get Jy
+        error_cal = 0.07 #calibration error
+    else:
+        multiplier = 1
+        error_cal = 0.05
+    return (multiplier, error_cal)
 
-#given the data and a list of background apertures, calculate the mean sky per pixel
-def background(value_data, error_data, apertures):
-    results = []
-    errors = []
-    for aperture in apertures: #make a list of flux / pixel and a list of error / pixel
-        phot_table = aperture_photometry(value_data, aperture, error_data).as_array()[0] #get photometry results as an array
-        results.append(phot_table[3] / aperture.area())
-        if len(phot_table) == 4:
-            errors.append(0)
-        else:
-            errors.append(phot_table[4] / aperture.area())
-    sum = 0
-    for result in results:
-        sum += result
-    mean = sum / len(results) #calculate mean
-
-    sum = 0
-    for error in errors:
-        sum += error * error
-    mean_error = math.sqrt(sum) / len(errors) #calculate error in mean
-
-    return (mean, mean_error)
-
-#get file paths and load the files
-print('\nEnter the file path of the FITS image.')
-values_path = str(input('Image File Path: '))
-
-print('\n')
-
-while True:
-    try:
-        fits_values = fits.open(values_path)
-        fits_values.info()
-        break
-    except ValueError:
-        values_path = str(input('Invalid input. Try again: '))
-    except FileNotFoundError:
-        values_path = str(input('File not found. Try again: '))
-    except OSError:
-        values_path = str(input('Invalid file. Try again: '))
-
-print('\n')
-
-print('Enter the level of the FITS file that you would like to analyze. (0, 1, 2,...)')
-while True:
-    try:
-        level = int(input('Level: '))
-        #load image headers
-        values_hdr = fits_values[level].header
-        break
-    except ValueError:
-        print('Invalid input. Try again.')
-    except IndexError:
-        print('This level was not found. Try again.')
-
-print('\n')
-
-print('Enter the name of the pixel scale variable in the FITS file. It is usually \'CDELT1\'.')
-while True:
-    try:
-        scale_name = str(input('Variable name: '))
-        pix_scale = abs(values_hdr[scale_name])
-        break
-    except KeyError:
-        print('Variable not found. Try again.')
-
-print('\n')
-
-#parse WCS info from headers
-values_wcs = wcs.WCS(values_hdr)
-
-print('Enter the file path of the FITS image error. Enter \'s\' to skip using an error file.')
-errors_path = str(input('Error File Path: '))
-while True:
-    try:
-        if errors_path == 's':
-            fits_errors = None
-            break
-        else:
-            fits_errors = fits.open(errors_path)
-            break
-    except ValueError:
-        errors_path = str(input('Invalid input. Try again: '))
-    except FileNotFoundError:
-        errors_path = str(input('File not found. Try again: '))
-    except OSError:
-        errors_path = str(input('Invalid file. Try again: '))
-
-print('\n')
-
-#retrieve data from the fits files
-value_data = fits_values[level].data
-
-if errors_path == 's':
-    error_data = None
-else:
-    error_data = fits_errors[level].data
-
-print('Enter the file path of the regions file. Background apertures should be green, and the object aperture should be red.')
-reg_path = str(input('Regions File Path: '))
-while True:
-    try:
-        regions = open(reg_path)
-        break
-    except ValueError:
-        reg_path = str(input('Invalid input. Try again: '))
-    except FileNotFoundError:
-        reg_path = str(input('File not found. Try again: '))
-    except OSError:
-        reg_path = str(input('Invalid file. Try again: '))
-
-print('\n')
-
-print('Is this SPIRE data?') #adjust units of SPIRE data. Assumes the fits file has units of MJy / sr for SPIRE and Jy / pix for PACS
-spire = ' '
-while (spire != 'y' and spire != 'n'):
-    spire = str(input('y/n: '))
-multiplier = 1
-if spire == 'y':
-    multiplier = solidAngle(pix_scale) * 1000000 #get the solid angle per pixel, multiply by a million to get Jy
-
-print('\n')
-
-lines = regions.readlines()
-background_apertures = []
-galaxy_apertures = []
-for line in lines: #make the apertures from the regions file and sort into a list of background apertures and a galaxy aperture
-    translation = translate(line, values_wcs, pix_scale)
-    if translation != None:
+#sort the apertures of a region file into a list of galaxy apertures, from highest area to lowest, and a list of background apertures
+def splitApertures(regions, coord_info, scale):
+    background_apertures = []
+    galaxy_apertures = []
+    for translation in translateRegions(regions, coord_info, scale):
         if translation[0]:
             galaxy_apertures.append(translation[1])
         else:
             background_apertures.append(translation[1])
-
-#sort the list of galaxy apertures from highest area to lowest area
-aperture_areas = []
-for aperture in galaxy_apertures:
-    aperture_areas.append((aperture.area(), galaxy_apertures.index(aperture)))
-aperture_areas_sorted = sorted(aperture_areas, key=lambda aperture: aperture[0]) #sort by area
-galaxy_apertures_sorted = []
-for aperture in aperture_areas_sorted:
-    galaxy_apertures_sorted.insert(0, galaxy_apertures[aperture[1]])
-
-#get background
-if len(background_apertures) == 0:
-    sky = (0, 0)
-else:
-    sky = background(value_data, error_data, background_apertures)
-
-#make list of photometry results for each aperture in the form (flux, sky error, total error)
-results = []
-for galaxy_aperture in galaxy_apertures_sorted:
-    galaxy_photometry = aperture_photometry(value_data, galaxy_aperture, error_data).as_array()[0] #get photometry results of the galaxy as an array
-    if len(galaxy_photometry) == 4:
-        galaxy_flux = (galaxy_photometry[3], 0) #if no error was calculated, return 0 for error
+    return (sortApertures(galaxy_apertures), background_apertures)
+
+#the number of pixels in each region of nested galaxy apertures sorted largest first, in the order regionPhotometry()
+#gives the regions: the whole galaxy, the rings from the outside in, then the center
+def regionAreas(galaxy_apertures_sorted):
+    areas = np.array([aperture.area() for aperture in galaxy_apertures_sorted])
+    return np.concatenate([areas[:1], areas[:-1] - areas[1:], areas[-1:]])
+
+#the background apertures to use: the ones from the region file, or with local_sky an annulus around the largest galaxy aperture
+def skyApertures(galaxy_apertures_sorted, background_apertures, local_sky = False):
+    if local_sky and len(galaxy_apertures_sorted) > 0:
+        return [localAnnulus(galaxy_apertures_sorted[0])]
+    return background_apertures
+
+#the apertures of a region file and the sky they give, worked out once for every measurement of the regions.
+#Returns (galaxy apertures sorted largest first, background apertures used for the sky (see skyApertures), sky), where
+#sky is the estimate from background(), or None without background apertures.
+def regionApertures(value_data, error_data, coord_info, scale, regions, sky_method = 'mean', local_sky = False):
+    galaxy_apertures_sorted, background_apertures = splitApertures(regions, coord_info, scale)
+    background_apertures = skyApertures(galaxy_apertures_sorted, background_apertures, local_sky)
+    sky = None
+    if len(background_apertures) > 0:
+        sky = background(value_data, error_data, background_apertures, sky_method)
+    return (galaxy_apertures_sorted, background_apertures, sky)
+
+#photometry on the regions between nested galaxy apertures in one pass (see ringStack in aperture_stack.py), given the
+#apertures and sky from regionApertures() and the flux units from fluxUnits(). Each ring is measured directly, so the
+#pixels that neighbouring apertures share are not counted twice in its error.
+#Returns a list of (region name, flux, sky error, total error) tuples: the whole galaxy ('Galaxy'), the rings between
+#neighbouring apertures from the outside in ('Next Region'), then the smallest aperture ('Center').
+def ringPhotometry(value_data, error_data, galaxy_apertures_sorted, sky, multiplier, error_cal):
+    if len(galaxy_apertures_sorted) == 0:
+        return []
+    if sky == None:
+        sky = (0, 0)
+
+    sums, errors = stackPhotometry(ringStack(maskStack(galaxy_apertures_sorted, value_data.shape)), value_data, error_data)
+    areas = np.array([aperture.area() for aperture in galaxy_apertures_sorted])
+    ring_areas = np.append(areas[:-1] - areas[1:], [areas[-1], areas[0]])
+    names = ['Next Region'] * (len(areas) - 1) + ['Center', 'Galaxy']
+
+    fluxes = (sums - sky[0] * ring_areas) * multiplier #scale background and subtract
+    sky_errors = np.sqrt(errors * errors + (sky[1] * ring_areas)**2) * multiplier #calculate error from sky
+    total_errors = np.sqrt((fluxes * error_cal)**2 + sky_errors * sky_errors)
+    order = [len(areas)] + list(range(len(areas))) #galaxy first, then the rings from the outside in, then the center
+    return [(names[i], fluxes[i], sky_errors[i], total_errors[i]) for i in order]
+
+#photometry like ringPhotometry(), with Monte-Carlo errors (see monte_carlo.py) in place of the analytic ones, given the
+#apertures and sky from regionApertures(). With the 'mean' sky the background apertures are bootstrapped; the other
+#sky methods are drawn about their estimate.
+def monteCarloPhotometry(value_data, error_data, galaxy_apertures_sorted, background_apertures, sky, sky_method,
+                         multiplier, error_cal, draws = 10000, seed = None):
+    if len(galaxy_apertures_sorted) == 0:
+        return []
+    nominal = [region[1] for region in ringPhotometry(value_data, None, galaxy_apertures_sorted, sky, multiplier, error_cal)]
+    drawn_sky = None
+    if sky_method != 'mean' and sky != None:
+        drawn_sky = (sky[0], sky[1])
+    return monteCarloRegions(value_data, error_data, galaxy_apertures_sorted, background_apertures, multiplier, error_cal,
+                             nominal, draws, seed = seed, sky = drawn_sky)[0]
+
+#perform photometry on the regions of a region file with the chosen sky and errors: the analytic errors, or
+#Monte-Carlo errors with draws realisations. The apertures and the sky are worked out once and shared.
+#Returns (regions, sky, galaxy apertures sorted largest first), where regions is a list of (region name, flux, sky error,
+#total error) tuples like ringPhotometry() and sky is the estimate from skyEstimate() (sky.py), or None without
+#background apertures.
+def regionPhotometry(value_data, error_data, coord_info, scale, regions, spire, sky_method = 'mean', local_sky = False, draws = 0, seed = None):
+    multiplier, error_cal = fluxUnits(scale, spire)
+    galaxy_apertures_sorted, background_apertures, sky = regionApertures(value_data, error_data, coord_info, scale, regions, sky_method, local_sky)
+    if draws > 0:
+        subtracted = monteCarloPhotometry(value_data, error_data, galaxy_apertures_sorted, background_apertures, sky, sky_method,
+                                          multiplier, error_cal, draws, seed)
     else:
-        galaxy_flux = (galaxy_photometry[3], galaxy_photometry[4])
+        subtracted = ringPhotometry(value_data, error_data, galaxy_apertures_sorted, sky, multiplier, error_cal)
+    return (subtracted, sky, galaxy_apertures_sorted)
+
+#print the sky estimate and the regions given by regionPhotometry()
+def printRegions(subtracted, sky = None):
+    if sky != None:
+        print('Sky:\n\tLevel: ' + str(sky[0]) + ' per pixel\n\tError: ' + str(sky[1]) + ' per pixel\n\tPixel Scatter: ' + str(sky[2]) + '\n\tPixels: ' + str(sky[3]) + '\n')
+    for region in subtracted:
+        print(region[0] + ':\n\tFlux: ' + str(region[1]) + ' Jy\n\tSky Error: ' + str(region[2]) + ' Jy\n\tTotal Error: ' + str(region[3]) + ' Jy\n')
+
+#save the regions given by regionPhotometry() to the results store (see results_store.py), where Fitting/fitter.py can
+#read them. settings are the options they were measured with. Returns the number of rows written.
+def saveRegions(galaxy_name, band, set_name, subtracted, galaxy_apertures_sorted, settings, path = DEFAULT_STORE):
+    with StoreWriter(path) as store:
+        store.addRegions(galaxy_name, band, set_name, subtracted, regionAreas(galaxy_apertures_sorted), configHash(settings))
+    print('Saved ' + str(store.written) + ' rows to ' + store.path)
+    return store.written
+
+if __name__ == '__main__':
+    #get file paths and load the files
+    print('\nEnter the file path of the FITS image.')
+    values_path = str(input('Image File Path: '))
+
+    print('\n')
+
+    while True:
+        try:
+            fits_values = openFits(values_path)
+            fits_values.info()
+            break
+        except ValueError:
+            values_path = str(input('Invalid input. Try again: '))
+        except FileNotFoundError:
+            values_path = str(input('File not found. Try again: '))
+        except OSError:
+            values_path = str(input('Invalid file. Try again: '))
+
+    print('\n')
+
+    print('Enter the level of the FITS file that you would like to analyze. (0, 1, 2,...)')
+    while True:
+        try:
+            level = int(input('Level: '))
+            #load image headers
+            values_hdr = fits_values[level].header
+            break
+        except ValueError:
+            print('Invalid input. Try again.')
+        except IndexError:
+            print('This level was not found. Try again.')
+
+    print('\n')
+
+    print('Enter the name of the pixel scale variable in the FITS file. It is usually \'CDELT1\'.')
+    while True:
+        try:
+            scale_name = str(input('Variable name: '))
+            pix_scale = abs(values_hdr[scale_name])
+            break
+        except KeyError:
+            print('Variable not found. Try again.')
 
-    final_flux = (galaxy_flux[0] - sky[0] * galaxy_aperture.area()) * multiplier #scale background and subtract
-    error_sky = (math.sqrt(galaxy_flux[1] * galaxy_flux[1] + sky[1] * galaxy_aperture.area() * sky[1] * galaxy_aperture.area())) * multiplier #calculate error from sky
-    if spire == 'y': #calculate calibration error
-        error_cal = 0.07
-    else:
-        error_cal = 0.05
-    final_error = math.sqrt(final_flux * error_cal * final_flux * error_cal + error_sky * error_sky)
-    results.append((final_flux, error_sky, final_error))
-
-#now do region subtraction and print results
-i = 0
-while i < len(results):
-    if i == 0:
-        print('Galaxy:\n\tFlux: ' + str(results[i][0]) + ' Jy\n\tSky Error: ' + str(results[i][1]) + ' Jy\n\tTotal Error: ' + str(results[i][2]) + ' Jy\n')
+    print('\n')
+
+    #parse WCS info from headers
+    values_wcs = getWcs(values_path, level)
+
+    print('Enter the file path of the FITS image error. Enter \'s\' to skip using an error file.')
+    errors_path = str(input('Error File Path: '))
+    while True:
+        try:
+            if errors_path == 's':
+                fits_errors = None
+                break
+            else:
+                fits_errors = openFits(errors_path)
+                break
+        except ValueError:
+            errors_path = str(input('Invalid input. Try again: '))
+        except FileNotFoundError:
+            errors_path = str(input('File not found. Try again: '))
+        except OSError:
+            errors_path = str(input('Invalid file. Try again: '))
+
+    print('\n')
+
+    #retrieve data from the fits files
+    value_data = fits_values[level].data
+
+    if errors_path == 's':
+        error_data = None
     else:
-        region_flux = results[i - 1][0] - results[i][0]
-        region_sky_error = math.sqrt(results[i - 1][1] * results[i - 1][1] + results[i][1] * results[i][1])
-        region_total_error = math.sqrt(region_sky_error * region_sky_error + region_flux * error_cal * region_flux * error_cal)
-        print('Next Region:\n\tFlux: ' + str(region_flux) + ' Jy\n\tSky Error: ' + str(region_sky_error) + ' Jy\n\tTotal Error: ' + str(region_total_error) + ' Jy\n')
-    if i == len(results) - 1:
-        print('Center:\n\tFlux: ' + str(results[i][0]) + ' Jy\n\tSky Error: ' + str(results[i][1]) + ' Jy\n\tTotal Error: ' + str(results[i][2]) + ' Jy\n')
-    i += 1
+        error_data = fits_errors[level].data
+
+    print('Enter the file path of the regions file. Background apertures should be green, and the object aperture should be red.')
+    reg_path = str(input('Regions File Path: '))
+    while True:
+        try:
+            regions = readRegions(reg_path)
+            break
+        except ValueError:
+            reg_path = str(input('Invalid input. Try again: '))
+        except FileNotFoundError:
+            reg_path = str(input('File not found. Try again: '))
+        except OSError:
+            reg_path = str(input('Invalid file. Try again: '))
+
+    print('\n')
+
+    print('Is this SPIRE data?') #adjust units of SPIRE data. Assumes the fits file has units of MJy / sr for SPIRE and Jy / pix for PACS
+    spire = ' '
+    while (spire != 'y' and spire != 'n'):
+        spire = str(input('y/n: '))
+
+    print('\n')
+
+    print('How should the sky be estimated? Enter \'mean\' for the mean of the background apertures, \'clipped\' for the sigma clipped mean of their pixels, \'median\' for the median of their pixels, or \'local\' for the sigma clipped mean in an annulus around the galaxy.')
+    sky_method = ' '
+    while sky_method not in ['mean', 'clipped', 'median', 'local']:
+        sky_method = str(input('Sky: '))
+    local_sky = sky_method == 'local'
+    if local_sky:
+        sky_method = 'clipped'
+
+    print('\n')
+
+    print('Enter the number of Monte-Carlo realisations to use for the errors. Enter 0 for the analytic errors.')
+    while True:
+        try:
+            draws = int(input('Realisations: '))
+            if draws >= 0:
+                break
+            print('Invalid input. Try again.')
+        except ValueError:
+            print('Invalid input. Try again.')
+
+    print('\n')
+
+    subtracted, sky, galaxy_apertures_sorted = regionPhotometry(value_data, error_data, values_wcs, pix_scale, regions, spire == 'y', sky_method, local_sky, draws)
+    printRegions(subtracted, sky)
+
+    #save the results to the results store, where Fitting/fitter.py can read them
+    print('Enter the name of the galaxy to save these results to the results store. Enter \'s\' to skip saving.')
+    galaxy_name = str(input('Galaxy: '))
+    if galaxy_name != 's':
+        while True:
+            try:
+                band = int(input('Band (microns): '))
+                break
+            except ValueError:
+                print('Invalid input. Try again.')
+        set_name = str(input('Aperture name: '))
+        saveRegions(galaxy_name, band, set_name, subtracted, galaxy_apertures_sorted,
+                    {'level': level, 'errors': errors_path != 's', 'draws': draws, 'sky': sky_method, 'local_sky': local_sky})
+
+    closeAll()
@@ -0,0 +1,141 @@
+import atexit
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+#Stage timers for the photometry, HI mass and fitting code. The slow steps (FITS open and read, WCS construction and
+#conversion, region parsing and translation, sky estimation, aperture photometry, Monte-Carlo errors, fits...) are
+#wrapped in named stages, with the timed() decorator or the stage() context manager. Each stage counts its calls and
+#adds up their wall and CPU time, both inclusive and self (without the stages nested in it, so the self times of all
+#stages add up to no more than the run), and records its peak memory: the most memory allocated (traced with
+#tracemalloc, which covers NumPy arrays) above what was in use when a call started.
+#Profiling is off unless the ETG_PROFILE environment variable names an output file, e.g.
+#    ETG_PROFILE=run.json python photometry_batch.py --workers 1
+#At exit the stages are summarized on stderr and written to that file as a Chrome trace (open it in chrome://tracing
+#or ui.perfetto.dev), with the per-stage totals under 'stages'. When off, a timed function costs one flag check; when on,
+#tracing the memory makes the run slower, so compare profiled runs with each other rather than with plain ones.
+#Only the process that started the run is recorded, so profile with one worker to see the stages of every job.
+
+_path = os.environ.get('ETG_PROFILE') or None
+_pid = os.getpid()
+_start = time.perf_counter()
+_stages = {}
+_events = []
+_open = [] #the stages running now, innermost last
+if _path != None:
+    tracemalloc.start()
+
+#peak resident memory of the process so far, in bytes
+def peakMemory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 #kilobytes on Linux
+
+#True if stages are being recorded
+def enabled():
+    return _path != None and os.getpid() == _pid
+
+#start recording, writing the results to path at exit (the same as setting ETG_PROFILE)
+def enable(path):
+    global _path, _pid
+    _path = path
+    _pid = os.getpid()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+#fold the traced peak since the last reset into every running stage, and start a new peak
+def _foldPeak():
+    peak = tracemalloc.get_traced_memory()[1]
+    for running in _open:
+        running.peak = max(running.peak, peak)
+    tracemalloc.reset_peak()
+
+#a named stage, used as a context manager:
+#    with stage('fits_read'):
+#        data = hdus[1].data
+class stage:
+    def __init__(self, name, **details):
+        self.name = name
+        self.details = details
+
+    def __enter__(self):
+        if enabled():
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            _foldPeak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+            self.peak = self.memory
+            self.nested_wall = 0.
+            self.nested_cpu = 0.
+            _open.append(self)
+            self.cpu = time.process_time()
+            self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        if enabled() and hasattr(self, 'wall'):
+            wall = time.perf_counter() - self.wall
+            cpu = time.process_time() - self.cpu
+            _foldPeak()
+            _open.remove(self)
+            if len(_open) > 0:
+                _open[-1].nested_wall += wall
+                _open[-1].nested_cpu += cpu
+            peak = self.peak - self.memory
+            totals = _stages.setdefault(self.name, {'calls': 0, 'wall': 0., 'cpu': 0., 'self_wall': 0., 'self_cpu': 0., 'max_wall': 0., 'peak_memory': 0})
+            totals['calls'] += 1
+            totals['wall'] += wall
+            totals['cpu'] += cpu
+            totals['self_wall'] += wall - self.nested_wall
+            totals['self_cpu'] += cpu - self.nested_cpu
+            totals['max_wall'] = max(totals['max_wall'], wall)
+            totals['peak_memory'] = max(totals['peak_memory'], peak)
+            event = {'name': self.name, 'ph': 'X', 'pid': _pid, 'tid': threading.get_ident(),
+                     'ts': (self.wall - _start) * 1e6, 'dur': wall * 1e6, 'args': {'cpu': cpu, 'peak_memory': peak}}
+            if len(self.details) > 0:
+                event['args'].update(self.details)
+            _events.append(event)
+        return False
+
+#decorator that runs every call of a function as a stage, named after the function unless a name is given
+def timed(name = None):
+    def decorate(function):
+        stage_name = name or function.__name__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return function(*args, **kwargs)
+            with stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+#the totals of every stage, as a dict of stage name to calls, wall, cpu, self_wall, self_cpu, max_wall and peak_memory.
+#wall and cpu include the stages nested in it, self_wall and self_cpu do not, and peak_memory is the largest peak of a call.
+def summary():
+    return {name: dict(totals) for name, totals in _stages.items()}
+
+#write the recorded stages to path as a Chrome trace with the stage totals
+def dump(path):
+    with open(path, 'w') as output:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms', 'stages': summary(),
+                   'otherData': {'command': ' '.join(sys.argv), 'wall': time.perf_counter() - _start, 'max_rss': peakMemory()}}, output)
+
+#print the stages, slowest first
+def report(stream = sys.stderr):
+    stream.write('\n%-22s %8s %11s %11s %11s %12s\n' % ('Stage', 'Calls', 'Wall (s)', 'Self (s)', 'CPU (s)', 'Peak (MB)'))
+    for name, totals in sorted(_stages.items(), key = lambda item: -item[1]['wall']):
+        stream.write('%-22s %8d %11.4f %11.4f %11.4f %12.1f\n' % (name, totals['calls'], totals['wall'], totals['self_wall'], totals['cpu'],
+                                                                 totals['peak_memory'] / 1e6))
+
+def _finish():
+    if enabled() and len(_stages) > 0:
+        report()
+        dump(_path)
+        sys.stderr.write('Profile written to ' + _path + '\n')
+
+atexit.register(_finish)
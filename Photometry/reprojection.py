@@ -0,0 +1,100 @@
+from astropy import wcs    #world coordinate system transformations
+from astropy.wcs.utils import proj_plane_pixel_area
+from fits_cache import getHeader, getData, getWcs
+from profiling import timed
+import numpy as np
+import hashlib
+import os
+
+#Reprojection of images onto a common pixel grid. The mapping from a band's pixel grid to a reference grid (for each
+#reference pixel, the source pixel to read and the bilinear weights of its neighbours) is the only part that needs
+#the WCS transforms, and it is the same for every image on the same grid: the value and error maps, the original
+#and _convolved versions, and every run after the first. Mappings are computed once per pair of grids, kept in
+#memory and saved to disk, keyed by a hash of both headers' WCS and image size. Applying one is a single gather.
+
+#directory where mappings are saved when no other is given
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reprojection_cache')
+
+_mappings = {}
+
+#hash of the pixel grid of a header: its WCS and image size
+def gridKey(header):
+    text = wcs.WCS(header).celestial.to_header_string(relax = True) + repr((header.get('NAXIS1'), header.get('NAXIS2')))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+#pixel positions on a source image of the pixel centers of a target grid, as (y, x) arrays of the target shape
+def reprojectionCoordinates(source_wcs, target_wcs, shape):
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    ra, dec = target_wcs.all_pix2world(x.ravel(), y.ravel(), 0)
+    source_x, source_y = source_wcs.all_world2pix(ra, dec, 0)
+    return (source_y.reshape(shape), source_x.reshape(shape))
+
+#the bilinear mapping from a source grid to a target grid. Returns a dict of arrays over the target pixels:
+#    index: flattened source index of the lower left neighbour, -1 where the target pixel is off the source image
+#    fy, fx: fractional position between the neighbours
+#and the source and target shapes.
+def computeMapping(source_wcs, source_shape, target_wcs, target_shape):
+    source_y, source_x = reprojectionCoordinates(source_wcs, target_wcs, target_shape)
+    height, width = source_shape
+    inside = (source_y >= 0) & (source_y <= height - 1) & (source_x >= 0) & (source_x <= width - 1)
+    y0 = np.clip(np.floor(np.where(inside, source_y, 0)), 0, max(height - 2, 0)).astype(np.int64)
+    x0 = np.clip(np.floor(np.where(inside, source_x, 0)), 0, max(width - 2, 0)).astype(np.int64)
+    index = np.where(inside, y0 * width + x0, -1)
+    return {'index': index, 'fy': np.where(inside, source_y - y0, 0),
+            'fx': np.where(inside, source_x - x0, 0),
+            'source_shape': np.array(source_shape), 'target_shape': np.array(target_shape)}
+
+#the mapping from the grid of source_header to the grid of target_header, from memory, from the disk cache in
+#directory, or computed and saved there. With directory None the mapping is only kept in memory.
+@timed('reprojection_mapping')
+def cachedMapping(source_header, target_header, directory = DEFAULT_CACHE):
+    key = gridKey(source_header) + '_' + gridKey(target_header)
+    if key in _mappings:
+        return _mappings[key]
+    path = None if directory == None else os.path.join(directory, key + '.npz')
+    if path != None and os.path.exists(path):
+        try:
+            with np.load(path) as saved:
+                _mappings[key] = dict(saved)
+            return _mappings[key]
+        except (OSError, ValueError, KeyError):
+            pass #a broken file is made again
+    source_shape = (source_header['NAXIS2'], source_header['NAXIS1'])
+    target_shape = (target_header['NAXIS2'], target_header['NAXIS1'])
+    mapping = computeMapping(wcs.WCS(source_header).celestial, source_shape, wcs.WCS(target_header).celestial, target_shape)
+    if path != None:
+        os.makedirs(directory, exist_ok = True)
+        temporary = path + '.tmp.npz'
+        np.savez(temporary, **mapping)
+        os.replace(temporary, path) #never leave a partly written mapping behind
+    _mappings[key] = mapping
+    return mapping
+
+#resample an image with a mapping by bilinear interpolation. Target pixels off the source image get nan.
+def applyMapping(mapping, data):
+    data = np.asarray(data, dtype = float)
+    if data.shape != tuple(mapping['source_shape']):
+        raise ValueError('Image of shape ' + str(data.shape) + ' does not match the mapping')
+    flat = data.ravel()
+    width = data.shape[1]
+    index = mapping['index']
+    inside = index >= 0
+    i = np.where(inside, index, 0)
+    i_right = np.minimum(i + 1, flat.size - 1)
+    i_up = np.minimum(i + width, flat.size - 1)
+    i_both = np.minimum(i + width + 1, flat.size - 1)
+    fy, fx = mapping['fy'], mapping['fx']
+    with np.errstate(invalid = 'ignore'):
+        result = ((1 - fy) * ((1 - fx) * flat[i] + fx * flat[i_right]) + fy * ((1 - fx) * flat[i_up] + fx * flat[i_both]))
+    result[~inside] = np.nan
+    return result
+
+#the band of a list of images with the largest pixels, whose grid the others are reprojected onto.
+#Returns the path of that image.
+def coarsestImage(paths, level = 1):
+    return max(paths, key = lambda path: proj_plane_pixel_area(getWcs(path, level)))
+
+#reproject one level of an image onto the grid of target_header, reusing the cached mapping
+def reprojectImage(path, level, target_header, directory = DEFAULT_CACHE):
+    header = getHeader(path, level)
+    return applyMapping(cachedMapping(header, target_header, directory), getData(path, level))
@@ -0,0 +1,172 @@
+from results_table import BANDS, makeTable, readTable
+import hashlib
+import json
+import csv
+import os
+
+#Append-only store of photometry measurements, shared by photometry.py, photometry_regions.py, photometry_batch.py and
+#HI Mass/mass.py, and read by Fitting/fitter.py. Each measurement is one csv row:
+#    galaxy, band, aperture, flux, sky_error, total_error, pixels, config
+#where band is the wavelength in microns ('HI' for HI masses, whose flux column holds the mass in solar masses),
+#aperture is the aperture name (e.g. 'bar', 'bar Galaxy' or 'bar Next Region 2', see regionNames), pixels is the number
+#of pixels measured and config is a hash of the settings used. Rows are only ever appended, in batches; when the same galaxy, band and aperture is measured again the
+#latest row is the one that is used, so older measurements stay on record.
+
+STORE_FIELDS = ['galaxy', 'band', 'aperture', 'flux', 'sky_error', 'total_error', 'pixels', 'config']
+
+#the store used when no other path is given
+DEFAULT_STORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'photometry_store.csv')
+
+#short hash of the settings of a measurement (a dict of names to values)
+def configHash(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys = True, default = str).encode()).hexdigest()[:12]
+
+#names of the regions of a measurement, as returned by regionPhotometry / hiMasses, in the store and the results table,
+#as a list of (region index, name). A single aperture is given as both the 'Galaxy' and the 'Center', so it is named once,
+#after the set alone. Every ring is called 'Next Region', so the rings are numbered from the outside in
+#('bar Next Region 1', 'bar Next Region 2', ...) to tell them apart.
+def regionNames(set_name, regions):
+    if len(regions) <= 2:
+        return [(0, set_name)] if len(regions) > 0 else []
+    names = []
+    for i, region in enumerate(regions):
+        if region[0] == 'Next Region':
+            names.append((i, '%s Next Region %d' % (set_name, i)))
+        else:
+            names.append((i, set_name + ' ' + region[0]))
+    return names
+
+#batched writer for the store. Rows are kept in memory and appended to the file every batch rows and on close().
+#Use as a context manager, or call close() when done.
+class StoreWriter:
+    def __init__(self, path = DEFAULT_STORE, batch = 500):
+        self.path = path
+        self.batch = batch
+        self.rows = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    #queue one measurement
+    def add(self, galaxy, band, aperture, flux, sky_error, total_error, pixels, config):
+        self.rows.append([galaxy, band, aperture, flux, sky_error, total_error, pixels, config])
+        if len(self.rows) >= self.batch:
+            self.flush()
+
+    #queue the regions of one measurement, as returned by regionPhotometry / hiMasses, with their pixel counts, under
+    #the names given by regionNames
+    def addRegions(self, galaxy, band, set_name, regions, pixels, config):
+        for i, name in regionNames(set_name, regions):
+            self.add(galaxy, band, name, regions[i][1], regions[i][2], regions[i][3], pixels[i], config)
+
+    #append the queued rows to the file, writing the header first if the file is new
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a+', newline = '') as store:
+            if not new:
+                store.seek(store.tell() - 1)
+                if store.read(1) != '\n': #finish a line cut off by a crash
+                    store.write('\n')
+            writer = csv.writer(store)
+            if new:
+                writer.writerow(STORE_FIELDS)
+            writer.writerows(self.rows)
+        self.written += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+#read every measurement in a store, oldest first, as a list of dicts. Rows that cannot be read, such as a line cut off by
+#a crash, are skipped. Raises FileNotFoundError / OSError like open, and ValueError if the file is not a store.
+def readStore(path = DEFAULT_STORE):
+    with open(path, newline = '') as store:
+        reader = csv.reader(store)
+        if next(reader, None) != STORE_FIELDS:
+            raise ValueError('Not a results store: ' + os.path.basename(path))
+        entries = []
+        for row in reader:
+            if len(row) != len(STORE_FIELDS):
+                continue
+            try:
+                entry = dict(zip(STORE_FIELDS, row))
+                for field in ['flux', 'sky_error', 'total_error', 'pixels']:
+                    entry[field] = float(entry[field])
+            except ValueError:
+                continue
+            entries.append(entry)
+    return entries
+
+#True if the file at path is a results store
+def isStore(path):
+    try:
+        with open(path, newline = '') as store:
+            return next(csv.reader(store), None) == STORE_FIELDS
+    except (UnicodeDecodeError, csv.Error):
+        return False
+
+#config of storeTable / loadResults that picks, for each galaxy, the config of its latest measurement
+LATEST = 'latest'
+
+#the config hashes in a store, oldest first, as a list of (config, number of measurements). Only bands in bands count.
+def storeConfigs(path = DEFAULT_STORE, bands = BANDS):
+    counts = {}
+    names = [str(band) for band in bands]
+    for entry in readStore(path):
+        if entry['band'] in names:
+            counts[entry['config']] = counts.get(entry['config'], 0) + 1
+    return list(counts.items())
+
+#the latest measurement of each galaxy, band and aperture in a store, as a results table (see results_table.py) with the
+#given guesses for the fitter. Only bands in bands are used. config chooses the measurements: a config hash for only the
+#measurements made with it, LATEST for the config of the latest measurement of each galaxy, or None for every
+#measurement. Measurements made with different settings should not be fit together, so a row whose bands come from
+#different configs is reported.
+def storeTable(path = DEFAULT_STORE, guesses = (20, 2, 1), bands = BANDS, config = None):
+    names = [str(band) for band in bands]
+    entries = [entry for entry in readStore(path) if entry['band'] in names]
+    if config == LATEST:
+        galaxy_configs = {entry['galaxy']: entry['config'] for entry in entries}
+        entries = [entry for entry in entries if entry['config'] == galaxy_configs[entry['galaxy']]]
+    elif config != None:
+        entries = [entry for entry in entries if entry['config'] == config]
+
+    latest = {}
+    configs = {}
+    order = []
+    for entry in entries:
+        key = (entry['galaxy'], entry['aperture'])
+        if key not in latest:
+            latest[key] = {}
+            configs[key] = {}
+            order.append(key)
+        latest[key][entry['band']] = [entry['flux'], entry['sky_error'], entry['total_error']]
+        configs[key][entry['band']] = entry['config']
+
+    rows = []
+    aperture_numbers = {}
+    for key in order:
+        if len(set(configs[key].values())) > 1:
+            print('Warning: the bands of ' + key[0] + ' ' + key[1] + ' were measured with different settings (configs ' +
+                  ', '.join(sorted(set(configs[key].values()))) + ')')
+        number = aperture_numbers.get(key[0], 0)
+        aperture_numbers[key[0]] = number + 1
+        row = [key[0], number, key[1]]
+        for name in names:
+            row.extend(latest[key].get(name, ['', '', '']))
+        row.extend(guesses)
+        rows.append(row)
+    return makeTable(rows, bands)
+
+#read a results table from a store, a .npy table or a csv table, whichever the file is. config chooses the measurements
+#of a store, as in storeTable.
+def loadResults(path, config = LATEST):
+    if not path.endswith('.npy') and isStore(path):
+        return storeTable(path, config = config)
+    return readTable(path)
@@ -0,0 +1,100 @@
+import numpy as np
+import csv
+import os
+
+#Typed, columnar form of the photometry results table that Fitting/fitter.py reads.
+#The table is a NumPy record array with one row per aperture and named columns:
+#    galaxy, aperture, ap_name
+#    flux_<band>, sky_error_<band>, total_error_<band> for each band (microns), nan where there is no data
+#    temp_guess, beta_guess, scale_guess
+#Tables are saved as .npy files, which load without parsing. The old csv layout can still be read and written,
+#and is converted to the same record array, so code using the table does not care which file it came from.
+
+#wavelengths in microns, in the column order of the csv layout
+BANDS = [24, 70, 100, 160, 250, 350, 500]
+
+_band_fields = ['flux', 'sky_error', 'total_error']
+_band_headers = ['Flux', 'Sky Error', 'Total Error']
+
+#record dtype of a table with the given bands
+def tableDtype(bands = BANDS):
+    fields = [('galaxy', 'U64'), ('aperture', 'i4'), ('ap_name', 'U128')]
+    for band in bands:
+        fields.extend([(field + '_' + str(band), 'f8') for field in _band_fields])
+    fields.extend([('temp_guess', 'f8'), ('beta_guess', 'f8'), ('scale_guess', 'f8')])
+    return np.dtype(fields)
+
+#header of the csv layout
+def csvHeader(bands = BANDS):
+    header = ['Galaxy', 'Aperture', 'ApName']
+    for band in bands:
+        header.extend([str(band) + ' ' + name for name in _band_headers])
+    header.extend(['Temp Guess', 'Beta Guess', 'Scale Guess'])
+    return header
+
+#build a table from rows in the csv layout (lists of strings or numbers; '' for a band with no data)
+def makeTable(rows, bands = BANDS):
+    table = np.zeros(len(rows), dtype = tableDtype(bands))
+    if len(rows) == 0:
+        return table
+    columns = list(zip(*rows))
+    table['galaxy'] = columns[0]
+    table['aperture'] = [int(value) for value in columns[1]]
+    table['ap_name'] = columns[2]
+    numbers = np.array([[np.nan if value == '' else float(value) for value in row[3:]] for row in rows], dtype = float)
+    for name, column in zip(tableDtype(bands).names[3:], numbers.T):
+        table[name] = column
+    return table
+
+#bands of a table, read from its column names
+def tableBands(table):
+    return [int(name[len('flux_'):]) for name in table.dtype.names if name.startswith('flux_')]
+
+#one kind of band column ('flux', 'sky_error' or 'total_error') for every band, as a (rows, bands) array
+def bandColumns(table, field):
+    return np.stack([table[field + '_' + str(band)] for band in tableBands(table)], axis = -1)
+
+#bands detected above sigma times the sky error, as a (rows, bands) boolean array. Bands with no data are not detected.
+def detectionMask(table, sigma = 3):
+    with np.errstate(invalid = 'ignore'):
+        return bandColumns(table, 'flux') > sigma * bandColumns(table, 'sky_error')
+
+#write a table, as .npy if the path ends in .npy and in the csv layout otherwise
+def writeTable(path, table):
+    if path.endswith('.npy'):
+        np.save(path, table, allow_pickle = False)
+        return
+    with open(path, 'w', newline = '') as output:
+        writer = csv.writer(output)
+        writer.writerow(csvHeader(tableBands(table)))
+        for record in table:
+            row = [record['galaxy'], record['aperture'], record['ap_name']]
+            row.extend(['' if np.isnan(value) else value for value in list(record)[3:]])
+            writer.writerow(row)
+
+#read a table from a .npy file or a csv in the old layout. Columns after the guesses are ignored, as the old fitter did.
+#Raises FileNotFoundError / OSError like open, and ValueError if the file is not a results table.
+def readTable(path):
+    if path.endswith('.npy'):
+        table = np.load(path, allow_pickle = False)
+        if table.dtype.names == None or 'galaxy' not in table.dtype.names:
+            raise ValueError('Not a results table: ' + path)
+        return table
+    with open(path, newline = '') as results:
+        reader = csv.reader(results)
+        header = next(reader)
+        rows = [row for row in reader if len(row) > 0]
+    bands = []
+    for name in header[3::3]: #the '<band> Flux' columns, up to the guesses
+        parts = name.split()
+        if len(parts) != 2 or parts[1] != 'Flux' or not parts[0].isdigit():
+            break
+        bands.append(int(parts[0]))
+    if len(bands) == 0:
+        bands = BANDS #header not written by writeTable, so assume the standard column order
+    width = len(csvHeader(bands))
+    if len(header) < width:
+        raise ValueError('Not a results table: ' + os.path.basename(path))
+    if len(header) > width: #columns added after the guesses, e.g. notes in a spreadsheet export
+        print('Ignoring ' + str(len(header) - width) + ' column(s) after the guesses in ' + os.path.basename(path))
+    return makeTable([row[:width] for row in rows], bands)
@@ -0,0 +1,86 @@
+from photutils import CircularAperture
+from photutils import EllipticalAperture
+from photutils import CircularAnnulus
+from photutils import EllipticalAnnulus
+from aperture_stack import maskStack, stackPhotometry, cutout
+import numpy as np
+
+#Sky estimation. The pixels of every background aperture are gathered into one array by a single mask stack, and
+#the sky level per pixel is estimated from them with one of
+#    'mean':    the mean of the mean surface brightness of each aperture, with the error propagated from the error
+#               map (the original estimate, kept as the default)
+#    'clipped': the mean of the pixels after iterative sigma clipping about the median
+#    'median':  the median of the pixels
+#For 'clipped' and 'median' the error of the level comes from the pixel to pixel scatter (1.4826 times the median
+#absolute deviation), so it also covers sky structure that the error map does not. Every estimate reports the scatter
+#and the number of pixels used. localAnnulus() makes a sky annulus around a galaxy aperture, for a local sky.
+
+METHODS = ['mean', 'clipped', 'median']
+
+#the robust standard deviation of a set of values
+def madScatter(values):
+    if len(values) == 0:
+        return np.nan
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+#mask of the values that survive iterative sigma clipping about the median
+def sigmaClip(values, sigma = 3., iterations = 10):
+    keep = np.isfinite(values)
+    for iteration in range(iterations):
+        kept = values[keep]
+        if len(kept) == 0:
+            break
+        center = np.median(kept)
+        scatter = madScatter(kept)
+        clipped = keep & (np.abs(values - center) <= sigma * scatter)
+        if np.count_nonzero(clipped) == np.count_nonzero(keep) or np.count_nonzero(clipped) == 0:
+            break
+        keep = clipped
+    return keep
+
+#estimate the sky per pixel from a list of background apertures.
+#Returns (sky level, error of the level, pixel scatter, number of pixels used). With no usable pixels the level is 0.
+def skyEstimate(value_data, error_data, apertures, method = 'mean', sigma = 3.):
+    if method not in METHODS:
+        raise ValueError('Unknown sky method: ' + str(method))
+    stack = maskStack(apertures, value_data.shape)
+    numbers, indices, weights, count, bounds = stack
+    values = np.take(cutout(stack, value_data), indices)
+
+    if method == 'mean':
+        sums, errors = stackPhotometry(stack, value_data, error_data) #measure all apertures at once
+        areas = np.array([aperture.area() for aperture in apertures])
+        results = sums / areas #flux / pixel
+        errors = errors / areas #error / pixel
+        mean = np.mean(results) #calculate mean
+        mean_error = np.sqrt(np.sum(errors * errors)) / len(errors) #calculate error in mean
+        return (mean, mean_error, madScatter(values[np.isfinite(values)]), float(np.sum(weights)))
+
+    #the robust methods use the pixels that are at least half inside a background aperture
+    values = values[weights >= 0.5]
+    keep = sigmaClip(values, sigma) if method == 'clipped' else np.isfinite(values)
+    values = values[keep]
+    if len(values) == 0:
+        return (0, 0, np.nan, 0)
+    scatter = madScatter(values)
+    if method == 'clipped':
+        level = np.mean(values)
+        level_error = scatter / np.sqrt(len(values))
+    else:
+        level = np.median(values)
+        level_error = 1.2533 * scatter / np.sqrt(len(values)) #the median is noisier than the mean by sqrt(pi / 2)
+    return (level, level_error, scatter, len(values))
+
+#a sky annulus around a galaxy aperture, from inner to outer times its size.
+#Circles and ellipses get an annulus of the same shape; other apertures get a circular annulus of the same area.
+def localAnnulus(aperture, inner = 1.5, outer = 2.):
+    if isinstance(aperture, CircularAperture):
+        return CircularAnnulus(aperture.positions, inner * aperture.r, outer * aperture.r)
+    elif isinstance(aperture, EllipticalAperture):
+        return EllipticalAnnulus(aperture.positions, inner * aperture.a, outer * aperture.a, outer * aperture.b, theta = aperture.theta)
+    if hasattr(aperture, 'positions'):
+        position = aperture.positions
+    else: #polygon
+        position = aperture.vertices.mean(axis = 0)
+    radius = np.sqrt(aperture.area() / np.pi)
+    return CircularAnnulus(position, inner * radius, outer * radius)
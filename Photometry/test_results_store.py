@@ -0,0 +1,50 @@
+import os
+import pytest
+
+#The batch run (photometry_batch.py) and the single image path of photometry_regions.py / etg.py photometry must save
+#a measurement under the same aperture names, so the fitter reads one row per aperture whichever tool measured it.
+#Run with
+#    python -m pytest Photometry
+#Skipped when the photometry dependencies (astropy, photutils) are not installed.
+
+try:
+    import photometry_batch
+    from photometry_regions import regionPhotometry, saveRegions
+    from fits_cache import getHeader, getData, getWcs
+    from ds9_regions import readRegions
+except ImportError as error: #photutils or astropy missing, or a photutils without the aperture API used here
+    pytest.skip('photometry dependencies not available: ' + str(error), allow_module_level = True)
+from results_store import storeTable
+
+GALAXY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FITS Files', 'NGC2685')
+
+#store the 250 micron photometry of a region file through both paths, and read each store back as a results table
+def storedTables(tmp_path, regions_path):
+    job = {'galaxy': 'NGC2685', 'band': 250, 'image': os.path.join(GALAXY_DIRECTORY, 'NGC2685_250.fits'),
+           'error': os.path.join(GALAXY_DIRECTORY, 'NGC2685_250_error.fits'), 'regions': regions_path, 'level': 1}
+    batch_store = str(tmp_path / 'batch_store.csv')
+    photometry_batch.storeResults(batch_store, [job], [photometry_batch.runJob(job)])
+
+    cli_store = str(tmp_path / 'cli_store.csv')
+    subtracted, sky, galaxy_apertures_sorted = regionPhotometry(getData(job['image'], 1), getData(job['error'], 1), getWcs(job['image'], 1),
+                                                                abs(getHeader(job['image'], 1)['CDELT1']), readRegions(regions_path), True)
+    saveRegions(job['galaxy'], job['band'], photometry_batch.regionSetName(job), subtracted, galaxy_apertures_sorted, {}, cli_store)
+    return (storeTable(batch_store), storeTable(cli_store))
+
+def test_single_aperture_is_one_row(tmp_path):
+    batch, cli = storedTables(tmp_path, os.path.join(GALAXY_DIRECTORY, 'NGC2685_galaxy'))
+    assert list(batch['ap_name']) == ['galaxy']
+    assert list(cli['ap_name']) == ['galaxy']
+    assert cli['flux_250'][0] == pytest.approx(batch['flux_250'][0], rel = 1e-12)
+
+def test_rings_have_the_same_names(tmp_path):
+    with open(os.path.join(GALAXY_DIRECTORY, 'NGC2685_galaxy')) as galaxy_file:
+        lines = galaxy_file.read()
+    regions_path = tmp_path / 'NGC2685_nested'
+    regions_path.write_text(lines.rstrip('\n') + '\nellipse(8:55:33.253,+58:44:06.51,95",157",38) # color=red\n'
+                            'ellipse(8:55:33.253,+58:44:06.51,40",66",38) # color=red\n')
+    batch, cli = storedTables(tmp_path, str(regions_path))
+    names = ['nested Galaxy', 'nested Next Region 1', 'nested Next Region 2', 'nested Center']
+    assert list(batch['ap_name']) == names
+    assert list(cli['ap_name']) == names
+    assert list(cli['flux_250']) == pytest.approx(list(batch['flux_250']), rel = 1e-12)
@@ -0,0 +1,253 @@
+from astropy.io import fits
+from astropy import wcs
+import numpy as np
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+_root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_root, 'Photometry'))
+sys.path.insert(0, os.path.join(_root, 'Fitting'))
+from ds9_regions import parseRegions
+from photometry_regions import translateRegions, splitApertures, background, regionPhotometry
+from photometry_batch import discover, runJobs, tabulate
+from aperture_stack import maskStack, stackPhotometry, ringStack
+from monte_carlo import monteCarloRegions
+from fits_cache import getHeader, getData, closeAll, isSpire
+from results_table import makeTable
+from fitter import fitJobs, fitRow
+
+#Benchmarks of the photometry, HI mass and fitting stages, on the galaxies in FITS Files/ and on synthetic mosaics.
+#Each stage is run a number of times and the best and median wall times are kept, then run once more under tracemalloc
+#for its peak memory. Everything is seeded, so two runs on the same machine do the same work. The results are written
+#as JSON, and --compare reports the stages that got slower than a saved run by more than the tolerance.
+#    python benchmark.py --output before.json
+#    python benchmark.py --output after.json --compare before.json
+
+#time a stage. function is called repeats times (after one untimed warm-up call); calls is the number of items
+#(regions, rows, pixels...) it handles per call, to report the time per item.
+def timeStage(function, repeats, calls = 1):
+    function()
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'repeats': repeats, 'calls': calls, 'best': min(times), 'median': float(np.median(times)),
+            'mean': float(np.mean(times)), 'per_call': min(times) / max(calls, 1), 'peak_memory': peak}
+
+#the region file lines of a set of jobs, and each job's image data, WCS header and pixel scale
+def loadJobs(jobs):
+    lines = {}
+    for job in jobs:
+        if job['regions'] not in lines:
+            with open(job['regions']) as regions_file:
+                lines[job['regions']] = regions_file.readlines()
+    images = []
+    for job in jobs:
+        header = getHeader(job['image'], job['level'])
+        error_data = None if job['error'] == None else np.asarray(getData(job['error'], job['level']))
+        images.append((np.asarray(getData(job['image'], job['level'])), error_data, header, abs(header['CDELT1'])))
+    return lines, images
+
+#benchmark every stage on the real galaxies under root
+def sampleStages(root, repeats):
+    jobs = discover(root, False, 1)
+    lines, images = loadJobs(jobs)
+    parsed = {path: parseRegions(region_lines) for path, region_lines in lines.items()}
+    headers = [image[2] for image in images]
+    coord_infos = [wcs.WCS(header) for header in headers]
+    stages = {}
+
+    def parse():
+        for region_lines in lines.values():
+            parseRegions(region_lines)
+    stages['sample_parse'] = timeStage(parse, repeats, sum(len(regions) for regions in parsed.values()))
+
+    def convert():
+        for job, header in zip(jobs, headers):
+            regions = parsed[job['regions']]
+            regions._pixels = {} #drop the cached conversion
+            regions.toPixels(wcs.WCS(header), abs(header['CDELT1']))
+    stages['sample_wcs'] = timeStage(convert, repeats, len(jobs))
+
+    def translate():
+        for job, coord_info, image in zip(jobs, coord_infos, images):
+            translateRegions(parsed[job['regions']], coord_info, image[3])
+    stages['sample_translate'] = timeStage(translate, repeats, len(jobs))
+
+    split = [splitApertures(parsed[job['regions']], coord_info, image[3]) for job, coord_info, image in zip(jobs, coord_infos, images)]
+    for method in ['mean', 'clipped', 'median']:
+        def sky():
+            for apertures, image in zip(split, images):
+                if len(apertures[1]) > 0:
+                    background(image[0], image[1], apertures[1], method)
+        stages['sample_background_' + method] = timeStage(sky, repeats, len(jobs))
+
+    def photometry():
+        for job, coord_info, image in zip(jobs, coord_infos, images):
+            regionPhotometry(image[0], image[1], coord_info, image[3], parsed[job['regions']], isSpire(image[2], job['band']))
+    stages['sample_photometry'] = timeStage(photometry, repeats, len(jobs))
+
+    #the fits, on the table the batch photometry makes of the sample
+    outcomes = runJobs(jobs, 1)
+    succeeded = [(job, outcome[0]) for job, outcome in zip(jobs, outcomes) if outcome[1] == None]
+    table = makeTable(tabulate([job for job, regions in succeeded], [regions for job, regions in succeeded], [20, 2, 1]))
+    fit_jobs = fitJobs(table)
+    stages['sample_fit_setup'] = timeStage(lambda: fitJobs(table), repeats, len(table))
+    stages['sample_fit'] = timeStage(lambda: [fitRow(*job) for job in fit_jobs], repeats, len(fit_jobs))
+    closeAll()
+    return stages
+
+#header of a synthetic mosaic of size x size pixels with a TAN projection
+def mosaicHeader(size, scale):
+    header = fits.Header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = size
+    header['NAXIS2'] = size
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = size / 2
+    header['CRPIX2'] = size / 2
+    header['CRVAL1'] = 180.
+    header['CRVAL2'] = 45.
+    header['CDELT1'] = -scale
+    header['CDELT2'] = scale
+    header['BUNIT'] = 'Jy/pixel'
+    return header
+
+#a synthetic mosaic: noise with galaxies on it, and a region file for each galaxy with three nested red ellipses and
+#backgrounds green circles around it, in fk5 degrees. Returns (values, errors, header, list of region lines per galaxy).
+def syntheticMosaic(size, galaxies, backgrounds, seed = 0):
+    rng = np.random.default_rng(seed)
+    scale = 6 / 3600.
+    header = mosaicHeader(size, scale)
+    coord_info = wcs.WCS(header)
+    values = rng.normal(0.01, 0.005, (size, size)).astype(np.float32)
+    errors = np.full((size, size), 0.005, dtype = np.float32)
+    y, x = np.ogrid[0:size, 0:size]
+    region_files = []
+    for galaxy in range(galaxies):
+        center_x, center_y = rng.uniform(size * 0.1, size * 0.9, 2)
+        radius = rng.uniform(10, 30)
+        stamp = (slice(max(int(center_y - 4 * radius), 0), int(center_y + 4 * radius)),
+                 slice(max(int(center_x - 4 * radius), 0), int(center_x + 4 * radius)))
+        values[stamp] += np.exp(-((x[:, stamp[1]] - center_x)**2 + (y[stamp[0], :] - center_y)**2) / (2 * radius * radius)).astype(np.float32)
+        lines = ['fk5']
+        ra, dec = coord_info.all_pix2world([[center_x, center_y]], 0)[0]
+        for factor in [1., 2., 3.]:
+            lines.append('ellipse(%.6f,%.6f,%.3f",%.3f",30) # color=red' % (ra, dec, factor * radius * 6, factor * radius * 4.5))
+        angles = rng.uniform(0, 2 * np.pi, backgrounds)
+        distances = rng.uniform(4 * radius, 8 * radius, backgrounds)
+        positions = np.stack([center_x + distances * np.cos(angles), center_y + distances * np.sin(angles)], axis = 1)
+        for ra, dec in coord_info.all_pix2world(positions, 0):
+            lines.append('circle(%.6f,%.6f,%.3f")' % (ra, dec, radius * 3))
+        region_files.append(lines)
+    return (values, errors, header, region_files)
+
+#benchmark the stages on a synthetic mosaic
+def mosaicStages(size, galaxies, backgrounds, draws, repeats):
+    values, errors, header, region_files = syntheticMosaic(size, galaxies, backgrounds)
+    coord_info = wcs.WCS(header)
+    scale = abs(header['CDELT1'])
+    parsed = [parseRegions(lines) for lines in region_files]
+    split = [splitApertures(regions, coord_info, scale) for regions in parsed]
+    region_count = sum(len(regions) for regions in parsed)
+    stages = {}
+
+    stages['mosaic_parse'] = timeStage(lambda: [parseRegions(lines) for lines in region_files], repeats, region_count)
+
+    def convert():
+        for regions in parsed:
+            regions._pixels = {}
+            regions.toPixels(coord_info, scale)
+    stages['mosaic_wcs'] = timeStage(convert, repeats, region_count)
+    stages['mosaic_translate'] = timeStage(lambda: [translateRegions(regions, coord_info, scale) for regions in parsed], repeats, region_count)
+
+    for method in ['mean', 'clipped', 'median']:
+        stages['mosaic_background_' + method] = timeStage(
+            lambda: [background(values, errors, apertures[1], method) for apertures in split], repeats, galaxies * backgrounds)
+    stages['mosaic_photometry'] = timeStage(
+        lambda: [regionPhotometry(values, errors, coord_info, scale, regions, False) for regions in parsed], repeats, galaxies)
+
+    #the HI mass steps of HI Mass/mass.py: one ring pass and Monte-Carlo errors with a distance factor
+    def mass():
+        for galaxy_apertures, background_apertures in split:
+            stackPhotometry(ringStack(maskStack(galaxy_apertures, values.shape)), values, None)
+            monteCarloRegions(values, None, galaxy_apertures, background_apertures, 236000 * 20 * 20, 0.15,
+                              np.zeros(len(galaxy_apertures) + 1), draws, seed = 0,
+                              factor = lambda rng, n: ((20 + 2 * rng.standard_normal(n)) / 20)**2)
+    stages['mosaic_hi_mass'] = timeStage(mass, repeats, galaxies)
+    return stages
+
+#machine and library versions, so runs from different machines are not compared by mistake
+def environment():
+    import astropy
+    import scipy
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'astropy': astropy.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+#print the change of every stage against a saved run. Returns the names of the stages that are slower by more than tolerance.
+def compare(results, baseline, tolerance):
+    slower = []
+    print('\n%-28s %12s %12s %8s' % ('Stage', 'Before (s)', 'After (s)', 'Change'))
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        before = baseline['stages'][name]['best']
+        change = stage['best'] / before - 1 if before > 0 else 0
+        flag = ''
+        if change > tolerance:
+            slower.append(name)
+            flag = ' slower'
+        print('%-28s %12.5f %12.5f %+7.1f%%%s' % (name, before, stage['best'], change * 100, flag))
+    return slower
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time the photometry, HI mass and fitting stages and save the results as JSON.')
+    parser.add_argument('--root', default = os.path.join(_root, 'FITS Files'), help = 'directory of galaxies to benchmark (default: FITS Files)')
+    parser.add_argument('--output', default = 'benchmark.json', help = 'JSON file to write')
+    parser.add_argument('--repeats', type = int, default = 5, help = 'timed runs of each stage')
+    parser.add_argument('--size', type = int, default = 4096, help = 'side of the synthetic mosaic in pixels (0 to skip it)')
+    parser.add_argument('--galaxies', type = int, default = 20, help = 'galaxies on the synthetic mosaic')
+    parser.add_argument('--backgrounds', type = int, default = 50, help = 'background apertures per synthetic galaxy')
+    parser.add_argument('--draws', type = int, default = 10000, help = 'Monte-Carlo realisations in the HI mass stage')
+    parser.add_argument('--compare', help = 'JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type = float, default = 0.1, help = 'slowdown that counts as a regression (default: 0.1 = 10%%)')
+    args = parser.parse_args()
+
+    results = {'created': datetime.datetime.now().isoformat(timespec = 'seconds'), 'environment': environment(),
+               'settings': vars(args), 'stages': {}}
+    start = time.perf_counter()
+    if os.path.isdir(args.root):
+        results['stages'].update(sampleStages(args.root, args.repeats))
+    if args.size > 0:
+        results['stages'].update(mosaicStages(args.size, args.galaxies, args.backgrounds, args.draws, args.repeats))
+    results['total_time'] = time.perf_counter() - start
+    results['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #kilobytes on Linux
+
+    print('%-28s %12s %12s %14s' % ('Stage', 'Best (s)', 'Per item (s)', 'Peak memory'))
+    for name, stage in results['stages'].items():
+        print('%-28s %12.5f %12.2e %11.1f MB' % (name, stage['best'], stage['per_call'], stage['peak_memory'] / 1e6))
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent = 2)
+    print('\nWrote ' + args.output)
+
+    if args.compare != None:
+        with open(args.compare) as baseline_file:
+            slower = compare(results, json.load(baseline_file), args.tolerance)
+        if len(slower) > 0:
+            print('\n' + str(len(slower)) + ' stages are slower than ' + args.compare)
+            sys.exit(1)
@@ -0,0 +1,322 @@
+import argparse
+import json
+import math
+import os
+import sys
+
+#One command for the photometry, HI mass and fitting steps, without prompts:
+#    python etg.py photometry "FITS Files/NGC2685/NGC2685_250.fits" --regions NGC2685_galaxy.reg --error NGC2685_250_error.fits
+#    python etg.py aperture NGC2685_250.fits --ra "8 55 34.7" --dec "58 44 4" --ellipse 120 60 30 --error NGC2685_250_error.fits
+#    python etg.py hi-mass NGC2685_HI.fits --regions NGC2685_HI.reg --distance 16.7 --distance-error 1.5 --galaxy NGC2685
+#    python etg.py fit --mode g --workers 4
+#Every option can also come from a JSON config file given with --config, holding the options by name (with dashes or
+#underscores), either for one command or in a section per command. They are checked and converted like the same options
+#on the command line, and options on the command line win:
+#    {"photometry": {"level": 1, "sky": "clipped"}, "fit": {"mode": "g", "plots": true}}
+#Only the standard library is imported up front. astropy, photutils, scipy and the modules in Photometry/, HI Mass/ and
+#Fitting/ are imported inside the command that needs them, so --help and mistakes in the options come back at once.
+
+_root = os.path.dirname(os.path.abspath(__file__))
+
+#sky estimates of Photometry/sky.py (sky.METHODS, which is not imported here to keep startup fast)
+SKY_METHODS = ['mean', 'clipped', 'median']
+
+#make the modules of the given directories of the repository importable
+def usePaths(*directories):
+    for directory in directories:
+        path = os.path.join(_root, directory)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+#the options of a config file for a command: the entries of its section, on top of the entries that are not sections.
+#Names may use dashes or underscores.
+def readConfig(path, command, commands):
+    with open(path) as config_file:
+        config = json.load(config_file)
+    if not isinstance(config, dict):
+        raise ValueError('The config file must hold a JSON object')
+    options = {key: value for key, value in config.items() if key not in commands}
+    section = config.get(command, {})
+    if not isinstance(section, dict):
+        raise ValueError('The \'' + command + '\' section of the config file must be a JSON object')
+    options.update(section)
+    return {key.replace('-', '_'): value for key, value in options.items()}
+
+#the options of a config file (from readConfig) as defaults for a command, checked and converted like the same options
+#on the command line: every name must be an option of the command, flags take true or false, options with several
+#values take a list, and each value goes through the option's type and choices. Mistakes are reported with parser.error.
+def configDefaults(options, parser, path):
+    actions = {action.dest: action for action in parser._actions if action.dest not in ['help', 'config']}
+    unknown = sorted(set(options) - set(actions) - {'config'})
+    if len(unknown) > 0:
+        parser.error('unknown options in ' + path + ': ' + ', '.join(unknown))
+    defaults = {}
+    for name, value in options.items():
+        if name == 'config':
+            continue
+        action = actions[name]
+        if action.nargs == 0: #a flag such as --local-sky, or --spire / --pacs
+            if not isinstance(value, bool):
+                parser.error('the option ' + name + ' in ' + path + ' takes true or false')
+            defaults[name] = value
+            continue
+        several = isinstance(action.nargs, int) or action.nargs in ['*', '+']
+        values = value if several and isinstance(value, list) else [value]
+        if several != isinstance(value, list) or (isinstance(action.nargs, int) and len(values) != action.nargs):
+            count = str(action.nargs) + ' values' if isinstance(action.nargs, int) else 'a list of values' if several else 'one value'
+            parser.error('the option ' + name + ' in ' + path + ' takes ' + count)
+        converted = []
+        for item in values:
+            try:
+                item = action.type(str(item)) if action.type != None else item
+            except (TypeError, ValueError):
+                parser.error('invalid value for ' + name + ' in ' + path + ': ' + json.dumps(item))
+            if action.choices != None and item not in action.choices:
+                parser.error('invalid value for ' + name + ' in ' + path + ': ' + json.dumps(item) + ' (choose from ' +
+                             ', '.join(str(choice) for choice in action.choices) + ')')
+            converted.append(item)
+        defaults[name] = converted if several else converted[0]
+    return defaults
+
+#name of the apertures of a region file in the results store, the region file name without the galaxy prefix like
+#regionSetName in Photometry/photometry_batch.py, unless one is given with --aperture-name
+def apertureName(args):
+    if args.aperture_name != None:
+        return args.aperture_name
+    name = os.path.basename(args.regions)
+    if name.startswith(args.galaxy + '_'):
+        name = name[len(args.galaxy) + 1:]
+    return name
+
+#True if an image is SPIRE data in MJy / sr rather than PACS data in Jy / pix: as given by --spire / --pacs, or from
+#its BUNIT and --band (see isSpire in Photometry/fits_cache.py)
+def spireUnits(args, header, parser):
+    if args.spire != None:
+        return args.spire
+    from fits_cache import isSpire
+    try:
+        return isSpire(header, args.band)
+    except ValueError:
+        parser.error('the image has no BUNIT, so give --band, --spire or --pacs')
+
+#a position in degrees from 'hour min sec' (RA) or 'deg arcmin arcsec' (declination), or from a single number in degrees
+def positionDegrees(text, ra, parser):
+    from photometry import positionToDegrees
+    try:
+        parts = [float(part) for part in str(text).split()]
+    except ValueError:
+        parts = []
+    if len(parts) == 1:
+        return parts[0]
+    if len(parts) != 3:
+        parser.error('positions are \'hour min sec\' for RA, \'deg arcmin arcsec\' for declination, or degrees: ' + str(text))
+    return positionToDegrees(parts[0], parts[1], parts[2], ra)
+
+#region photometry on one image, like Photometry/photometry_regions.py
+def runPhotometry(args, parser):
+    if args.regions == None:
+        parser.error('the regions file is required (--regions)')
+    if args.galaxy != None and args.band == None:
+        parser.error('--band is required to save the results (--galaxy)')
+    usePaths('Photometry')
+    from fits_cache import getHeader, getData, getWcs, closeAll
+    from ds9_regions import readRegions
+    from photometry_regions import regionPhotometry, printRegions, saveRegions
+    from results_store import DEFAULT_STORE
+
+    header = getHeader(args.image, args.level)
+    try:
+        pix_scale = abs(header[args.scale_key])
+    except KeyError:
+        parser.error('the pixel scale variable ' + args.scale_key + ' was not found in ' + args.image)
+    spire = spireUnits(args, header, parser)
+    value_data = getData(args.image, args.level)
+    error_data = getData(args.error, args.level) if args.error != None else None
+    regions = readRegions(args.regions)
+
+    sky_method = 'clipped' if args.local_sky else args.sky
+    subtracted, sky, galaxy_apertures_sorted = regionPhotometry(value_data, error_data, getWcs(args.image, args.level), pix_scale,
+                                                                regions, spire, sky_method, args.local_sky, args.monte_carlo)
+    print(('SPIRE' if spire else 'PACS') + ' units\n')
+    printRegions(subtracted, sky)
+    if args.galaxy != None:
+        set_name = apertureName(args)
+        saveRegions(args.galaxy, args.band, set_name, subtracted, galaxy_apertures_sorted,
+                    {'level': args.level, 'errors': args.error != None, 'draws': args.monte_carlo, 'sky': sky_method, 'local_sky': args.local_sky},
+                    args.store or DEFAULT_STORE)
+    closeAll()
+
+#HI masses on a moment-0 map or a cube, like HI Mass/mass.py
+def runHiMass(args, parser):
+    if args.regions == None:
+        parser.error('the regions file is required (--regions)')
+    if args.distance == None:
+        parser.error('the distance is required (--distance)')
+    usePaths('Photometry', 'HI Mass')
+    from fits_cache import openFits, closeAll
+    from ds9_regions import readRegions
+    from mass import hiMasses, printMasses, saveMasses, isCube
+    from results_store import DEFAULT_STORE
+
+    hdu = openFits(args.image)[args.level]
+    if args.monte_carlo > 0 and isCube(hdu.header):
+        print('The Monte-Carlo errors need a 2D image, using the analytic errors for this cube.\n')
+    try:
+        names, masses, sky_errors, errors, pixels, channels = hiMasses(hdu.data, hdu.header, readRegions(args.regions), args.distance,
+                                                                      args.distance_error, args.monte_carlo, args.velocity_range)
+    except ValueError as error: #a velocity range outside the cube, or a bad region file
+        parser.error(str(error))
+    printMasses(names, masses, errors)
+    if args.galaxy != None:
+        set_name = apertureName(args)
+        saveMasses(args.galaxy, set_name, names, masses, sky_errors, errors, pixels,
+                   {'level': args.level, 'distance': args.distance, 'derror': args.distance_error,
+                    'draws': 0 if channels != None else args.monte_carlo, 'window': list(channels) if channels != None else None},
+                   args.store or DEFAULT_STORE)
+    closeAll()
+
+#photometry on one circular or elliptical aperture, like Photometry/photometry.py
+def runAperture(args, parser):
+    if args.ra == None or args.dec == None:
+        parser.error('the position is required (--ra and --dec)')
+    if (args.radius == None) == (args.ellipse == None):
+        parser.error('give one aperture, --radius or --ellipse')
+    if args.galaxy != None and args.band == None:
+        parser.error('--band is required to save the result (--galaxy)')
+    usePaths('Photometry')
+    from fits_cache import getHeader, getData, getWcs, closeAll
+    from photometry import measureAperture, saveAperture
+    from results_store import DEFAULT_STORE
+
+    ra = positionDegrees(args.ra, True, parser)
+    dec = positionDegrees(args.dec, False, parser)
+    header = getHeader(args.image, args.level)
+    try:
+        pix_scale = abs(header[args.scale_key])
+    except KeyError:
+        parser.error('the pixel scale variable ' + args.scale_key + ' was not found in ' + args.image)
+    value_data = getData(args.image, args.level)
+    error_data = getData(args.error, args.level) if args.error != None else None
+    coord_info = getWcs(args.image, args.level)
+    if args.radius != None:
+        photometry_results, pixels, settings = measureAperture(value_data, error_data, coord_info, pix_scale, ra, dec, abs(args.radius))
+    else:
+        semimajor, semiminor, angle = args.ellipse
+        photometry_results, pixels, settings = measureAperture(value_data, error_data, coord_info, pix_scale, ra, dec, None,
+                                                               abs(semimajor), abs(semiminor), angle * math.pi / 180)
+    print(photometry_results)
+    if args.galaxy != None:
+        saveAperture(args.galaxy, args.band, args.aperture_name or settings['aperture'], photometry_results, pixels, pix_scale,
+                     spireUnits(args, header, parser), settings, args.store or DEFAULT_STORE)
+    closeAll()
+
+#fit every row of a results table or store, like Fitting/fitter.py
+def runFitting(args, parser):
+    usePaths('Photometry', 'Fitting')
+    from fitter import runFit
+    from results_store import DEFAULT_STORE, loadResults
+
+    data = loadResults(args.results or DEFAULT_STORE, None if args.store_config == 'all' else args.store_config)
+    workers = args.workers if args.workers >= 1 else os.cpu_count() or 1
+    runFit(data, workers, args.mode, args.plots, args.output, args.cache, args.plot_directory)
+
+#the parser for every command, and a dict of command name to (subparser, function that runs it)
+def buildParser():
+    parser = argparse.ArgumentParser(description = 'Photometry, HI masses and dust fits of the ETG sample, without prompts.')
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument('--config', help = 'JSON file of options, for every command or in a section per command')
+    commands = parser.add_subparsers(dest = 'command', metavar = 'command')
+    commands.required = True
+
+    photometry = commands.add_parser('photometry', parents = [common], help = 'region photometry on one image',
+                                     description = 'Region photometry on one image (see Photometry/photometry_regions.py).')
+    photometry.add_argument('image', nargs = '?', help = 'FITS image')
+    photometry.add_argument('--regions', help = 'ds9 region file: background apertures green, galaxy apertures red')
+    photometry.add_argument('--error', help = 'FITS image of the errors')
+    photometry.add_argument('--level', type = int, default = 1, help = 'level of the FITS files to analyze (default: 1)')
+    photometry.add_argument('--scale-key', default = 'CDELT1', help = 'header variable holding the pixel scale (default: CDELT1)')
+    units = photometry.add_mutually_exclusive_group()
+    units.add_argument('--spire', dest = 'spire', action = 'store_const', const = True, help = 'the image is SPIRE data in MJy / sr')
+    units.add_argument('--pacs', dest = 'spire', action = 'store_const', const = False, help = 'the image is PACS data in Jy / pix')
+    photometry.add_argument('--band', type = int, help = 'band in microns, to tell SPIRE from PACS without BUNIT and to save the results')
+    photometry.add_argument('--sky', choices = SKY_METHODS, default = 'mean',
+                            help = 'sky estimate: mean of the background apertures, or the sigma clipped mean or median of their pixels')
+    photometry.add_argument('--local-sky', action = 'store_true', help = 'measure the sky in an annulus around the galaxy instead of the background apertures')
+    photometry.add_argument('--monte-carlo', type = int, default = 0, metavar = 'N',
+                            help = 'use N Monte-Carlo realisations for the errors instead of the analytic errors')
+    photometry.add_argument('--galaxy', help = 'save the results to the results store under this galaxy name')
+    photometry.add_argument('--aperture-name', help = 'name of the apertures in the results store (default: the region file name without the galaxy name)')
+    photometry.add_argument('--store', help = 'results store to save to (default: Photometry/photometry_store.csv)')
+
+    hi_mass = commands.add_parser('hi-mass', parents = [common], help = 'HI masses on a moment-0 map or a cube',
+                                  description = 'HI masses on a moment-0 map or a cube with velocity as its third axis (see HI Mass/mass.py).')
+    hi_mass.add_argument('image', nargs = '?', help = 'FITS moment-0 map or cube')
+    hi_mass.add_argument('--regions', help = 'ds9 region file: background apertures green, galaxy apertures red')
+    hi_mass.add_argument('--level', type = int, default = 0, help = 'level of the FITS file to analyze (default: 0)')
+    hi_mass.add_argument('--distance', type = float, help = 'distance to the galaxy in Mpc')
+    hi_mass.add_argument('--distance-error', type = float, default = 0., help = 'error in the distance in Mpc (default: 0)')
+    hi_mass.add_argument('--velocity-range', type = float, nargs = 2, metavar = ('VMIN', 'VMAX'),
+                         help = 'velocities in km/s to integrate a cube over (default: every channel)')
+    hi_mass.add_argument('--monte-carlo', type = int, default = 0, metavar = 'N',
+                         help = 'use N Monte-Carlo realisations for the errors of a moment-0 map instead of the analytic errors')
+    hi_mass.add_argument('--galaxy', help = 'save the masses to the results store under this galaxy name')
+    hi_mass.add_argument('--aperture-name', help = 'name of the apertures in the results store (default: the region file name without the galaxy name)')
+    hi_mass.add_argument('--store', help = 'results store to save to (default: Photometry/photometry_store.csv)')
+
+    aperture = commands.add_parser('aperture', parents = [common], help = 'photometry on one circular or elliptical aperture',
+                                   description = 'Photometry on one circular or elliptical aperture, without a sky (see Photometry/photometry.py).')
+    aperture.add_argument('image', nargs = '?', help = 'FITS image')
+    aperture.add_argument('--ra', help = 'right ascension of the center, \'hour min sec\' or degrees')
+    aperture.add_argument('--dec', help = 'declination of the center, \'deg arcmin arcsec\' or degrees')
+    shape = aperture.add_mutually_exclusive_group()
+    shape.add_argument('--radius', type = float, help = 'radius of a circular aperture in arcseconds')
+    shape.add_argument('--ellipse', type = float, nargs = 3, metavar = ('SEMIMAJOR', 'SEMIMINOR', 'ANGLE'),
+                       help = 'elliptical aperture: axes in arcseconds and rotation angle in degrees')
+    aperture.add_argument('--error', help = 'FITS image of the errors')
+    aperture.add_argument('--level', type = int, default = 1, help = 'level of the FITS files to analyze (default: 1)')
+    aperture.add_argument('--scale-key', default = 'CDELT1', help = 'header variable holding the pixel scale (default: CDELT1)')
+    aperture_units = aperture.add_mutually_exclusive_group()
+    aperture_units.add_argument('--spire', dest = 'spire', action = 'store_const', const = True, help = 'the image is SPIRE data in MJy / sr')
+    aperture_units.add_argument('--pacs', dest = 'spire', action = 'store_const', const = False, help = 'the image is PACS data in Jy / pix')
+    aperture.add_argument('--band', type = int, help = 'band in microns, to tell SPIRE from PACS without BUNIT and to save the result')
+    aperture.add_argument('--galaxy', help = 'save the result to the results store under this galaxy name')
+    aperture.add_argument('--aperture-name', help = 'name of the aperture in the results store (default: circular or elliptical)')
+    aperture.add_argument('--store', help = 'results store to save to (default: Photometry/photometry_store.csv)')
+
+    fit = commands.add_parser('fit', parents = [common], help = 'fit modified blackbodies to a results table or store',
+                              description = 'Fit a modified blackbody to every aperture of a results table or store (see Fitting/fitter.py).')
+    fit.add_argument('results', nargs = '?', help = 'results table (.npy or .csv) or results store (default: Photometry/photometry_store.csv)')
+    fit.add_argument('--store-config', default = 'latest', metavar = 'CONFIG',
+                     help = 'config hash of the store measurements to fit, \'latest\' for the latest config of each galaxy, or \'all\' for every measurement (default: latest)')
+    fit.add_argument('--mode', choices = ['f', 'g', 'm'], default = 'f',
+                     help = '\'f\' runs the full fit, \'g\' looks up the nearest grid point, \'m\' samples the posterior with MCMC (default: f)')
+    fit.add_argument('--workers', type = int, default = 0, help = 'number of worker processes (default: one per core)')
+    fit.add_argument('--plots', action = 'store_true', help = 'plot every fit, with a PDF of all plots for each galaxy')
+    fit.add_argument('--plot-directory', default = 'plots', help = 'directory to write the plots to (default: plots)')
+    fit.add_argument('--output', default = 'fitting_results.csv', help = 'csv to write the fits to (default: fitting_results.csv)')
+    fit.add_argument('--cache', default = 'fitting_cache.jsonl', help = 'cache of finished fits, so an interrupted run can be resumed (default: fitting_cache.jsonl)')
+
+    return (parser, {'photometry': (photometry, runPhotometry), 'aperture': (aperture, runAperture), 'hi-mass': (hi_mass, runHiMass),
+                     'fit': (fit, runFitting)})
+
+#parse the command line, with the defaults of the config file if one is given, and run the command
+def main(argv = None):
+    parser, commands = buildParser()
+    args = parser.parse_args(argv)
+    subparser, run = commands[args.command]
+    if args.config != None:
+        try:
+            options = readConfig(args.config, args.command, commands)
+        except (OSError, ValueError) as error:
+            subparser.error('could not read the config file ' + args.config + ': ' + str(error))
+        subparser.set_defaults(**configDefaults(options, subparser, args.config))
+        args = parser.parse_args(argv)
+    if args.command != 'fit' and args.image == None:
+        subparser.error('the image is required')
+    try:
+        run(args, subparser)
+    except OSError as error: #a missing or unreadable file
+        subparser.error(str(error))
+
+if __name__ == '__main__':
+    main()